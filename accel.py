@@ -0,0 +1,147 @@
+import argparse
+import contextlib
+import time
+
+import torch
+
+
+class AccelConfig:
+    """
+    Opt-in CPU inference acceleration for the evaluators:
+        int8           dynamic int8 quantization of nn.Linear layers
+        bf16           bfloat16 autocast during the forward pass
+        compile        torch.compile of the model (or the given submodules)
+        channels_last  channels-last memory format for image inputs
+    Parsed from strings like "int8+compile".
+    """
+    OPTIONS = ("int8", "bf16", "compile", "channels_last")
+
+    def __init__(self, int8=False, bf16=False, compile=False, channels_last=False):
+        self.int8 = int8
+        self.bf16 = bf16
+        self.compile = compile
+        self.channels_last = channels_last
+
+    @classmethod
+    def parse(cls, spec):
+        if spec is None or isinstance(spec, cls):
+            return spec
+        options = [o.strip() for o in spec.split("+") if o.strip() and o.strip() != "fp32"]
+        unknown = [o for o in options if o not in cls.OPTIONS]
+        if unknown:
+            raise ValueError(f"unknown acceleration option(s) {unknown}, expected {cls.OPTIONS}")
+        return cls(**{o: True for o in options})
+
+    @property
+    def tag(self):
+        """Short description; also part of the embedding cache namespace since int8/bf16 shift features."""
+        return "+".join(o for o in self.OPTIONS if getattr(self, o)) or "fp32"
+
+
+def apply_accel(model, accel, device="cpu", compile_attrs=None):
+    """
+    Return model prepared according to accel. compile_attrs names submodules to
+    compile instead of the whole model (CLIP is called through get_*_features,
+    which bypasses a compiled wrapper's forward).
+    """
+    if accel is None:
+        return model
+    model.eval()
+    if accel.int8:
+        if str(device).startswith("cuda"):
+            print("int8 dynamic quantization is CPU-only, skipping it on", device)
+        else:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if accel.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if accel.compile and hasattr(torch, "compile"):
+        if compile_attrs:
+            for attr in compile_attrs:
+                setattr(model, attr, torch.compile(getattr(model, attr)))
+        else:
+            model = torch.compile(model)
+    return model
+
+
+def inference_context(accel):
+    """no_grad for the default path; inference_mode (+ bf16 autocast) when accelerated."""
+    if accel is None:
+        return torch.no_grad()
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if accel.bf16:
+        stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+    return stack
+
+
+def check_accuracy_drift(reference_dirs, accel, tolerance=0.01):
+    """
+    Compare CLIP-T and DINO-I of accelerated evaluators against fp32 on a
+    reference set of sequence directories (step_N.png + prompts.json).
+
+    Returns:
+        dict with per-metric max absolute drift, images/sec for both modes and
+        whether every drift is within tolerance
+    """
+    from PIL import Image
+    from dino_eval import DinoEval
+    from clip_eval import CLIPEvaluator
+    from utils import load_sequence
+
+    sequences = []
+    for seq_dir in reference_dirs:
+        image_paths, goal, prompts = load_sequence(seq_dir)
+        sequences.append(([Image.open(p).convert("RGB") for p in image_paths], prompts))
+    num_images = sum(len(images) for images, _ in sequences)
+
+    results = {}
+    for label, config in (("fp32", None), (accel.tag, accel)):
+        dino_evaluator = DinoEval(accel=config)
+        clip_evaluator = CLIPEvaluator(accel=config)
+        # one untimed pass so compile/warm-up cost does not count as throughput
+        dino_evaluator.extract_dino_features(sequences[0][0][:1])
+        clip_evaluator.extract_clip_image_features(sequences[0][0][:1])
+
+        metrics = []
+        start = time.perf_counter()
+        for images, prompts in sequences:
+            metrics.append({
+                "clip_t": float(clip_evaluator.compute_clip_t(images, prompts)),
+                "dino_i": float(dino_evaluator.compute_dino_i(images)),
+            })
+        elapsed = time.perf_counter() - start
+        results[label] = {"metrics": metrics, "images_per_sec": 2 * num_images / elapsed}
+
+    reference, accelerated = results["fp32"]["metrics"], results[accel.tag]["metrics"]
+    drift = {
+        name: max(abs(a[name] - r[name]) for a, r in zip(accelerated, reference))
+        for name in ("clip_t", "dino_i")
+    }
+    return {
+        "mode": accel.tag,
+        "tolerance": tolerance,
+        "max_drift": drift,
+        "passed": all(d <= tolerance for d in drift.values()),
+        "images_per_sec": {label: r["images_per_sec"] for label, r in results.items()},
+        "speedup": results[accel.tag]["images_per_sec"] / results["fp32"]["images_per_sec"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check metric drift of accelerated evaluators against fp32")
+    parser.add_argument("reference_dirs", nargs="+", help="sequence directories with step_N.png and prompts.json")
+    parser.add_argument("--mode", default="int8", help="e.g. int8, bf16, int8+compile")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="max allowed absolute CLIP-T/DINO-I drift")
+    args = parser.parse_args()
+
+    report = check_accuracy_drift(args.reference_dirs, AccelConfig.parse(args.mode), args.tolerance)
+    print(f"mode {report['mode']}: speedup {report['speedup']:.2f}x "
+          f"({report['images_per_sec']['fp32']:.1f} -> {report['images_per_sec'][report['mode']]:.1f} images/sec)")
+    for name, drift in report["max_drift"].items():
+        print(f"  max |{name} drift| = {drift:.5f} (tolerance {args.tolerance})")
+    print("PASS" if report["passed"] else "FAIL")
+    raise SystemExit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import ThrottledError
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket whose refill rate adapts to throttling:
+    halved on every throttling response, slowly raised again on success.
+    """
+    def __init__(self, rate=2.0, burst=None, min_rate=0.1, max_rate=None, recovery=1.05):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.recovery = recovery
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1.0:
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1.0
+
+    def on_throttle(self):
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * 0.5)
+        self.tokens = 0.0
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate * self.recovery)
+
+
+class AsyncEngine:
+    """
+    Asyncio front end for the blocking DashScope clients. Calls run on a worker
+    pool sized to max_concurrency, are admitted by an adaptive TokenBucket and
+    are retried with exponential backoff when DashScope throttles them.
+    """
+    def __init__(self, generator=None, editor=None, rewriter=None, vlm=None,
+                 max_concurrency=8, rate=2.0, burst=None, max_retries=5, backoff=1.0):
+        self.generator = generator
+        self.editor = editor
+        self.rewriter = rewriter
+        self.vlm = vlm
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="dashscope")
+        # created lazily so they bind to the running event loop
+        self.loop = None
+        self.semaphore = None
+        self.bucket = None
+
+    def _ensure_limits(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.bucket = TokenBucket(self.rate, self.burst)
+
+    async def call(self, fn, *args, **kwargs):
+        """Run a blocking client call under the concurrency and rate limits."""
+        self._ensure_limits()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            async with self.semaphore:
+                # carry the caller's trace context (sequence/step ids) onto the worker thread
+                ctx = contextvars.copy_context()
+                try:
+                    result = await loop.run_in_executor(self.executor, lambda: ctx.run(fn, *args, **kwargs))
+                except ThrottledError as e:
+                    self.bucket.on_throttle()
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                    print(f"throttled ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+            self.bucket.on_success()
+            return result
+
+    def _client(self, name):
+        client = getattr(self, name)
+        if client is None:
+            if name == "generator":
+                from image_gen import image_generator
+                client = image_generator()
+            elif name == "editor":
+                from image_edit import image_editor
+                client = image_editor()
+            elif name == "rewriter":
+                from prompt_rewriter import prompt_rewriter
+                client = prompt_rewriter()
+            else:
+                from vlm_analyzer import vlm_analyzer
+                client = vlm_analyzer()
+            setattr(self, name, client)
+        return client
+
+    async def generate_image(self, prompt, filename, **kwargs):
+        return await self.call(self._client("generator").generate_image, prompt, filename, **kwargs)
+
+    async def edit_image(self, image_filepath, prompt, dest_filename, edit_url, **kwargs):
+        return await self.call(self._client("editor").edit_image, image_filepath, prompt, dest_filename, edit_url, **kwargs)
+
+    async def rewrite_prompt(self, original_prompt, **kwargs):
+        return await self.call(self._client("rewriter").rewrite_prompt, original_prompt, **kwargs)
+
+    async def rewrite_prompt_for_edit(self, original_prompt, edit_prompt, **kwargs):
+        return await self.call(self._client("rewriter").rewrite_prompt_for_edit, original_prompt, edit_prompt, **kwargs)
+
+    async def check_image_consistency(self, image_1_path, image_1_prompt, image_2_path, image_2_prompt, **kwargs):
+        return await self.call(self._client("vlm").check_image_consistency,
+                               image_1_path, image_1_prompt, image_2_path, image_2_prompt, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
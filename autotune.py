@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+DEFAULT_TUNING_PATH = os.getenv(
+    "AUTOTUNE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "image_gen_framework", "autotune.json")
+)
+EVALUATORS = ("dino", "clip")
+
+
+def host_key():
+    """Identifies the hardware/software combination a tuning result is valid for."""
+    import torch
+
+    return f"{platform.node()}|{platform.machine()}|cpus={os.cpu_count()}|torch={torch.__version__}"
+
+
+def _read_all(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_tuning(evaluator_name, path=DEFAULT_TUNING_PATH):
+    """Best known {batch_size, num_threads, interop_threads} for this host, or None."""
+    return _read_all(path).get(host_key(), {}).get(evaluator_name)
+
+
+def save_tuning(evaluator_name, config, path=DEFAULT_TUNING_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tunings = _read_all(path)
+    tunings.setdefault(host_key(), {})[evaluator_name] = config
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tunings, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def apply_threads(config, num_threads=None):
+    """
+    Apply a tuning's thread counts to this process, once at evaluator load; both
+    are process-wide, so the evaluators share one setting. num_threads is an
+    intra-op count the caller already pinned (e.g. one share of the CPUs per
+    dataset_eval worker); it is left alone instead of the tuned one being applied.
+    """
+    import torch
+
+    if num_threads is None and config.get("num_threads"):
+        torch.set_num_threads(config["num_threads"])
+    if config.get("interop_threads"):
+        try:
+            torch.set_num_interop_threads(config["interop_threads"])
+        except RuntimeError:
+            # only settable before the first inter-op parallel work in the process
+            pass
+
+
+def run_chunked(forward_fn, items, batch_size):
+    """Call forward_fn on batch_size-sized chunks of items and concatenate the results."""
+    import torch
+
+    if not batch_size or len(items) <= batch_size:
+        return forward_fn(items)
+    return torch.cat([forward_fn(items[i:i + batch_size]) for i in range(0, len(items), batch_size)])
+
+
+def peak_rss_mb():
+    # ru_maxrss never goes down, so it is only a per-trial figure while trials in
+    # a process use more and more memory (see _profile_in_process)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _synthetic_images(count, size):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def _profile_in_process(evaluator_name, interop_threads, num_threads, batch_sizes, image_size, max_memory_mb):
+    """
+    Profile increasing batch sizes for one inter-op/intra-op thread setting (must
+    run in a fresh process). Memory only grows with the batch size, so the
+    process's peak RSS after each trial is that trial's own peak.
+    """
+    import torch
+
+    torch.set_num_interop_threads(interop_threads)
+    if evaluator_name == "dino":
+        from dino_eval import DinoEval
+        evaluator = DinoEval(batch_size=0)
+        forward = evaluator._dino_forward
+    else:
+        from clip_eval import CLIPEvaluator
+        evaluator = CLIPEvaluator(batch_size=0)
+        forward = evaluator._clip_image_forward
+
+    torch.set_num_threads(num_threads)
+    images = _synthetic_images(max(batch_sizes), image_size)
+    forward(images[:1])
+
+    trials = []
+    for batch_size in sorted(batch_sizes):
+        batch = images[:batch_size]
+        start = time.perf_counter()
+        repeats = 0
+        while repeats < 2 or time.perf_counter() - start < 1.0:
+            forward(batch)
+            repeats += 1
+        elapsed = time.perf_counter() - start
+        peak = peak_rss_mb()
+        trials.append({
+            "batch_size": batch_size,
+            "num_threads": num_threads,
+            "interop_threads": interop_threads,
+            "images_per_sec": batch_size * repeats / elapsed,
+            "peak_rss_mb": peak,
+        })
+        if peak > max_memory_mb:
+            # larger batches only use more memory
+            break
+    return trials
+
+
+def tune(evaluator_name, batch_sizes=(1, 2, 4, 8, 16, 32), thread_counts=None, interop_counts=(1, 2, 4),
+         image_size=1328, max_memory_mb=None, path=DEFAULT_TUNING_PATH):
+    """
+    Profile an evaluator over batch size x intra-op threads x inter-op threads and
+    persist the fastest configuration whose peak memory stays within max_memory_mb.
+    Each inter-op x intra-op setting runs in its own process: torch fixes the
+    inter-op count at first use, and a fresh process starts peak RSS from scratch.
+    """
+    cpus = os.cpu_count() or 1
+    if thread_counts is None:
+        thread_counts = sorted({t for t in (1, 2, 4, 8, 16, 32, cpus) if t <= cpus})
+    if max_memory_mb is None:
+        total_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2 ** 20
+        max_memory_mb = 0.75 * total_mb
+
+    trials = []
+    for interop_threads in interop_counts:
+        if interop_threads > cpus:
+            continue
+        for num_threads in thread_counts:
+            cmd = [
+                sys.executable, os.path.abspath(__file__), "profile-worker",
+                "--evaluator", evaluator_name,
+                "--interop", str(interop_threads),
+                "--threads", str(num_threads),
+                "--batch-sizes", ",".join(map(str, batch_sizes)),
+                "--image-size", str(image_size),
+                "--max-memory-mb", str(max_memory_mb),
+            ]
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            trials.extend(json.loads(output.strip().splitlines()[-1]))
+
+    within_budget = [t for t in trials if t["peak_rss_mb"] <= max_memory_mb]
+    if not within_budget:
+        raise RuntimeError(f"no {evaluator_name} configuration fits in {max_memory_mb:.0f} MB")
+    best = max(within_budget, key=lambda t: t["images_per_sec"])
+    best = dict(best, tuned_at=time.time(), max_memory_mb=max_memory_mb)
+    save_tuning(evaluator_name, best, path)
+    return best, trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Autotune batch size and thread counts for CPU feature extraction")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    tune_parser = sub.add_parser("tune", help="profile this host and persist the best configuration")
+    tune_parser.add_argument("--evaluator", nargs="+", choices=EVALUATORS, default=list(EVALUATORS))
+    tune_parser.add_argument("--batch-sizes", default="1,2,4,8,16,32")
+    tune_parser.add_argument("--interop", default="1,2,4")
+    tune_parser.add_argument("--image-size", type=int, default=1328)
+    tune_parser.add_argument("--max-memory-mb", type=float)
+    tune_parser.add_argument("--path", default=DEFAULT_TUNING_PATH)
+
+    show_parser = sub.add_parser("show", help="print the persisted configuration for this host")
+    show_parser.add_argument("--path", default=DEFAULT_TUNING_PATH)
+
+    worker = sub.add_parser("profile-worker")
+    worker.add_argument("--evaluator", choices=EVALUATORS, required=True)
+    worker.add_argument("--interop", type=int, required=True)
+    worker.add_argument("--threads", type=int, required=True)
+    worker.add_argument("--batch-sizes", required=True)
+    worker.add_argument("--image-size", type=int, required=True)
+    worker.add_argument("--max-memory-mb", type=float, required=True)
+    args = parser.parse_args()
+
+    if args.command == "profile-worker":
+        trials = _profile_in_process(
+            args.evaluator, args.interop, args.threads,
+            [int(b) for b in args.batch_sizes.split(",")], args.image_size, args.max_memory_mb
+        )
+        print(json.dumps(trials))
+    elif args.command == "tune":
+        for evaluator_name in args.evaluator:
+            best, trials = tune(
+                evaluator_name,
+                batch_sizes=[int(b) for b in args.batch_sizes.split(",")],
+                interop_counts=[int(i) for i in args.interop.split(",")],
+                image_size=args.image_size, max_memory_mb=args.max_memory_mb, path=args.path
+            )
+            print(f"{evaluator_name}: batch_size={best['batch_size']} threads={best['num_threads']} "
+                  f"interop={best['interop_threads']} -> {best['images_per_sec']:.1f} images/sec "
+                  f"({len(trials)} configurations tried, peak {best['peak_rss_mb']:.0f} MB)")
+    else:
+        print(json.dumps(_read_all(args.path).get(host_key(), {}), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_engine import AsyncEngine
+from candidate_ranker import best_of_n
+from draft import DraftFrame, new_seed
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+import image_writer
+import tracing
+
+
+def load_specs(spec_path):
+    """
+    Read sequence specs, one JSON object per line:
+        {"goal": "...", "prompts": ["step 1", "step 2", ...], "output_dir": "...",
+         "auto_accept": "always" | "vlm", "rewrite": "first" | "all" | "none",
+         "edit_from": "first" | "previous", "max_attempts": 3, "num_candidates": 1,
+         "draft": false, "id": "..."}
+    Only goal, prompts and output_dir are required. With draft, edit attempts and
+    candidates are low-resolution previews and only the accepted one is rendered
+    at full resolution (same source, prompt and seed).
+    """
+    specs = []
+    with open(spec_path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            specs.append(normalize_spec(json.loads(line), f"{spec_path}:{line_num}"))
+    return specs
+
+
+def normalize_spec(spec, where="spec"):
+    """Check a spec's required fields and fill in the defaults (see load_specs)."""
+    for field in ("goal", "prompts", "output_dir"):
+        if field not in spec:
+            raise ValueError(f"{where}: missing '{field}'")
+    spec.setdefault("id", os.path.basename(os.path.normpath(spec["output_dir"])))
+    spec.setdefault("auto_accept", "always")
+    spec.setdefault("rewrite", "first")
+    spec.setdefault("edit_from", "first")
+    spec.setdefault("max_attempts", 3)
+    spec.setdefault("num_candidates", 1)
+    spec.setdefault("draft", False)
+    return spec
+
+
+class BatchRunner:
+    """
+    Headless version of the main_loop pipeline: rewrite -> generate -> edit chain
+    -> evaluate for many sequences at once. Remote stages of all sequences share
+    one AsyncEngine; evaluation runs on a single model thread, so one sequence is
+    scored while others are still waiting on DashScope.
+    """
+    def __init__(self, engine, manifest_path, evaluate=True, num_distractors=3, max_sequences=16,
+                 reuse_index=None, reuse_threshold=0.97, load_evaluators=None):
+        self.engine = engine
+        self.manifest_path = manifest_path
+        self.evaluate = evaluate
+        self.num_distractors = num_distractors
+        self.max_sequences = max_sequences
+        self.manifest_lock = threading.Lock()
+        self.eval_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval")
+        self.evaluators = None
+        # optional embedding_index.GenerationIndex; near-identical earlier steps are copied, not regenerated
+        self.reuse_index = reuse_index
+        self.reuse_threshold = reuse_threshold
+        # optional callable returning (DinoEval, CLIPEvaluator), e.g. resident models in pipeline_service
+        self.load_evaluators = load_evaluators
+
+    def _load_evaluators(self):
+        if self.load_evaluators is not None:
+            return self.load_evaluators()
+        from dino_eval import DinoEval
+        from clip_eval import CLIPEvaluator
+        return DinoEval(), CLIPEvaluator()
+
+    def _write_manifest_row(self, row):
+        with self.manifest_lock:
+            with open(self.manifest_path, "a") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    async def _accept(self, spec, prev_image, prev_prompt, image, prompt):
+        if spec["auto_accept"] != "vlm" or prev_image is None:
+            return True, None
+        from vlm_analyzer import parse_consistency
+
+        verdict = await self.engine.check_image_consistency(prev_image, prev_prompt, image, prompt, verbose=False)
+        return parse_consistency(verdict)["passed"], verdict
+
+    async def _make_step(self, spec, step_num, prompt, prev_image, prev_prompt, source_url, source_image=None):
+        """
+        Generate (step 1) or edit (later steps) until accepted or out of attempts.
+        source_image is the file source_url refers to; draft edits send it downscaled.
+        """
+        dest = os.path.join(spec["output_dir"], f"step_{step_num}.png")
+        source_image = source_image or prev_image
+        if self.reuse_index is not None:
+            # looked up by the image this step is edited from, as _index_steps records it
+            reused = await self._reuse_step(prompt, source_image, dest)
+            if reused is not None:
+                return reused
+        verdicts = []
+        candidates = []
+        url = None
+        accepted = False
+        # generations have no smaller size than the full one, so only edits are drafted
+        frame = DraftFrame(dest) if spec["draft"] and step_num > 1 else None
+        for attempt in range(1, spec["max_attempts"] + 1):
+            if spec["num_candidates"] > 1:
+                dino_evaluator, clip_evaluator = await self._get_evaluators()
+                best = await best_of_n(
+                    self.engine, dino_evaluator, clip_evaluator, step_num, prompt, spec["output_dir"],
+                    spec["num_candidates"], prev_image, source_url, self.eval_executor,
+                    draft=frame is not None, source_image=source_image
+                )
+                url = best["url"] if best else None
+                if best:
+                    candidates.append(best["candidates"])
+                    if frame is not None:
+                        frame.edit(source_image, prompt, best["seed"])
+            elif step_num == 1:
+                url = await self.engine.generate_image(prompt, dest)
+            elif frame is not None:
+                seed = new_seed()
+                url = await self.engine.edit_image(source_image, prompt, dest, None, seed=seed, draft=True)
+                frame.edit(source_image, prompt, seed)
+            else:
+                url = await self.engine.edit_image(source_image, prompt, dest, source_url)
+            if url is None:
+                continue
+            accepted, verdict = await self._accept(spec, prev_image, prev_prompt, dest, prompt)
+            verdicts.append(verdict)
+            if accepted:
+                break
+        if url is None:
+            raise RuntimeError(f"step {step_num} failed after {spec['max_attempts']} attempts")
+        step = {"image": dest, "url": url, "attempts": attempt, "accepted": accepted, "verdicts": verdicts}
+        if frame is not None:
+            # the gate judged the draft; the next step and the evaluation use the full-size render
+            step["url"] = await frame.promote_async(self.engine)
+            if step["url"] is None:
+                raise RuntimeError(f"step {step_num}: full-resolution render of the accepted draft failed")
+            step["seed"] = frame.ops[-1][2]
+        if candidates:
+            step["candidates"] = candidates
+        return step
+
+    async def _reuse_step(self, prompt, source_image, dest):
+        from payload_cache import remote_urls
+
+        await self._get_evaluators()
+        loop = asyncio.get_running_loop()
+        hit = await loop.run_in_executor(
+            self.eval_executor, contextvars.copy_context().run,
+            self.reuse_index.find_reuse, prompt, source_image, self.reuse_threshold
+        )
+        if hit is None:
+            return None
+        image_writer.wait_written(hit["path"])
+        shutil.copyfile(hit["path"], dest)
+        url = hit.get("url") if hit.get("url") and remote_urls.is_valid(hit["url"]) else None
+        return {"image": dest, "url": url, "attempts": 0, "accepted": True, "verdicts": [],
+                "reused_from": hit["path"], "reuse_score": hit["score"]}
+
+    def _index_steps(self, spec, steps, prompts):
+        from embedding_index import edit_sources
+
+        image_paths = [s["image"] for s in steps]
+        # reused steps are skipped by content hash
+        self.reuse_index.add(image_paths, prompts, edit_sources(image_paths, spec["edit_from"]),
+                             [s["url"] for s in steps], goal=spec["goal"], sequence=spec["id"])
+
+    async def run_sequence(self, spec, all_goals, progress=None):
+        """
+        Run one spec end to end and append its manifest row. progress, if given, is
+        called with an event dict after rewriting, after each step and after evaluation.
+        """
+        progress = progress or (lambda event: None)
+        # each sequence runs in its own task, so this only tags this sequence's spans
+        tracing.set_context(sequence=spec["id"])
+        os.makedirs(spec["output_dir"], exist_ok=True)
+        row = {"id": spec["id"], "goal": spec["goal"], "output_dir": spec["output_dir"], "status": "ok"}
+        timings = {}
+        prompts = []
+        steps = []
+        try:
+            start = time.perf_counter()
+            for i, prompt in enumerate(spec["prompts"]):
+                if spec["rewrite"] == "all" or (spec["rewrite"] == "first" and i == 0):
+                    prompt = await self.engine.rewrite_prompt(prompt)
+                prompts.append(prompt)
+            timings["rewrite"] = time.perf_counter() - start
+            progress({"event": "rewritten", "prompts": prompts})
+
+            start = time.perf_counter()
+            first_url = None
+            for step_num, prompt in enumerate(prompts, 1):
+                prev = steps[-1] if steps else None
+                tracing.set_context(step=step_num)
+                source_url = first_url if spec["edit_from"] == "first" else (prev["url"] if prev else None)
+                source_image = steps[0]["image"] if spec["edit_from"] == "first" and steps else None
+                step = await self._make_step(
+                    spec, step_num, prompt,
+                    prev["image"] if prev else None, prompts[step_num - 2] if prev else None,
+                    source_url, source_image
+                )
+                steps.append(step)
+                progress(dict(step, event="step", step=step_num, of=len(prompts)))
+                if first_url is None:
+                    first_url = step["url"]
+            timings["generate"] = time.perf_counter() - start
+            # evaluation, indexing and the manifest row all refer to the written files
+            await asyncio.get_running_loop().run_in_executor(
+                None, image_writer.wait_written, *[s["image"] for s in steps]
+            )
+
+            with open(os.path.join(spec["output_dir"], "prompts.json"), "w") as f:
+                json.dump({"goal": spec["goal"], "prompts": prompts}, f, ensure_ascii=False, indent=2)
+
+            if self.evaluate:
+                start = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                tracing.set_context(step=None)
+                row["metrics"] = await loop.run_in_executor(
+                    self.eval_executor, contextvars.copy_context().run, self._evaluate, [s["image"] for s in steps], prompts, spec["goal"], all_goals
+                )
+                timings["evaluate"] = time.perf_counter() - start
+                progress({"event": "metrics", "metrics": row["metrics"]})
+
+            if self.reuse_index is not None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    self.eval_executor, contextvars.copy_context().run, self._index_steps, spec, steps, prompts
+                )
+        except Exception as e:
+            row["status"] = "failed"
+            row["error"] = f"{type(e).__name__}: {e}"
+            print(f"[{spec['id']}] failed: {row['error']}")
+
+        row["prompts"] = prompts
+        row["steps"] = steps
+        row["timings"] = timings
+        self._write_manifest_row(row)
+        return row
+
+    def _evaluate(self, image_paths, prompts, goal, all_goals):
+        from PIL import Image
+        from eval_report import evaluate_sequence
+
+        if self.evaluators is None:
+            self.evaluators = self._load_evaluators()
+        dino_evaluator, clip_evaluator = self.evaluators
+        images = [Image.open(path).convert("RGB") for path in image_paths]
+        return evaluate_sequence(dino_evaluator, clip_evaluator, images, prompts, goal, all_goals, self.num_distractors)
+
+    async def run(self, specs):
+        all_goals = sorted({spec["goal"] for spec in specs})
+        if self.evaluate or self.reuse_index is not None or any(spec["num_candidates"] > 1 for spec in specs):
+            # warm the models up while the first remote calls are in flight
+            self.eval_executor.submit(self._warm_up)
+        limit = asyncio.Semaphore(self.max_sequences)
+
+        async def bounded(spec):
+            async with limit:
+                return await self.run_sequence(spec, all_goals)
+
+        start = time.perf_counter()
+        rows = await asyncio.gather(*[bounded(spec) for spec in specs])
+        elapsed = time.perf_counter() - start
+        done = sum(1 for row in rows if row["status"] == "ok")
+        print(f"{done}/{len(rows)} sequences finished in {elapsed:.1f}s "
+              f"({60 * done / elapsed if elapsed else 0.0:.2f} sequences/minute)")
+        return rows
+
+    def _warm_up(self):
+        if self.evaluators is None:
+            self.evaluators = self._load_evaluators()
+            if self.reuse_index is not None:
+                self.reuse_index.dino_evaluator, self.reuse_index.clip_evaluator = self.evaluators
+
+    async def _get_evaluators(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.eval_executor, self._warm_up)
+        return self.evaluators
+
+    def close(self):
+        self.eval_executor.shutdown(wait=True)
+        self.engine.close()
+
+
+def run_on_service(url, specs, manifest_path, max_sequences=16):
+    """
+    Thin-client mode: submit every spec as a "sequence" job to a running
+    pipeline_service, print its progress events and append the returned rows to
+    the local manifest. The service shares this host's filesystem.
+    """
+    from pipeline_service import ServiceClient, ServiceError
+
+    client = ServiceClient(url)
+    all_goals = sorted({spec["goal"] for spec in specs})
+    job_ids = []
+    for spec in specs:
+        spec = dict(spec, output_dir=os.path.abspath(spec["output_dir"]))
+        job_ids.append(client.submit("sequence", {"spec": spec, "all_goals": all_goals}))
+    lock = threading.Lock()
+
+    def follow(spec, job_id):
+        def on_event(event):
+            if event["event"] == "step":
+                print(f"[{spec['id']}] step {event['step']}/{event['of']} done")
+            elif event["event"] == "metrics":
+                print(f"[{spec['id']}] evaluated")
+        try:
+            row = client.wait(job_id, on_event)
+        except ServiceError as e:
+            row = {"id": spec["id"], "goal": spec["goal"], "output_dir": spec["output_dir"],
+                   "status": "failed", "error": str(e)}
+            print(f"[{spec['id']}] failed: {row['error']}")
+        with lock:
+            with open(manifest_path, "a") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        return row
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_sequences) as pool:
+        rows = list(pool.map(follow, specs, job_ids))
+    elapsed = time.perf_counter() - start
+    done = sum(1 for row in rows if row["status"] == "ok")
+    print(f"{done}/{len(rows)} sequences finished in {elapsed:.1f}s "
+          f"({60 * done / elapsed if elapsed else 0.0:.2f} sequences/minute)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many image sequences headlessly from a JSONL spec file.")
+    parser.add_argument("specs", help="JSONL file with one sequence spec per line")
+    parser.add_argument("--manifest", default="manifest.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=8, help="max DashScope calls in flight")
+    parser.add_argument("--rate", type=float, default=2.0, help="initial DashScope calls per second")
+    parser.add_argument("--max-sequences", type=int, default=16, help="max sequences in flight")
+    parser.add_argument("--num-distractors", type=int, default=3, help="distractor goals for goal faithfulness")
+    parser.add_argument("--no-eval", action="store_true", help="skip DINO/CLIP evaluation")
+    parser.add_argument("--response-cache", default=DEFAULT_CACHE_PATH, help="rewrite/VLM response cache file")
+    parser.add_argument("--bypass-cache", action="store_true",
+                        help="ignore cached rewrite/VLM responses (fresh ones are still stored)")
+    parser.add_argument("--reuse-index", help="embedding index dir; steps whose prompt (and source image) "
+                                              "nearly match an indexed generation are copied instead of regenerated")
+    parser.add_argument("--reuse-threshold", type=float, default=0.97,
+                        help="min CLIP prompt similarity for --reuse-index")
+    parser.add_argument("--draft", action="store_true",
+                        help="draft edits at low resolution and render only accepted steps at full size "
+                             "(pays off with auto_accept: vlm or num_candidates > 1)")
+    image_writer.add_arguments(parser)
+    parser.add_argument("--service", help="submit the specs to a running pipeline_service at this URL "
+                                          "instead of running them here")
+    parser.add_argument("--trace", help="append per-stage spans to this JSONL file")
+    parser.add_argument("--metrics", help="write a Prometheus text snapshot of stage timings here at exit")
+    args = parser.parse_args()
+    specs = load_specs(args.specs)
+    if args.draft:
+        for spec in specs:
+            spec["draft"] = True
+    if args.service:
+        run_on_service(args.service, specs, args.manifest, args.max_sequences)
+        return
+    if args.trace or args.metrics:
+        tracing.configure(args.trace, args.metrics)
+    image_writer.configure_from_args(args)
+
+    from prompt_rewriter import prompt_rewriter
+    from vlm_analyzer import vlm_analyzer
+
+    response_cache = ResponseCache(args.response_cache, bypass=args.bypass_cache)
+    engine = AsyncEngine(rewriter=prompt_rewriter(cache=response_cache), vlm=vlm_analyzer(cache=response_cache),
+                         max_concurrency=args.concurrency, rate=args.rate)
+    reuse_index = None
+    if args.reuse_index:
+        from embedding_index import GenerationIndex
+        reuse_index = GenerationIndex(args.reuse_index)
+    runner = BatchRunner(engine, args.manifest, evaluate=not args.no_eval,
+                         num_distractors=args.num_distractors, max_sequences=args.max_sequences,
+                         reuse_index=reuse_index, reuse_threshold=args.reuse_threshold)
+    try:
+        asyncio.run(runner.run(specs))
+    finally:
+        runner.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import builtins
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from mock_dashscope import MockConfig, MockDashScope
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class StageTimer:
+    """Collects wall-clock durations per pipeline stage by wrapping client methods."""
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+
+    def wrap(self, obj, method_name, stage):
+        method = getattr(obj, method_name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        setattr(obj, method_name, timed)
+
+    def summary(self):
+        return {
+            stage: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "mean": sum(values) / len(values),
+            }
+            for stage, values in sorted(self.durations.items())
+        }
+
+
+def make_clients(timer):
+    from image_gen import image_generator
+    from image_edit import image_editor
+    from prompt_rewriter import prompt_rewriter
+    from vlm_analyzer import vlm_analyzer
+    from downloader import get_downloader
+
+    generator = image_generator()
+    editor = image_editor()
+    rewriter = prompt_rewriter()
+    vlm = vlm_analyzer()
+    timer.wrap(generator, "generate_image", "generate")
+    timer.wrap(editor, "edit_image", "edit")
+    timer.wrap(rewriter, "rewrite_prompt", "rewrite")
+    timer.wrap(vlm, "check_image_consistency", "vlm_check")
+    timer.wrap(get_downloader(), "fetch_image", "download")
+    return generator, editor, rewriter, vlm
+
+
+def bench_batch(timer, work_dir, num_sequences, num_steps, concurrency, evaluate, auto_accept):
+    """Drive batch_runner end to end; returns sequences/minute."""
+    from async_engine import AsyncEngine
+    from batch_runner import BatchRunner, load_specs
+
+    generator, editor, rewriter, vlm = make_clients(timer)
+    spec_path = os.path.join(work_dir, "specs.jsonl")
+    with open(spec_path, "w") as f:
+        for i in range(num_sequences):
+            f.write(json.dumps({
+                "id": f"bench_{i}",
+                "goal": f"benchmark goal {i}",
+                "prompts": [f"sequence {i} step {s}" for s in range(1, num_steps + 1)],
+                "output_dir": os.path.join(work_dir, f"bench_{i}"),
+                "auto_accept": auto_accept,
+            }) + "\n")
+
+    engine = AsyncEngine(generator, editor, rewriter, vlm, max_concurrency=concurrency, rate=1000.0)
+    runner = BatchRunner(engine, os.path.join(work_dir, "manifest.jsonl"), evaluate=evaluate,
+                         max_sequences=num_sequences)
+    start = time.perf_counter()
+    try:
+        rows = asyncio.run(runner.run(load_specs(spec_path)))
+    finally:
+        runner.close()
+    elapsed = time.perf_counter() - start
+    for row in rows:
+        for stage, seconds in row.get("timings", {}).items():
+            timer.record(f"sequence_{stage}", seconds)
+    done = sum(1 for row in rows if row["status"] == "ok")
+    return 60.0 * done / elapsed if elapsed else 0.0
+
+
+def bench_main_loop(timer, work_dir, num_steps):
+    """Drive the interactive main_loop flow with scripted answers; returns sequences/minute."""
+    import main_loop
+    from PIL import Image
+
+    answers = [os.path.join(work_dir, "interactive"), str(num_steps), "benchmark goal", "first step", "y", "y"]
+    for step in range(2, num_steps + 1):
+        answers += [f"step {step}", "y", "y"]
+    answers = iter(answers)
+
+    original_input, original_show = builtins.input, Image.Image.show
+    original_classes = (main_loop.image_generator, main_loop.image_editor,
+                        main_loop.prompt_rewriter, main_loop.vlm_analyzer)
+    generator, editor, rewriter, vlm = make_clients(timer)
+    builtins.input = lambda prompt="": next(answers)
+    Image.Image.show = lambda self, *args, **kwargs: None
+    main_loop.image_generator = lambda: generator
+    main_loop.image_editor = lambda: editor
+    main_loop.prompt_rewriter = lambda: rewriter
+    main_loop.vlm_analyzer = lambda: vlm
+    start = time.perf_counter()
+    try:
+        main_loop.main()
+    finally:
+        builtins.input, Image.Image.show = original_input, original_show
+        (main_loop.image_generator, main_loop.image_editor,
+         main_loop.prompt_rewriter, main_loop.vlm_analyzer) = original_classes
+    elapsed = time.perf_counter() - start
+    timer.record("sequence_interactive", elapsed)
+    return 60.0 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against a local DashScope stand-in")
+    parser.add_argument("--scenario", choices=["batch", "main_loop"], default="batch")
+    parser.add_argument("--sequences", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--auto-accept", choices=["always", "vlm"], default="always")
+    parser.add_argument("--eval", action="store_true", help="include DINO/CLIP evaluation (loads the models)")
+    parser.add_argument("--text-latency", type=float, default=1.0)
+    parser.add_argument("--generate-latency", type=float, default=8.0)
+    parser.add_argument("--edit-latency", type=float, default=6.0)
+    parser.add_argument("--vlm-latency", type=float, default=3.0)
+    parser.add_argument("--download-latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="mock requests/second, 0 = unlimited")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    config = MockConfig(args.text_latency, args.generate_latency, args.edit_latency, args.vlm_latency,
+                        args.download_latency, 0.2, args.error_rate, args.rate_limit)
+    mock = MockDashScope(config).start()
+    os.environ["DASHSCOPE_BASE_URL"] = mock.base_url
+    os.environ.setdefault("ALIBABA_API_KEY", "mock-key")
+
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            if args.scenario == "batch":
+                throughput = bench_batch(timer, work_dir, args.sequences, args.steps, args.concurrency,
+                                         args.eval, args.auto_accept)
+            else:
+                throughput = bench_main_loop(timer, work_dir, args.steps)
+    finally:
+        mock.stop()
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {
+        "scenario": args.scenario,
+        "sequences_per_minute": throughput,
+        "peak_python_memory_mb": peak_traced / 2 ** 20,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "mock": mock.stats,
+        "stages": timer.summary(),
+    }
+
+    print(f"\n{'stage':<22}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}")
+    for stage, stats in results["stages"].items():
+        print(f"{stage:<22}{stats['count']:>7}{stats['p50']:>10.3f}{stats['p95']:>10.3f}")
+    print(f"\nsequences/minute: {throughput:.2f}")
+    print(f"peak python memory: {results['peak_python_memory_mb']:.1f} MB, peak RSS: {results['peak_rss_mb']:.1f} MB")
+    print(f"mock requests: {mock.stats}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
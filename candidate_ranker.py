@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+
+from PIL import Image
+
+from draft import new_seed
+from image_writer import wait_written
+
+
+def score_candidates(dino_evaluator, clip_evaluator, candidates, prompt, prev_image=None):
+    """
+    Score candidate images for one step.
+
+    Args:
+        dino_evaluator: DinoEval instance
+        clip_evaluator: CLIPEvaluator instance
+        candidates: List of PIL Images generated for the step
+        prompt: The step prompt the candidates were generated from
+        prev_image: PIL Image of the previous frame, None for the first step
+
+    Returns:
+        List of dicts with dino (similarity to previous frame), clip_t and score.
+        The score is DINO-sim * CLIP-T, or CLIP-T alone for the first step.
+    """
+    clip_image_features = clip_evaluator.extract_clip_image_features(candidates)
+    clip_text_features = clip_evaluator.extract_clip_text_features([prompt])
+    clip_t = (clip_image_features @ clip_text_features.T).squeeze(1).tolist()
+
+    if prev_image is not None:
+        dino_features = dino_evaluator.extract_dino_features([prev_image] + list(candidates))
+        dino_sim = (dino_features[1:] @ dino_features[0]).tolist()
+    else:
+        dino_sim = [None] * len(candidates)
+
+    scores = []
+    for d, t in zip(dino_sim, clip_t):
+        scores.append({"dino": d, "clip_t": t, "score": t if d is None else d * t})
+    return scores
+
+
+async def best_of_n(engine, dino_evaluator, clip_evaluator, step_num, prompt, output_dir, n,
+                    prev_image_path=None, source_url=None, eval_executor=None, draft=False, source_image=None):
+    """
+    Issue n generate (step 1) or edit requests for a step concurrently, rank the
+    candidates with score_candidates and copy the winner to <output_dir>/step_N.png.
+    All candidates are kept under <output_dir>/candidates/ for review. Every
+    candidate gets its own seed. Edits are of source_url, with source_image
+    (default prev_image_path) as its local file when the URL has expired; with
+    draft, they are low-resolution previews of source_image that the caller
+    promotes with the winner's seed (see draft.DraftFrame).
+
+    Returns:
+        dict with image, url, seed, selected (candidate index) and candidates, or
+        None if every request failed
+    """
+    candidate_dir = os.path.join(output_dir, "candidates")
+    os.makedirs(candidate_dir, exist_ok=True)
+    paths = [os.path.join(candidate_dir, f"step_{step_num}_cand_{i + 1}.png") for i in range(n)]
+
+    seeds = [new_seed() for _ in paths]
+    if prev_image_path is None:
+        calls = [engine.generate_image(prompt, path, seed=seed) for path, seed in zip(paths, seeds)]
+    elif draft:
+        calls = [engine.edit_image(source_image or prev_image_path, prompt, path, None, seed=seed, draft=True)
+                 for path, seed in zip(paths, seeds)]
+    else:
+        calls = [engine.edit_image(source_image or prev_image_path, prompt, path, source_url, seed=seed)
+                 for path, seed in zip(paths, seeds)]
+    urls = await asyncio.gather(*calls, return_exceptions=True)
+    loop = asyncio.get_running_loop()
+    # the downloads are written in the background; ranking and the copy below read the files
+    await loop.run_in_executor(None, wait_written, *paths)
+
+    candidates = [
+        {"path": path, "url": url, "seed": seed}
+        for path, url, seed in zip(paths, urls, seeds)
+        if isinstance(url, str) and os.path.exists(path)
+    ]
+    if not candidates:
+        return None
+
+    def rank():
+        images = [Image.open(c["path"]).convert("RGB") for c in candidates]
+        prev_image = Image.open(prev_image_path).convert("RGB") if prev_image_path is not None else None
+        return score_candidates(dino_evaluator, clip_evaluator, images, prompt, prev_image)
+
+    scores = await loop.run_in_executor(eval_executor, rank)
+    for candidate, score in zip(candidates, scores):
+        candidate.update(score)
+
+    selected = max(range(len(candidates)), key=lambda i: candidates[i]["score"])
+    dest = os.path.join(output_dir, f"step_{step_num}.png")
+    shutil.copyfile(candidates[selected]["path"], dest)
+    print(f"step {step_num}: selected candidate {selected + 1}/{len(candidates)} "
+          f"(score {candidates[selected]['score']:.4f})")
+
+    return {
+        "image": dest,
+        "url": candidates[selected]["url"],
+        "seed": candidates[selected]["seed"],
+        "selected": selected,
+        "candidates": candidates,
+    }
@@ -5,29 +5,102 @@ from PIL import Image
 import torch
 import torch.nn.functional as F
 import random
+from embedding_cache import image_key, text_key
+from tracing import traced, current_span
+from model_snapshot import default_snapshot_dir, has_snapshot, load_clip_snapshot
+from accel import AccelConfig, apply_accel, inference_context
+from autotune import load_tuning, apply_threads, run_chunked
 
 class CLIPEvaluator:
-    def __init__(self, model_name="openai/clip-vit-base-patch32"):
-        self.clip_model = CLIPModel.from_pretrained(model_name)
-        self.clip_processor = CLIPProcessor.from_pretrained(model_name)
+    @traced("model_load")
+    def __init__(self, model_name="openai/clip-vit-base-patch32", cache=None, snapshot_dir=None, accel=None,
+                 batch_size=None, num_threads=None):
+        current_span().set(model=model_name)
+        # prefer an offline snapshot (see model_snapshot.py) over the hub
+        snapshot_dir = snapshot_dir or default_snapshot_dir()
+        if has_snapshot(snapshot_dir, model_name):
+            self.clip_model, self.clip_processor = load_clip_snapshot(snapshot_dir, model_name)
+        else:
+            self.clip_model = CLIPModel.from_pretrained(model_name)
+            self.clip_processor = CLIPProcessor.from_pretrained(model_name)
         self.clip_model.eval()
         self.device = 'cpu'
+        self.model_name = model_name
+        # optional CPU acceleration, e.g. accel="int8+compile" (see accel.py)
+        self.accel = AccelConfig.parse(accel)
+        self.clip_model = apply_accel(self.clip_model, self.accel, self.device,
+                                      compile_attrs=["vision_model", "text_model"])
+        # optional EmbeddingCache; the namespaces pin model and preprocessing
+        self.cache = cache
+        self.image_cache_namespace = f"{model_name}|image|{self.clip_processor.image_processor.to_json_string()}"
+        self.text_cache_namespace = f"{model_name}|text|max_length={self.clip_processor.tokenizer.model_max_length}"
+        if self.accel is not None:
+            self.image_cache_namespace += f"|accel={self.accel.tag}"
+            self.text_cache_namespace += f"|accel={self.accel.tag}"
+        # batch_size=None uses this host's autotuned config (python autotune.py tune), 0 disables chunking
+        # num_threads: intra-op threads the caller pinned, which the tuned count must not override
+        if batch_size is None:
+            tuning = load_tuning("clip")
+            if tuning:
+                apply_threads(tuning, num_threads)
+                batch_size = tuning["batch_size"]
+        self.batch_size = batch_size
 
     def extract_clip_image_features(self, images):
+        if self.cache is not None:
+            features = self.cache.get_or_compute(
+                self.image_cache_namespace, [image_key(img) for img in images], images,
+                self._extract_clip_image_features
+            )
+            return torch.from_numpy(features).to(self.device)
+        return self._extract_clip_image_features(images)
+
+    @traced("feature_extraction")
+    def _extract_clip_image_features(self, images):
+        current_span().set(model=self.model_name, images=len(images), batch_size=self.batch_size)
+        return run_chunked(self._clip_image_forward, images, self.batch_size)
+
+    @traced("feature_extraction")
+    def extract_clip_image_features_from_pixels(self, pixel_values):
+        """
+        Image features from already preprocessed pixel_values (see image_pipeline.SharedPreprocessor)
+        """
+        current_span().set(model=self.model_name, images=len(pixel_values), batch_size=self.batch_size)
+        return run_chunked(self._clip_pixel_forward, pixel_values, self.batch_size)
+
+    def _clip_image_forward(self, images):
         inputs = self.clip_processor(
             images=images,
             return_tensors="pt",
             padding=True
-        ).to(self.device)
+        )
+        
+        return self._clip_pixel_forward(inputs["pixel_values"])
+
+    def _clip_pixel_forward(self, pixel_values):
+        pixel_values = pixel_values.to(self.device)
+        if self.accel is not None and self.accel.channels_last:
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
         
-        with torch.no_grad():
-            image_features = self.clip_model.get_image_features(**inputs)
+        with inference_context(self.accel):
+            image_features = self.clip_model.get_image_features(pixel_values=pixel_values)
 
-            image_features = F.normalize(image_features, p=2, dim=1)
+            image_features = F.normalize(image_features.float(), p=2, dim=1)
         
         return image_features
     
     def extract_clip_text_features(self, texts):
+        if self.cache is not None:
+            features = self.cache.get_or_compute(
+                self.text_cache_namespace, [text_key(t) for t in texts], texts,
+                self._extract_clip_text_features
+            )
+            return torch.from_numpy(features).to(self.device)
+        return self._extract_clip_text_features(texts)
+
+    @traced("feature_extraction")
+    def _extract_clip_text_features(self, texts):
+        current_span().set(model=self.model_name, texts=len(texts))
         inputs = self.clip_processor(
             text=texts,
             return_tensors="pt",
@@ -35,9 +108,9 @@ class CLIPEvaluator:
             truncation=True
         ).to(self.device)
         
-        with torch.no_grad():
+        with inference_context(self.accel):
             text_features = self.clip_model.get_text_features(**inputs)
-            text_features = F.normalize(text_features, p=2, dim=1)
+            text_features = F.normalize(text_features.float(), p=2, dim=1)
         
         return text_features
     
@@ -50,15 +123,18 @@ class CLIPEvaluator:
         
         clip_features = self.extract_clip_image_features(images)
         
+        return self.clip_i_from_features(clip_features)
+    
+    def clip_i_from_features(self, clip_features):
+        """
+        CLIP-I from already extracted, normalized image features
+        """
+        if len(clip_features) < 2:
+            return 0.0
       
-        similarities = []
-        for i in range(len(images) - 1):
-            sim = (clip_features[i] * clip_features[i + 1]).sum().item()
-            similarities.append(sim)
-        
-        avg_similarity = np.mean(similarities)
+        similarities = (clip_features[:-1] * clip_features[1:]).sum(dim=1)
         
-        return avg_similarity
+        return similarities.mean().item()
     
     def compute_clip_t(self, images, 
                        texts):
@@ -72,29 +148,35 @@ class CLIPEvaluator:
         clip_image_features = self.extract_clip_image_features(images)
         clip_text_features = self.extract_clip_text_features(texts)
         
+        return self.clip_t_from_features(clip_image_features, clip_text_features)
+    
+    def clip_t_from_features(self, clip_image_features, clip_text_features):
+        """
+        CLIP-T from already extracted, normalized image and text features
+        """
+        if len(clip_image_features) != len(clip_text_features):
+            raise ValueError("Number of images must match number of texts")
+        if len(clip_image_features) == 0:
+            return np.nan
       
-        alignments = []
-        for i in range(len(images)):
-           
-            cumulative_text = clip_text_features[:i+1].mean(dim=0, keepdim=True)
-            cumulative_text = F.normalize(cumulative_text, p=2, dim=1)
-            
-         
-            sim = (clip_image_features[i:i+1] * cumulative_text).sum().item()
-            alignments.append(sim)
-        
-        avg_alignment = np.mean(alignments)
-        
-        return avg_alignment
+        # running mean of the texts up to each step; normalizing makes the 1/(i+1) factor irrelevant
+        cumulative_text = F.normalize(clip_text_features.cumsum(dim=0), p=2, dim=1)
+        alignments = (clip_image_features * cumulative_text).sum(dim=1)
+        
+        return alignments.mean().item()
     
     def compute_clip_star(self, images, 
                           texts):
         """
         CLIP*: Product of CLIP-I and CLIP-T
         """
+        if len(images) != len(texts):
+            raise ValueError("Number of images must match number of texts")
        
-        clip_i = self.compute_clip_i(images)
-        clip_t = self.compute_clip_t(images, texts)
+        clip_image_features = self.extract_clip_image_features(images)
+        clip_text_features = self.extract_clip_text_features(texts)
+        clip_i = self.clip_i_from_features(clip_image_features)
+        clip_t = self.clip_t_from_features(clip_image_features, clip_text_features)
         print("clip i, t", clip_i, clip_t)
         return clip_i * clip_t
     
@@ -119,36 +201,28 @@ class CLIPEvaluator:
         
         image_features = self.extract_clip_image_features(images)
         
-        correct_count = 0
-        total_count = 0
-        
-        for img_feat in image_features:
-            
-            available_distractors = [g for g in all_goal_texts if g != goal_text]
-            
-            if len(available_distractors) < num_distractors:
-              
-                continue
-            
-            distractors = random.sample(available_distractors, num_distractors)
-            
-          
-            candidates = [goal_text] + distractors
-            
-        
-            text_features = self.extract_clip_text_features(candidates)
-            
-            
-            similarities = (img_feat.unsqueeze(0) @ text_features.T).squeeze(0)
-            
-           
-            predicted_idx = similarities.argmax().item()
-            if predicted_idx == 0:
-                correct_count += 1
-            total_count += 1
-        
-        accuracy = correct_count / total_count if total_count > 0 else 0.0
-        return accuracy
+        return self.goal_faithfulness_from_features(image_features, goal_text, all_goal_texts, num_distractors)
+
+    def goal_faithfulness_from_features(self, image_features, goal_text, all_goal_texts, num_distractors=3):
+        """
+        Goal Faithfulness from already extracted, normalized image features
+        """
+        available_distractors = [g for g in all_goal_texts if g != goal_text]
+        if len(image_features) == 0 or len(available_distractors) < num_distractors:
+            return 0.0
+
+        # draw every image's distractors first, then encode only the goals that were drawn,
+        # so the text pass stays O(images * num_distractors) however large the goal pool is
+        drawn = [random.sample(range(len(available_distractors)), num_distractors) for _ in range(len(image_features))]
+        used = sorted({i for picks in drawn for i in picks})
+        position = {i: 1 + j for j, i in enumerate(used)}
+        goal_features = self.extract_clip_text_features([goal_text] + [available_distractors[i] for i in used])
+        candidate_idx = torch.tensor([[0] + [position[i] for i in picks] for picks in drawn])
+        
+        # (images, candidates) similarities; the correct goal is candidate 0
+        similarities = torch.einsum("nd,nkd->nk", image_features, goal_features[candidate_idx])
+        
+        return (similarities.argmax(dim=1) == 0).float().mean().item()
 
     def compute_step_faithfulness(self, images, step_texts, goal_text):
         """
@@ -178,20 +252,19 @@ class CLIPEvaluator:
      
         text_features = self.extract_clip_text_features(conditioned_steps)
         
-        correct_count = 0
-        total_count = 0
-        
-        for step_idx, img_feat in enumerate(image_features):
-           
-            similarities = (img_feat.unsqueeze(0) @ text_features.T).squeeze(0)
-            
-           
-            predicted_idx = similarities.argmax().item()
-            if predicted_idx == step_idx:
-                correct_count += 1
-            total_count += 1
-        
-        accuracy = correct_count / total_count if total_count > 0 else 0.0
-        return accuracy
+        return self.step_faithfulness_from_features(image_features, text_features)
+
+    def step_faithfulness_from_features(self, image_features, conditioned_step_features):
+        """
+        Step Faithfulness from already extracted, normalized image features and
+        features of the goal-conditioned step texts ("<goal>. <step>")
+        """
+        if len(image_features) != len(conditioned_step_features) or len(image_features) == 0:
+            return 0.0
+
+        similarities = image_features @ conditioned_step_features.T
+        predicted_idx = similarities.argmax(dim=1)
+        
+        return (predicted_idx == torch.arange(len(image_features))).float().mean().item()
     
 
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import json
+import threading
+
+from vlm_analyzer import parse_consistency
+
+
+def consecutive_pairs(num_images, window=1):
+    """(i, j) index pairs of images at most window steps apart, in step order."""
+    return [(i, j) for j in range(num_images) for i in range(max(0, j - window), j)]
+
+
+async def check_pair(engine, image_paths, prompts, i, j, bypass_cache=False):
+    result = {"pair": [i + 1, j + 1]}
+    try:
+        text = await engine.check_image_consistency(image_paths[i], prompts[i], image_paths[j], prompts[j],
+                                                    bypass_cache=bypass_cache, verbose=False)
+        result.update(parse_consistency(text))
+    except Exception as e:
+        result.update({"verdict": None, "passed": False, "error": f"{type(e).__name__}: {e}"})
+    return result
+
+
+async def check_sequence(engine, image_paths, prompts, window=1, bypass_cache=False):
+    """
+    Check every pair of images up to window steps apart concurrently (under the
+    engine's rate limits). Each image is uploaded once and shared by all its pairs.
+
+    Returns:
+        list of structured results (see vlm_analyzer.parse_consistency) with the
+        1-based step numbers of each pair under "pair"
+    """
+    if len(image_paths) != len(prompts):
+        raise ValueError("Number of images must match number of prompts")
+    return list(await asyncio.gather(*(
+        check_pair(engine, image_paths, prompts, i, j, bypass_cache)
+        for i, j in consecutive_pairs(len(image_paths), window)
+    )))
+
+
+def format_result(result):
+    step_a, step_b = result["pair"]
+    if result.get("error"):
+        return f"steps {step_a}->{step_b}: check failed ({result['error']})"
+    line = f"steps {step_a}->{step_b}: {result['verdict'] or 'no verdict'}"
+    failed = [str(q) for q, a in sorted(result["answers"].items()) if a["answer"] == "no"]
+    if failed:
+        line += f" (failed question(s) {', '.join(failed)})"
+    return line
+
+
+class BackgroundConsistencyChecker:
+    """
+    Runs VLM checks for the interactive loop on a private event loop thread, so the
+    check of step N runs while the user reviews step N+1. Checking a pair again
+    (after a regenerated image) supersedes the earlier check of that pair.
+    """
+    def __init__(self, vlm, window=1, max_concurrency=4, rate=2.0):
+        from async_engine import AsyncEngine
+
+        self.window = window
+        self.engine = AsyncEngine(vlm=vlm, max_concurrency=max_concurrency, rate=rate)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="vlm-check", daemon=True)
+        self.thread.start()
+        self.futures = {}
+        self.reported = set()
+
+    def submit_step(self, image_paths, prompts):
+        """Queue the checks that end at the newest image (paths/prompts are the sequence so far)."""
+        paths, texts = list(image_paths), list(prompts)
+        j = len(paths) - 1
+        for i in range(max(0, j - self.window), j):
+            future = asyncio.run_coroutine_threadsafe(check_pair(self.engine, paths, texts, i, j), self.loop)
+            self.futures[(i, j)] = future
+            self.reported.discard((i, j))
+
+    def poll(self):
+        """Print checks that finished since the last poll."""
+        for key, future in sorted(self.futures.items()):
+            if key not in self.reported and future.done():
+                self.reported.add(key)
+                print("[VLM check] " + format_result(future.result()))
+
+    def results(self):
+        """Wait for all outstanding checks and return their results in step order."""
+        return [future.result() for _, future in sorted(self.futures.items())]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.engine.close()
+
+
+def main():
+    from async_engine import AsyncEngine
+    from response_cache import ResponseCache
+    from utils import load_sequence
+    from vlm_analyzer import vlm_analyzer
+
+    parser = argparse.ArgumentParser(description="VLM consistency check over the image pairs of a sequence")
+    parser.add_argument("seq_dir", help="sequence directory (step_N.png + prompts.json)")
+    parser.add_argument("--window", type=int, default=1, help="check pairs up to this many steps apart")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2.0, help="requests per second")
+    parser.add_argument("--bypass-cache", action="store_true")
+    parser.add_argument("--out", help="write the structured results as JSON")
+    args = parser.parse_args()
+
+    image_paths, goal, prompts = load_sequence(args.seq_dir)
+    engine = AsyncEngine(vlm=vlm_analyzer(cache=ResponseCache()), max_concurrency=args.concurrency, rate=args.rate)
+    try:
+        results = asyncio.run(check_sequence(engine, image_paths, prompts, args.window, args.bypass_cache))
+    finally:
+        engine.close()
+    for result in results:
+        print(format_result(result))
+    print(f"{sum(r['passed'] for r in results)}/{len(results)} pairs passed")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import time
+
+from utils import find_sequence_dirs, load_sequence
+
+
+def shard_of(sequence, num_shards):
+    """Stable shard assignment, so a sequence lands on the same worker (and cache shard) every run."""
+    return int(hashlib.sha1(sequence.encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def read_finished(results_path, retry_failed=False):
+    """Sequences already in the results file. A torn last line from a killed run is ignored."""
+    finished = set()
+    if not os.path.exists(results_path):
+        return finished
+    with open(results_path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row.get("status") == "ok" or not retry_failed:
+                finished.add(row["sequence"])
+    return finished
+
+
+def collect_goals(root, seq_dirs):
+    """
+    Goal of every sequence dir, for the distractor pool. A dir that cannot be
+    loaded gets a failed result row instead of aborting the run.
+
+    Returns:
+        ({seq_dir: goal} for the loadable dirs, [failed rows])
+    """
+    goals = {}
+    failed = []
+    for seq_dir in seq_dirs:
+        try:
+            goals[seq_dir] = load_sequence(seq_dir)[1]
+        except Exception as e:
+            failed.append({"sequence": os.path.relpath(seq_dir, root), "status": "failed",
+                           "error": f"{type(e).__name__}: {e}", "seconds": 0.0})
+    return goals, failed
+
+
+def evaluate_sequence_dir(dino_evaluator, clip_evaluator, root, seq_dir, all_goals, num_distractors, preprocessor=None):
+    from PIL import Image
+    from eval_report import evaluate_sequence
+
+    sequence = os.path.relpath(seq_dir, root)
+    row = {"sequence": sequence, "status": "ok"}
+    start = time.perf_counter()
+    try:
+        image_paths, goal, prompts = load_sequence(seq_dir)
+        if preprocessor is not None:
+            # decoded on the preprocessor's pool, once for both models
+            images = image_paths
+        else:
+            images = []
+            for path in image_paths:
+                with Image.open(path) as img:
+                    images.append(img.convert("RGB"))
+        # seeded per sequence so distractor sampling is reproducible across runs and shards
+        random.seed(sequence)
+        row["goal"] = goal
+        row.update(evaluate_sequence(dino_evaluator, clip_evaluator, images, prompts, goal, all_goals, num_distractors,
+                                     preprocessor))
+    except Exception as e:
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+
+def _worker(shard, root, seq_dirs, all_goals, options, results):
+    """One resident copy of the models per process, scoring its shard of sequences."""
+    import torch
+    from dino_eval import DinoEval
+    from clip_eval import CLIPEvaluator
+    from embedding_cache import EmbeddingCache
+    from image_pipeline import SharedPreprocessor
+
+    if options["threads_per_worker"]:
+        torch.set_num_threads(options["threads_per_worker"])
+    cache = None
+    if options["cache_dir"]:
+        # the embedding cache is single-writer, so every shard gets its own store
+        cache = EmbeddingCache(os.path.join(options["cache_dir"], f"shard_{shard}_of_{options['workers']}"))
+    # each worker keeps its share of the CPUs rather than the autotuned (whole-host) thread count
+    threads = options["threads_per_worker"] or None
+    dino_evaluator = DinoEval(cache=cache, accel=options["accel"], num_threads=threads)
+    clip_evaluator = CLIPEvaluator(cache=cache, accel=options["accel"], num_threads=threads)
+    preprocessor = None
+    if options["shared_preprocess"]:
+        preprocessor = SharedPreprocessor(dino_evaluator, clip_evaluator, workers=options["threads_per_worker"])
+
+    for seq_dir in seq_dirs:
+        results.put(evaluate_sequence_dir(dino_evaluator, clip_evaluator, root, seq_dir,
+                                          all_goals, options["num_distractors"], preprocessor))
+    results.put(("done", shard))
+
+
+def evaluate_dataset(root, results_path, workers=2, num_distractors=3, cache_dir=None, accel=None,
+                     retry_failed=False, shared_preprocess=True):
+    """
+    Score every sequence under root with a pool of model-resident worker processes,
+    appending one JSON row per sequence to results_path. Sequences already in the
+    results file are skipped, so a killed run resumes where it stopped.
+    """
+    seq_dirs = find_sequence_dirs(root)
+    goals, load_failures = collect_goals(root, seq_dirs)
+    all_goals = sorted(set(goals.values()))
+    finished = read_finished(results_path, retry_failed)
+    load_failures = [row for row in load_failures if row["sequence"] not in finished]
+    pending = [d for d in goals if os.path.relpath(d, root) not in finished]
+    print(f"{len(seq_dirs)} sequences, {len(seq_dirs) - len(pending) - len(load_failures)} already scored, "
+          f"{len(load_failures)} unreadable, {len(pending)} to go")
+    if not pending and not load_failures:
+        return
+
+    # shards follow the configured worker count, so a sequence keeps its cache shard
+    # however many sequences are left to score
+    workers = max(1, workers)
+    shards = [[] for _ in range(workers)]
+    for seq_dir in pending:
+        shards[shard_of(os.path.relpath(seq_dir, root), workers)].append(seq_dir)
+    active = sum(1 for shard_dirs in shards if shard_dirs)
+
+    options = {
+        "workers": workers,
+        "num_distractors": num_distractors,
+        "cache_dir": cache_dir,
+        "accel": accel,
+        "threads_per_worker": max(1, (os.cpu_count() or 1) // max(1, active)),
+        "shared_preprocess": shared_preprocess,
+    }
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = {
+        shard: ctx.Process(target=_worker, args=(shard, root, shard_dirs, all_goals, options, results),
+                           name=f"dataset-eval-{shard}")
+        for shard, shard_dirs in enumerate(shards) if shard_dirs
+    }
+    for process in processes.values():
+        process.start()
+
+    running = set(processes)
+    done = 0
+    start = time.perf_counter()
+    with open(results_path, "a+b") as out:
+        # terminate a torn last line so the next row starts on its own line
+        if out.tell() > 0:
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b"\n":
+                out.write(b"\n")
+        for row in load_failures:
+            print(f"{row['sequence']}: {row['error']}")
+            _append_row(out, row)
+        while running:
+            try:
+                row = results.get(timeout=1.0)
+            except queue.Empty:
+                for shard in list(running):
+                    if not processes[shard].is_alive():
+                        print(f"worker {shard} exited with code {processes[shard].exitcode}; "
+                              f"rerun to resume its remaining sequences")
+                        running.discard(shard)
+                continue
+            if isinstance(row, tuple):
+                running.discard(row[1])
+                continue
+            _append_row(out, row)
+            done += 1
+            if done % 50 == 0 or done == len(pending):
+                rate = done / (time.perf_counter() - start)
+                print(f"{done}/{len(pending)} sequences scored ({rate:.2f}/s)")
+
+    for process in processes.values():
+        process.join()
+
+
+def _append_row(out, row):
+    out.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a directory tree of generated sequences")
+    parser.add_argument("root", help="directory containing sequence dirs (step_N.png + prompts.json)")
+    parser.add_argument("--results", default="results.jsonl", help="append-only JSONL results file")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes, each holding the models")
+    parser.add_argument("--num-distractors", type=int, default=3)
+    parser.add_argument("--cache-dir", help="per-shard embedding caches under this directory")
+    parser.add_argument("--accel", help="evaluator acceleration, e.g. int8 (see accel.py)")
+    parser.add_argument("--retry-failed", action="store_true", help="re-score sequences whose row failed")
+    parser.add_argument("--per-model-preprocess", action="store_true",
+                        help="preprocess with each model's own transforms instead of the shared decode pipeline")
+    args = parser.parse_args()
+
+    evaluate_dataset(args.root, args.results, args.workers, args.num_distractors, args.cache_dir,
+                     args.accel, args.retry_failed, not args.per_model_preprocess)
+
+
+if __name__ == "__main__":
+    main()
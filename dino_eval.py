@@ -3,13 +3,27 @@ from PIL import Image
 from torchvision import transforms
 import torch.nn.functional as F
 import numpy as np
+from embedding_cache import file_key, image_key
+from tracing import traced, current_span
+from model_snapshot import default_snapshot_dir, has_snapshot, load_dino_snapshot
+from accel import AccelConfig, apply_accel, inference_context
+from autotune import load_tuning, apply_threads, run_chunked
 
 class DinoEval:
-    def __init__(self):
+    @traced("model_load", model="dinov2_vitb14")
+    def __init__(self, cache=None, snapshot_dir=None, accel=None, batch_size=None, num_threads=None):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.dino_model = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
+        # prefer an offline snapshot (see model_snapshot.py) over the torch hub
+        snapshot_dir = snapshot_dir or default_snapshot_dir()
+        if has_snapshot(snapshot_dir, 'dinov2_vitb14'):
+            self.dino_model = load_dino_snapshot(snapshot_dir, self.device)
+        else:
+            self.dino_model = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
         self.dino_model = self.dino_model.to(self.device)
         self.dino_model.eval()
+        # optional CPU acceleration, e.g. accel="int8+compile" (see accel.py)
+        self.accel = AccelConfig.parse(accel)
+        self.dino_model = apply_accel(self.dino_model, self.accel, self.device)
         self.preprocess = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
@@ -19,43 +33,102 @@ class DinoEval:
                 std=[0.229, 0.224, 0.225]
             )
         ])
+        # optional EmbeddingCache; the namespace pins model and preprocessing
+        self.cache = cache
+        self.cache_namespace = "dinov2_vitb14|resize=256|crop=224|mean=0.485,0.456,0.406|std=0.229,0.224,0.225"
+        if self.accel is not None:
+            self.cache_namespace += f"|accel={self.accel.tag}"
+        # batch_size=None uses this host's autotuned config (python autotune.py tune), 0 disables chunking
+        # num_threads: intra-op threads the caller pinned, which the tuned count must not override
+        if batch_size is None:
+            tuning = load_tuning("dino")
+            if tuning:
+                apply_threads(tuning, num_threads)
+                batch_size = tuning["batch_size"]
+        self.batch_size = batch_size
 
     def extract_image(self, filepath):
+        if self.cache is not None:
+            features = self.cache.get_or_compute(
+                self.cache_namespace, [file_key(filepath)], [filepath],
+                lambda paths: self._extract_image(paths[0])
+            )
+            return torch.from_numpy(features).to(self.device)
+        return self._extract_image(filepath)
+
+    @traced("feature_extraction", model="dinov2_vitb14", images=1)
+    def _extract_image(self, filepath):
        
 
     
         image = Image.open(filepath).convert('RGB')
         image_tensor = self.preprocess(image).unsqueeze(0).to(self.device)
+        if self.accel is not None and self.accel.channels_last:
+            image_tensor = image_tensor.contiguous(memory_format=torch.channels_last)
 
    
-        with torch.no_grad():
+        with inference_context(self.accel):
             features = self.dino_model(image_tensor)
          
             
 
-        features = torch.nn.functional.normalize(features, p=2, dim=1)
+        features = torch.nn.functional.normalize(features.float(), p=2, dim=1)
 
         return features
     
     def extract_dino_features(self, images):
+        if self.cache is not None:
+            features = self.cache.get_or_compute(
+                self.cache_namespace, [image_key(img) for img in images], images,
+                self._extract_dino_features
+            )
+            return torch.from_numpy(features).to(self.device)
+        return self._extract_dino_features(images)
+
+    @traced("feature_extraction", model="dinov2_vitb14")
+    def _extract_dino_features(self, images):
+        current_span().set(images=len(images), batch_size=self.batch_size)
+        return run_chunked(self._dino_forward, images, self.batch_size)
+
+    @traced("feature_extraction", model="dinov2_vitb14")
+    def extract_dino_features_from_pixels(self, pixel_values):
+        """
+        DINO features from already preprocessed pixel_values (see image_pipeline.SharedPreprocessor)
+        """
+        current_span().set(images=len(pixel_values), batch_size=self.batch_size)
+        return run_chunked(self._dino_pixel_forward, pixel_values, self.batch_size)
+
+    def _dino_forward(self, images):
 
         image_inputs = torch.stack([
             self.preprocess(img) for img in images
-        ]).to(self.device)
+        ])
+        return self._dino_pixel_forward(image_inputs)
 
-        with torch.no_grad():
+    def _dino_pixel_forward(self, image_inputs):
+        image_inputs = image_inputs.to(self.device)
+        if self.accel is not None and self.accel.channels_last:
+            image_inputs = image_inputs.contiguous(memory_format=torch.channels_last)
+
+        with inference_context(self.accel):
             image_features = self.dino_model(image_inputs)
 
-            image_features = F.normalize(image_features, p=2, dim=1)
+            image_features = F.normalize(image_features.float(), p=2, dim=1)
 
             return image_features
         
     def compute_dino_i(self, images):
         dino_features = self.extract_dino_features(images)
 
+        return self.dino_i_from_features(dino_features)
+
+    def dino_i_from_features(self, dino_features):
+        """
+        DINO-I from already extracted, normalized DINO features
+        """
         similarities = []
 
-        for i in range(len(images) - 1):
+        for i in range(len(dino_features) - 1):
             sim =(dino_features[i] * dino_features[i+1]).sum().item()
             similarities.append(sim)
 
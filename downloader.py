@@ -0,0 +1,84 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+from tracing import traced, current_span
+
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (10, 120)
+
+
+class ImageDownloader:
+    """
+    Shared HTTP downloader for generated images: one keep-alive connection pool,
+    timeouts, exponential-backoff retries and a thread pool for parallel fetches.
+    Images are handed back decoded so callers never need to re-read them from disk.
+    """
+    def __init__(self, pool_size=16, max_retries=4, backoff_factor=0.5, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="download")
+
+    def fetch(self, url):
+        """
+        Download url and return its bytes. Connecting and the response status are
+        retried by the adapter's Retry; this loop only retries a body that broke
+        off mid-transfer, which urllib3 does not.
+        """
+        for attempt in range(self.max_retries + 1):
+            # errors here already went through the adapter's retries
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+            response.raise_for_status()
+            try:
+                return response.content
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                # raised while reading the body: truncated chunk, reset or read timeout
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_factor * (2 ** attempt))
+            finally:
+                response.close()
+
+    @traced("download")
+    def fetch_image(self, url):
+        """Download url and return (bytes, decoded PIL Image)."""
+        data = self.fetch(url)
+        current_span().set(bytes=len(data), images=1)
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return data, image
+
+    def fetch_many(self, urls):
+        """Fetch several images in parallel, returning (bytes, PIL Image) in url order."""
+        return list(self.executor.map(self.fetch_image, urls))
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader():
+    """Process-wide ImageDownloader, created on first use."""
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = ImageDownloader()
+        return _downloader
@@ -0,0 +1,51 @@
+import random
+
+
+# DashScope image models take seeds in [0, 2**31 - 1]
+MAX_SEED = 2 ** 31 - 1
+
+
+def new_seed():
+    return random.randint(0, MAX_SEED)
+
+
+class DraftFrame:
+    """
+    The edits that produced a draft frame at dest, replayed at full resolution once
+    the frame is accepted. Each op is (source path, prompt, seed); a source of None
+    means the frame itself, i.e. an edit of the previous op's result. Replaying with
+    the same sources, prompts and seeds keeps the promoted frame close to the draft
+    that was approved.
+    """
+    def __init__(self, dest):
+        self.dest = dest
+        self.ops = []
+
+    def edit(self, source, prompt, seed):
+        """The frame was (re)drafted from source, discarding earlier ops."""
+        self.ops = [(source, prompt, seed)]
+
+    def refine(self, prompt, seed):
+        """The current draft was edited again."""
+        self.ops.append((None, prompt, seed))
+
+    def promote(self, editor, return_image=False):
+        """Re-render the frame at full resolution with editor; returns what the last edit_image call returns."""
+        result = url = None
+        for i, (source, prompt, seed) in enumerate(self.ops):
+            last = i == len(self.ops) - 1
+            result = editor.edit_image(source or self.dest, prompt, self.dest, None if source else url,
+                                       return_image=return_image and last, seed=seed)
+            url = result[0] if return_image and last else result
+            if url is None:
+                return (None, None) if return_image else None
+        return result
+
+    async def promote_async(self, engine):
+        """promote through an AsyncEngine; returns the full-resolution URL."""
+        url = None
+        for source, prompt, seed in self.ops:
+            url = await engine.edit_image(source or self.dest, prompt, self.dest, None if source else url, seed=seed)
+            if url is None:
+                break
+        return url
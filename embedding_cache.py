@@ -0,0 +1,232 @@
+import atexit
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from image_writer import pending_digest
+
+
+DEFAULT_CACHE_DIR = os.getenv(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "image_gen_framework", "embeddings")
+)
+
+
+def image_key(image):
+    """Content hash of a PIL image (mode, size and decoded pixels)."""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def file_key(filepath):
+    """Content hash of an image file's bytes, without decoding it."""
+    digest = pending_digest(filepath)
+    if digest is not None:
+        return digest
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _try_lock(path):
+    """Open path and take a non-blocking exclusive lock on it; returns the file, or None if another process holds it."""
+    f = open(path, "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def _slot_key(key):
+    return np.frombuffer(hashlib.sha256(key.encode("utf-8")).digest(), dtype=np.uint8)
+
+
+class EmbeddingStore:
+    """
+    Fixed-capacity vector store for one namespace (model + preprocessing config).
+    Vectors live in a memory-mapped .npy file; slots are recycled least-recently-used
+    first once the store is full. Next to each vector the hash of the key that owns
+    the slot is kept, so a crash between recycling a slot and saving index.json can
+    only turn the evicted key into a miss, never into another item's vector.
+
+    One process writes a store at a time: the first one takes a lock file, and
+    others (or store_dir=None) get a private in-memory store instead.
+    """
+    def __init__(self, store_dir, dim, max_entries):
+        self.store_dir = store_dir
+        self.dim = dim
+        self.max_entries = max_entries
+        # key -> slot, ordered from least to most recently used
+        self.slots = OrderedDict()
+        self.dirty = False
+        # LRU order changed by reads only; persisted by flush(include_order=True)
+        self.touched = False
+        self.lock_file = None
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+            self.lock_file = _try_lock(os.path.join(store_dir, "lock"))
+            if self.lock_file is None:
+                print(f"embedding cache {store_dir} is in use by another process; caching in memory only")
+        if self.lock_file is None:
+            self.index_path = None
+            self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+            self.slot_keys = np.zeros((max_entries, 32), dtype=np.uint8)
+            self.free_slots = list(range(max_entries - 1, -1, -1))
+            return
+
+        self.index_path = os.path.join(store_dir, "index.json")
+        vectors_path = os.path.join(store_dir, "vectors.npy")
+        keys_path = os.path.join(store_dir, "keys.npy")
+        if all(os.path.exists(p) for p in (self.index_path, vectors_path, keys_path)):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("dim") == dim and index.get("max_entries") == max_entries:
+                self.slots = OrderedDict(index["slots"])
+
+        if self.slots:
+            self.vectors = np.load(vectors_path, mmap_mode="r+")
+            self.slot_keys = np.load(keys_path, mmap_mode="r+")
+        else:
+            self.vectors = np.lib.format.open_memmap(
+                vectors_path, mode="w+", dtype=np.float32, shape=(max_entries, dim)
+            )
+            self.slot_keys = np.lib.format.open_memmap(
+                keys_path, mode="w+", dtype=np.uint8, shape=(max_entries, 32)
+            )
+        # unowned slots, lowest last so they are handed out in order
+        self.free_slots = sorted(set(range(max_entries)) - set(self.slots.values()), reverse=True)
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        if not np.array_equal(self.slot_keys[slot], _slot_key(key)):
+            # the slot was recycled after the last saved index; the key that now
+            # owns it is not in the index either, so the slot is free again
+            del self.slots[key]
+            self.free_slots.append(slot)
+            self.dirty = True
+            return None
+        self.slots.move_to_end(key)
+        self.touched = True
+        return np.array(self.vectors[slot])
+
+    def put(self, key, vector):
+        if key in self.slots:
+            slot = self.slots[key]
+            self.slots.move_to_end(key)
+        elif self.free_slots:
+            slot = self.free_slots.pop()
+            self.slots[key] = slot
+        else:
+            _, slot = self.slots.popitem(last=False)
+            self.slots[key] = slot
+        # disown the slot before its vector changes, then claim it for the new key
+        self.slot_keys[slot] = 0
+        self.vectors[slot] = vector
+        self.slot_keys[slot] = _slot_key(key)
+        self.dirty = True
+
+    def flush(self, include_order=False):
+        if not (self.dirty or (include_order and self.touched)):
+            return
+        if self.index_path is not None:
+            self.vectors.flush()
+            self.slot_keys.flush()
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({
+                    "dim": self.dim,
+                    "max_entries": self.max_entries,
+                    "slots": list(self.slots.items())
+                }, f)
+            os.replace(tmp_path, self.index_path)
+        self.dirty = False
+        self.touched = False
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk embedding cache shared by DinoEval and CLIPEvaluator.
+    Entries are keyed by content hash inside a namespace that encodes the model
+    name and preprocessing config, so changing either never returns stale vectors.
+    New vectors are saved after each batch that computed any; the LRU order that
+    cache hits change is saved by flush(), which also runs at exit.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_entries=200000):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.stores = {}
+        atexit.register(self.flush)
+
+    def _store_dir(self, namespace):
+        return os.path.join(self.cache_dir, hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:16])
+
+    def _store(self, namespace, dim=None):
+        store = self.stores.get(namespace)
+        if store is None:
+            store_dir = self._store_dir(namespace)
+            if dim is None:
+                index_path = os.path.join(store_dir, "index.json")
+                if not os.path.exists(index_path):
+                    return None
+                with open(index_path) as f:
+                    dim = json.load(f)["dim"]
+            store = EmbeddingStore(store_dir, dim, self.max_entries)
+            if store.index_path is not None:
+                with open(os.path.join(store_dir, "namespace.txt"), "w") as f:
+                    f.write(namespace)
+            self.stores[namespace] = store
+        return store
+
+    def get_or_compute(self, namespace, keys, items, extract_fn):
+        """
+        Return an (N, dim) float32 array of embeddings for items, running
+        extract_fn only on the items whose key is not cached yet.
+
+        Args:
+            namespace: model name + preprocessing config string
+            keys: content keys, one per item
+            items: the images/texts to embed
+            extract_fn: callable(list of items) -> (M, dim) torch tensor or array
+        """
+        store = self._store(namespace)
+        vectors = [store.get(key) if store is not None else None for key in keys]
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            computed = extract_fn([items[i] for i in missing])
+            if hasattr(computed, "detach"):
+                computed = computed.detach().float().cpu().numpy()
+            computed = np.asarray(computed, dtype=np.float32)
+            store = self._store(namespace, computed.shape[1])
+            for i, vector in zip(missing, computed):
+                store.put(keys[i], vector)
+                vectors[i] = vector
+
+        if store is not None:
+            # a no-op unless vectors were added; an all-hit batch writes nothing
+            store.flush()
+        return np.stack(vectors)
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush(include_order=True)
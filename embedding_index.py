@@ -0,0 +1,453 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from payload_cache import file_digest
+
+
+DEFAULT_INDEX_DIR = os.getenv(
+    "EMBEDDING_INDEX_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "image_gen_framework", "index")
+)
+
+
+class VectorIndex:
+    """
+    Append-only matrix of normalized vectors in a memory-mapped .npy file with exact
+    (flat) inner-product search. After train_ivf, every row is also assigned to its
+    closest k-means centroid and queries only scan the nprobe closest lists.
+    Meant for a single writer process at a time.
+    """
+    def __init__(self, index_dir, dim, initial_capacity=1024):
+        os.makedirs(index_dir, exist_ok=True)
+        self.header_path = os.path.join(index_dir, "header.json")
+        self.vectors_path = os.path.join(index_dir, "vectors.npy")
+        self.lists_path = os.path.join(index_dir, "lists.npy")
+        self.centroids_path = os.path.join(index_dir, "centroids.npy")
+        self.dim = dim
+        self.count = 0
+        self.centroids = None
+        self.lists = None
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path) as f:
+                header = json.load(f)
+            if header["dim"] != dim:
+                raise ValueError(f"{index_dir} holds {header['dim']}-d vectors, not {dim}-d")
+            self.count = header["count"]
+            self.vectors = np.load(self.vectors_path, mmap_mode="r+")
+            if os.path.exists(self.centroids_path):
+                self.centroids = np.load(self.centroids_path)
+                self.lists = np.load(self.lists_path, mmap_mode="r+")
+        else:
+            self.vectors = np.lib.format.open_memmap(
+                self.vectors_path, mode="w+", dtype=np.float32, shape=(initial_capacity, dim)
+            )
+
+    def __len__(self):
+        return self.count
+
+    def _resized(self, path, old, capacity):
+        tmp_path = path + ".tmp.npy"
+        new = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=old.dtype, shape=(capacity,) + old.shape[1:])
+        new[:self.count] = old[:self.count]
+        new.flush()
+        os.replace(tmp_path, path)
+        return new
+
+    def _assign(self, vectors):
+        return (np.asarray(vectors, dtype=np.float32) @ self.centroids.T).argmax(axis=1).astype(np.int32)
+
+    def add(self, vectors):
+        """Append rows; returns their row ids."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        start, end = self.count, self.count + len(vectors)
+        if end > len(self.vectors):
+            capacity = max(end, 2 * len(self.vectors))
+            self.vectors = self._resized(self.vectors_path, self.vectors, capacity)
+            if self.lists is not None:
+                self.lists = self._resized(self.lists_path, self.lists, capacity)
+        self.vectors[start:end] = vectors
+        if self.lists is not None:
+            self.lists[start:end] = self._assign(vectors)
+        self.count = end
+        return list(range(start, end))
+
+    def truncate(self, count):
+        self.count = min(self.count, count)
+
+    def _probe(self, query, nprobe):
+        """Row ids to scan for query, or None to scan everything."""
+        if self.centroids is None or nprobe >= len(self.centroids):
+            return None
+        probed = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.flatnonzero(np.isin(self.lists[:self.count], probed))
+
+    def search(self, query, k=10, nprobe=8, chunk=65536):
+        """
+        Top-k rows by inner product (cosine similarity for normalized vectors).
+
+        Returns:
+            (scores, row ids) arrays, best first
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        rows = self._probe(query, nprobe)
+        total = self.count if rows is None else len(rows)
+        best_scores = np.empty(0, dtype=np.float32)
+        best_ids = np.empty(0, dtype=np.int64)
+        for start in range(0, total, chunk):
+            end = min(start + chunk, total)
+            if rows is None:
+                ids = np.arange(start, end)
+                scores = self.vectors[start:end] @ query
+            else:
+                ids = rows[start:end]
+                scores = self.vectors[ids] @ query
+            best_scores = np.concatenate([best_scores, scores])
+            best_ids = np.concatenate([best_ids, ids])
+            if len(best_scores) > k:
+                keep = np.argpartition(-best_scores, k)[:k]
+                best_scores, best_ids = best_scores[keep], best_ids[keep]
+        order = np.argsort(-best_scores)
+        return best_scores[order], best_ids[order]
+
+    def near_duplicates(self, threshold=0.95, new_from=0, chunk=256):
+        """
+        (row_a, row_b, similarity) for pairs above threshold with row_b >= new_from,
+        so only rows added since the last check need comparing. With IVF, rows are
+        only compared within their own list.
+        """
+        pairs = []
+        if self.lists is not None:
+            lists = self.lists[:self.count]
+            for c in np.unique(lists[new_from:]):
+                members = np.flatnonzero(lists == c)
+                new_members = members[members >= new_from]
+                sims = self.vectors[new_members] @ np.asarray(self.vectors[members]).T
+                for a, b in zip(*np.nonzero(sims >= threshold)):
+                    # pairs of two new rows show up twice; keep the ordered one
+                    i, j = members[b], new_members[a]
+                    if i < j:
+                        pairs.append((int(i), int(j), float(sims[a, b])))
+            return sorted(pairs)
+        everything = self.vectors[:self.count]
+        for start in range(new_from, self.count, chunk):
+            end = min(start + chunk, self.count)
+            sims = self.vectors[start:end] @ np.asarray(everything[:end]).T
+            for a, b in zip(*np.nonzero(sims >= threshold)):
+                if b < start + a:
+                    pairs.append((int(b), int(start + a), float(sims[a, b])))
+        return pairs
+
+    def train_ivf(self, nlist=256, iterations=10, sample=50000, seed=0, chunk=65536):
+        """Spherical k-means on a sample of the rows, then assign every row to a list."""
+        if nlist > self.count:
+            raise ValueError(f"cannot train {nlist} lists on {self.count} vectors")
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(self.count, min(sample, self.count), replace=False))
+        x = np.asarray(self.vectors[sample_ids])
+        centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = (x @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, x)
+            filled = np.bincount(assign, minlength=nlist) > 0
+            centroids[filled] = sums[filled] / np.linalg.norm(sums[filled], axis=1, keepdims=True)
+
+        self.centroids = centroids
+        np.save(self.centroids_path, centroids)
+        self.lists = np.lib.format.open_memmap(self.lists_path, mode="w+", dtype=np.int32, shape=(len(self.vectors),))
+        for start in range(0, self.count, chunk):
+            end = min(start + chunk, self.count)
+            self.lists[start:end] = self._assign(self.vectors[start:end])
+        self.flush()
+
+    def flush(self):
+        self.vectors.flush()
+        if self.lists is not None:
+            self.lists.flush()
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "count": self.count, "ivf": self.centroids is not None}, f)
+        os.replace(tmp_path, self.header_path)
+
+
+class GenerationIndex:
+    """
+    Nearest-neighbour index over generated images: DINO and CLIP image embeddings
+    plus the CLIP text embedding of each image's prompt, sharing row ids, with the
+    image path, prompt and source image recorded per row. Supports lookup by image
+    or prompt, reuse of a near-identical earlier generation, and near-duplicate
+    detection. Models are only loaded when embedding is needed.
+    """
+    SPACES = ("dino", "clip_image", "clip_text")
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, dino_evaluator=None, clip_evaluator=None):
+        self.index_dir = index_dir
+        self.dino_evaluator = dino_evaluator
+        self.clip_evaluator = clip_evaluator
+        os.makedirs(index_dir, exist_ok=True)
+        self.meta_path = os.path.join(index_dir, "meta.jsonl")
+        self.spaces_path = os.path.join(index_dir, "spaces.json")
+        self.spaces = {}
+        self.namespaces = {}
+        if os.path.exists(self.spaces_path):
+            with open(self.spaces_path) as f:
+                self.namespaces = json.load(f)
+            for space, info in self.namespaces.items():
+                self.spaces[space] = VectorIndex(os.path.join(index_dir, space), info["dim"])
+
+        self.rows = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                for line in f:
+                    try:
+                        self.rows.append(json.loads(line))
+                    except ValueError:
+                        break
+        # a crash between writing vectors and metadata leaves them uneven; keep the common prefix
+        count = min([len(self.rows)] + [len(index) for index in self.spaces.values()])
+        if count < len(self.rows):
+            self.rows = self.rows[:count]
+            self._rewrite_meta()
+        for index in self.spaces.values():
+            index.truncate(count)
+        self.by_digest = {row["digest"]: i for i, row in enumerate(self.rows)}
+
+    def _dino(self):
+        if self.dino_evaluator is None:
+            from dino_eval import DinoEval
+            self.dino_evaluator = DinoEval()
+        return self.dino_evaluator
+
+    def _clip(self):
+        if self.clip_evaluator is None:
+            from clip_eval import CLIPEvaluator
+            self.clip_evaluator = CLIPEvaluator()
+        return self.clip_evaluator
+
+    def _namespace(self, space):
+        if space == "dino":
+            return self._dino().cache_namespace
+        if space == "clip_image":
+            return self._clip().image_cache_namespace
+        return self._clip().text_cache_namespace
+
+    def _space(self, space, dim=None):
+        """The VectorIndex of a space, checking the evaluator matches the one that built it."""
+        namespace = self._namespace(space)
+        info = self.namespaces.get(space)
+        if info is None:
+            if dim is None:
+                return None
+            self.namespaces[space] = {"namespace": namespace, "dim": dim}
+            self.spaces[space] = VectorIndex(os.path.join(self.index_dir, space), dim)
+            with open(self.spaces_path, "w") as f:
+                json.dump(self.namespaces, f, indent=2)
+        elif info["namespace"] != namespace:
+            raise ValueError(f"{self.index_dir} {space} vectors were built with {info['namespace']!r}, "
+                             f"not {namespace!r}")
+        return self.spaces[space]
+
+    def _rewrite_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for row in self.rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.meta_path)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, image_paths, prompts, source_paths=None, urls=None, **meta):
+        """
+        Embed and add generated images with the prompts that produced them.
+        source_paths gives each image's input image for edits (None for generations),
+        urls their hosted result URLs if known; other keyword arguments are stored on
+        every row. Files whose content is already indexed are skipped. Returns the new row ids.
+        """
+        from PIL import Image
+
+        source_paths = source_paths or [None] * len(image_paths)
+        urls = urls or [None] * len(image_paths)
+        new = []
+        seen = set(self.by_digest)
+        for path, prompt, source, url in zip(image_paths, prompts, source_paths, urls):
+            digest = file_digest(path)
+            if digest not in seen:
+                seen.add(digest)
+                new.append((path, digest, prompt, source, url))
+        if not new:
+            return []
+
+        images = []
+        for path, *_ in new:
+            with Image.open(path) as img:
+                images.append(img.convert("RGB"))
+        features = {
+            "dino": self._dino().extract_dino_features(images),
+            "clip_image": self._clip().extract_clip_image_features(images),
+            "clip_text": self._clip().extract_clip_text_features([prompt for _, _, prompt, _, _ in new]),
+        }
+        for space, vectors in features.items():
+            vectors = vectors.detach().float().cpu().numpy()
+            self._space(space, vectors.shape[1]).add(vectors)
+
+        start = len(self.rows)
+        with open(self.meta_path, "a") as f:
+            for path, digest, prompt, source, url in new:
+                row = dict(meta, path=os.path.abspath(path), digest=digest, prompt=prompt,
+                           source=file_digest(source) if source else None, url=url)
+                self.by_digest[digest] = len(self.rows)
+                self.rows.append(row)
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.flush()
+        return list(range(start, len(self.rows)))
+
+    def _results(self, scores, ids):
+        return [dict(self.rows[i], row=int(i), score=float(s)) for s, i in zip(scores, ids)]
+
+    def query_image(self, image, k=10, space="dino", nprobe=8):
+        """Most similar indexed images to a PIL image, in DINO or CLIP image space."""
+        if space == "dino":
+            query = self._dino().extract_dino_features([image])
+        else:
+            query = self._clip().extract_clip_image_features([image])
+        index = self._space(space)
+        if index is None:
+            return []
+        return self._results(*index.search(query[0].float().cpu().numpy(), k, nprobe))
+
+    def query_text(self, text, k=10, against="clip_text", nprobe=8):
+        """
+        Indexed images for a text: against="clip_text" matches the prompts that made them,
+        against="clip_image" matches the images themselves.
+        """
+        index = self._space(against)
+        if index is None:
+            return []
+        query = self._clip().extract_clip_text_features([text])[0].float().cpu().numpy()
+        return self._results(*index.search(query, k, nprobe))
+
+    def find_reuse(self, prompt, source_path=None, threshold=0.97):
+        """
+        An earlier generation that can stand in for a new request: a prompt at least
+        threshold similar, made from the same source image (or also a fresh
+        generation when source_path is None), whose file still exists. None otherwise.
+        """
+        source = file_digest(source_path) if source_path else None
+        for hit in self.query_text(prompt, k=20):
+            if hit["score"] < threshold:
+                break
+            if hit["source"] == source and os.path.exists(hit["path"]):
+                return hit
+        return None
+
+    def near_duplicates(self, threshold=0.95, space="dino", new_from=0):
+        """Groups of row dicts whose images are near-duplicates in the given space."""
+        index = self.spaces.get(space)
+        if index is None:
+            return []
+        parent = {}
+
+        def find(i):
+            while parent.setdefault(i, i) != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b, _ in index.near_duplicates(threshold, new_from):
+            parent[find(a)] = find(b)
+        groups = {}
+        for i in parent:
+            groups.setdefault(find(i), []).append(i)
+        return [[self.rows[i] for i in sorted(members)] for members in groups.values() if len(members) > 1]
+
+    def train_ivf(self, nlist=256, **kwargs):
+        for index in self.spaces.values():
+            index.train_ivf(min(nlist, len(index)), **kwargs)
+
+    def flush(self):
+        for index in self.spaces.values():
+            index.flush()
+
+
+def edit_sources(image_paths, edit_from="first"):
+    """
+    Source image of each step of a sequence, as the generation loops make them:
+    None for the generated step 1, then step 1 for every later step with
+    edit_from="first" (the default), or the previous step with "previous".
+    """
+    if not image_paths:
+        return []
+    if edit_from == "first":
+        return [None] + [image_paths[0]] * (len(image_paths) - 1)
+    return [None] + list(image_paths[:-1])
+
+
+def main():
+    from utils import find_sequence_dirs, load_sequence
+
+    parser = argparse.ArgumentParser(description="Nearest-neighbour index over generated images")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = sub.add_parser("add", help="index every sequence directory under a root")
+    add_parser.add_argument("root")
+    add_parser.add_argument("--edit-from", choices=("first", "previous"), default="first",
+                            help="which step the sequences' later steps were edited from (batch_runner's edit_from)")
+
+    query_parser = sub.add_parser("query", help="find indexed images similar to an image or a text")
+    query_parser.add_argument("--image")
+    query_parser.add_argument("--text")
+    query_parser.add_argument("--space", choices=GenerationIndex.SPACES, default=None,
+                              help="dino/clip_image for --image, clip_text/clip_image for --text")
+    query_parser.add_argument("-k", type=int, default=10)
+
+    dedupe_parser = sub.add_parser("dedupe", help="list groups of near-duplicate images")
+    dedupe_parser.add_argument("--threshold", type=float, default=0.95)
+    dedupe_parser.add_argument("--space", choices=("dino", "clip_image"), default="dino")
+    dedupe_parser.add_argument("--out", help="write the groups as JSON")
+
+    ivf_parser = sub.add_parser("train-ivf", help="cluster the index so queries scan only nearby lists")
+    ivf_parser.add_argument("--nlist", type=int, default=256)
+    args = parser.parse_args()
+
+    index = GenerationIndex(args.index_dir)
+    if args.command == "add":
+        added = 0
+        for seq_dir in find_sequence_dirs(args.root):
+            image_paths, goal, prompts = load_sequence(seq_dir)
+            sources = edit_sources(image_paths, args.edit_from)
+            added += len(index.add(image_paths, prompts, sources, goal=goal, sequence=seq_dir))
+        print(f"added {added} images, index holds {len(index)}")
+    elif args.command == "query":
+        if bool(args.image) == bool(args.text):
+            parser.error("give exactly one of --image or --text")
+        if args.image:
+            from PIL import Image
+            with Image.open(args.image) as img:
+                hits = index.query_image(img.convert("RGB"), args.k, args.space or "dino")
+        else:
+            hits = index.query_text(args.text, args.k, args.space or "clip_text")
+        for hit in hits:
+            print(f"{hit['score']:.4f}  {hit['path']}  {hit['prompt'][:80]!r}")
+    elif args.command == "dedupe":
+        groups = index.near_duplicates(args.threshold, args.space)
+        for group in groups:
+            print(f"{len(group)} near-duplicates:")
+            for row in group:
+                print(f"  {row['path']}")
+        print(f"{len(groups)} groups, {sum(len(g) - 1 for g in groups)} redundant images")
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump([[row["path"] for row in group] for group in groups], f, indent=2)
+    else:
+        index.train_ivf(args.nlist)
+        print(f"trained IVF with up to {args.nlist} lists on {len(index)} images")
+
+
+if __name__ == "__main__":
+    main()
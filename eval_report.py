@@ -0,0 +1,90 @@
+from tracing import traced
+
+
+def extract_sequence_features(dino_evaluator, clip_evaluator, images, prompts, goal_text, preprocessor=None):
+    """
+    Run every feature extraction a sequence report needs exactly once.
+
+    Args:
+        dino_evaluator: DinoEval instance
+        clip_evaluator: CLIPEvaluator instance
+        images: List of PIL Images (or image paths, with a preprocessor) for ONE sequence
+        prompts: List of step prompts corresponding to images
+        goal_text: The goal text of the sequence
+        preprocessor: optional image_pipeline.SharedPreprocessor that decodes each
+            image once for both models
+
+    Returns:
+        dict of normalized feature tensors: dino, clip_image, clip_text, clip_step
+    """
+    if len(images) != len(prompts):
+        raise ValueError("Number of images must match number of texts")
+
+    if preprocessor is not None:
+        dino_features, clip_image_features = preprocessor.extract_features(images)
+    else:
+        dino_features = dino_evaluator.extract_dino_features(images)
+        clip_image_features = clip_evaluator.extract_clip_image_features(images)
+
+    # prompts and goal-conditioned steps go through the text tower in one batch
+    conditioned_steps = [f"{goal_text}. {step}" for step in prompts]
+    text_features = clip_evaluator.extract_clip_text_features(list(prompts) + conditioned_steps)
+
+    return {
+        "dino": dino_features,
+        "clip_image": clip_image_features,
+        "clip_text": text_features[:len(prompts)],
+        "clip_step": text_features[len(prompts):],
+    }
+
+
+def report_from_features(dino_evaluator, clip_evaluator, features, goal_text, all_goal_texts=None, num_distractors=1):
+    """
+    Derive every sequence metric from features returned by extract_sequence_features.
+    Goal faithfulness is None when no all_goal_texts pool is given.
+    """
+    import torch
+
+    with torch.no_grad():
+        dino_i = dino_evaluator.dino_i_from_features(features["dino"])
+        clip_i = clip_evaluator.clip_i_from_features(features["clip_image"])
+        clip_t = clip_evaluator.clip_t_from_features(features["clip_image"], features["clip_text"])
+        step_faithfulness = clip_evaluator.step_faithfulness_from_features(features["clip_image"], features["clip_step"])
+
+        goal_faithfulness = None
+        if all_goal_texts is not None:
+            goal_faithfulness = clip_evaluator.goal_faithfulness_from_features(
+                features["clip_image"], goal_text, all_goal_texts, num_distractors
+            )
+
+    return {
+        "num_images": len(features["clip_image"]),
+        "clip_i": float(clip_i),
+        "clip_t": float(clip_t),
+        "clip_star": float(clip_i * clip_t),
+        "dino_i": float(dino_i),
+        "dino_star": float(dino_i * clip_t),
+        "goal_faithfulness": goal_faithfulness,
+        "step_faithfulness": step_faithfulness,
+    }
+
+
+@traced("evaluate")
+def evaluate_sequence(dino_evaluator, clip_evaluator, images, prompts, goal_text, all_goal_texts=None, num_distractors=1,
+                      preprocessor=None):
+    """
+    Single-pass evaluation report: CLIP-I, CLIP-T, CLIP*, DINO-I, DINO*,
+    goal faithfulness and step faithfulness from one feature extraction.
+    """
+    features = extract_sequence_features(dino_evaluator, clip_evaluator, images, prompts, goal_text, preprocessor)
+    return report_from_features(dino_evaluator, clip_evaluator, features, goal_text, all_goal_texts, num_distractors)
+
+
+def print_report(report):
+    print("DINO-i", report["dino_i"])
+    print("CLIP-i", report["clip_i"])
+    print("CLIP-t", report["clip_t"])
+    print("CLIP-star", report["clip_star"])
+    print("DINO-star", report["dino_star"])
+    print("goal faithfulness ", report["goal_faithfulness"])
+    print("step faithfulness ", report["step_faithfulness"])
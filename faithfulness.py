@@ -0,0 +1,211 @@
+import argparse
+import json
+
+import numpy as np
+import torch
+
+from tracing import traced, current_span
+
+
+class FaithfulnessEngine:
+    """
+    Dataset-level goal and step faithfulness. The whole goal/step vocabulary is
+    embedded in one text pass, distractor goals are drawn as index sets from a
+    seeded RNG, and every image of every sequence is scored with batched matrix
+    ops. Sequence scores come with bootstrap confidence intervals over sequences.
+    """
+    def __init__(self, clip_evaluator, seed=0, text_batch_size=256, image_chunk=4096):
+        self.clip_evaluator = clip_evaluator
+        self.seed = seed
+        self.text_batch_size = text_batch_size
+        self.image_chunk = image_chunk
+
+    @traced("faithfulness_text")
+    def encode_texts(self, texts):
+        current_span().set(texts=len(texts))
+        return torch.cat([
+            self.clip_evaluator.extract_clip_text_features(texts[i:i + self.text_batch_size])
+            for i in range(0, len(texts), self.text_batch_size)
+        ])
+
+    def _distractor_idx(self, rng, goal_ids, num_goals, num_distractors):
+        """(images, num_distractors) goal ids drawn without replacement from all goals but each image's own."""
+        picks = []
+        for start in range(0, len(goal_ids), self.image_chunk):
+            own = goal_ids[start:start + self.image_chunk, None]
+            drawn = self._distinct_draws(rng, len(own), num_goals - 1, num_distractors)
+            # indices range over the other num_goals - 1 goals; shift past the image's own goal
+            picks.append(drawn + (drawn >= own))
+        return np.concatenate(picks)
+
+    @staticmethod
+    def _distinct_draws(rng, rows, high, k, rounds=8):
+        """(rows, k) integers in [0, high), distinct within each row, without a (rows, high) matrix."""
+        drawn = rng.integers(0, high, (rows, k))
+        for _ in range(rounds):
+            ordered = np.sort(drawn, axis=1)
+            bad = (ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+            if not bad.any():
+                return drawn
+            # redraw only the rows with a collision; rare unless k is close to high
+            drawn[bad] = rng.integers(0, high, (int(bad.sum()), k))
+        ordered = np.sort(drawn, axis=1)
+        for row in np.flatnonzero((ordered[:, 1:] == ordered[:, :-1]).any(axis=1)):
+            drawn[row] = rng.choice(high, k, replace=False)
+        return drawn
+
+    @traced("faithfulness")
+    def score(self, sequences, num_distractors=3, num_bootstrap=1000, confidence=0.95):
+        """
+        Args:
+            sequences: list of dicts with "goal", "prompts" and "image_features"
+                (normalized CLIP image features, one row per prompt)
+            num_distractors: distractor goals per multiple-choice question
+            num_bootstrap: bootstrap resamples for the confidence intervals (0 disables)
+            confidence: confidence level of the intervals
+
+        Returns:
+            dict with per-sequence goal/step accuracies and dataset means with intervals
+        """
+        if not sequences:
+            raise ValueError("no sequences to score")
+        rng = np.random.default_rng(self.seed)
+        goals = sorted({seq["goal"] for seq in sequences})
+        goal_index = {g: i for i, g in enumerate(goals)}
+        lengths = [len(seq["prompts"]) for seq in sequences]
+        for seq, n in zip(sequences, lengths):
+            if len(seq["image_features"]) != n:
+                raise ValueError(f"sequence {seq['goal']!r} has {len(seq['image_features'])} images for {n} prompts")
+        current_span().set(sequences=len(sequences), images=sum(lengths), goals=len(goals))
+
+        # one text pass: every goal, then every goal-conditioned step
+        conditioned_steps = [f"{seq['goal']}. {step}" for seq in sequences for step in seq["prompts"]]
+        text_features = self.encode_texts(goals + conditioned_steps)
+        goal_features, step_features = text_features[:len(goals)], text_features[len(goals):]
+
+        image_features = torch.cat([torch.as_tensor(seq["image_features"]) for seq in sequences]).float()
+        seq_ids = np.repeat(np.arange(len(sequences)), lengths)
+        goal_ids = np.array([goal_index[sequences[s]["goal"]] for s in seq_ids], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        step_pos = np.arange(len(seq_ids)) - offsets[seq_ids]
+
+        # step candidates: every step of the image's own sequence, padded with -1
+        max_len = max(lengths, default=0)
+        seq_steps = np.full((len(sequences), max_len), -1, dtype=np.int64)
+        for s, (offset, n) in enumerate(zip(offsets, lengths)):
+            seq_steps[s, :n] = np.arange(offset, offset + n)
+
+        goal_correct = np.zeros(len(seq_ids), dtype=bool)
+        step_correct = np.zeros(len(seq_ids), dtype=bool)
+        has_goal_question = len(goals) - 1 >= num_distractors > 0
+        if has_goal_question:
+            candidates = np.concatenate(
+                [goal_ids[:, None], self._distractor_idx(rng, goal_ids, len(goals), num_distractors)], axis=1
+            )
+        with torch.no_grad():
+            for start in range(0, len(seq_ids), self.image_chunk):
+                end = start + self.image_chunk
+                feats = image_features[start:end]
+                if has_goal_question:
+                    cand = torch.from_numpy(candidates[start:end])
+                    sims = torch.einsum("nd,nkd->nk", feats, goal_features[cand])
+                    goal_correct[start:end] = (sims.argmax(dim=1) == 0).numpy()
+
+                steps = torch.from_numpy(seq_steps[seq_ids[start:end]])
+                sims = torch.einsum("nd,nkd->nk", feats, step_features[steps.clamp(min=0)])
+                sims[steps < 0] = -float("inf")
+                step_correct[start:end] = (sims.argmax(dim=1).numpy() == step_pos[start:end])
+
+        per_sequence_goal = _per_sequence_mean(goal_correct, seq_ids, len(sequences))
+        per_sequence_step = _per_sequence_mean(step_correct, seq_ids, len(sequences))
+        result = {
+            "num_sequences": len(sequences),
+            "num_images": int(len(seq_ids)),
+            "num_goals": len(goals),
+            "num_distractors": num_distractors,
+            "seed": self.seed,
+            "step_faithfulness": _summary(per_sequence_step, rng, num_bootstrap, confidence),
+            "per_sequence_step_faithfulness": per_sequence_step.tolist(),
+            "goal_faithfulness": None,
+            "per_sequence_goal_faithfulness": None,
+        }
+        if has_goal_question:
+            result["goal_faithfulness"] = _summary(per_sequence_goal, rng, num_bootstrap, confidence)
+            result["per_sequence_goal_faithfulness"] = per_sequence_goal.tolist()
+        return result
+
+
+def _per_sequence_mean(correct, seq_ids, num_sequences):
+    """Accuracy per sequence; NaN for sequences without images."""
+    counts = np.bincount(seq_ids, minlength=num_sequences)
+    hits = np.bincount(seq_ids, weights=correct.astype(np.float64), minlength=num_sequences)
+    return np.divide(hits, counts, out=np.full(num_sequences, np.nan), where=counts > 0)
+
+
+def _summary(values, rng, num_bootstrap, confidence, chunk=256):
+    """Mean over sequences with a percentile bootstrap interval (sequences resampled with replacement)."""
+    values = values[~np.isnan(values)]
+    summary = {"mean": float(values.mean()) if len(values) else 0.0, "ci_low": None, "ci_high": None}
+    if num_bootstrap and len(values) > 1:
+        means = np.concatenate([
+            values[rng.integers(0, len(values), (min(chunk, num_bootstrap - i), len(values)))].mean(axis=1)
+            for i in range(0, num_bootstrap, chunk)
+        ])
+        alpha = (1 - confidence) / 2
+        summary["ci_low"], summary["ci_high"] = (float(q) for q in np.quantile(means, [alpha, 1 - alpha]))
+        summary["confidence"] = confidence
+    return summary
+
+
+def main():
+    from PIL import Image
+    from clip_eval import CLIPEvaluator
+    from embedding_cache import EmbeddingCache
+    from utils import find_sequence_dirs, load_sequence
+
+    parser = argparse.ArgumentParser(description="Dataset-level goal/step faithfulness with bootstrap intervals")
+    parser.add_argument("root", help="directory containing sequence dirs (step_N.png + prompts.json)")
+    parser.add_argument("--num-distractors", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bootstrap", type=int, default=1000, help="bootstrap resamples (0 disables intervals)")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--cache-dir", help="embedding cache directory, reused across runs")
+    parser.add_argument("--out", help="write the full result (with per-sequence scores) as JSON")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache_dir) if args.cache_dir else None
+    clip_evaluator = CLIPEvaluator(cache=cache)
+
+    sequences = []
+    for seq_dir in find_sequence_dirs(args.root):
+        image_paths, goal, prompts = load_sequence(seq_dir)
+        images = []
+        for path in image_paths:
+            with Image.open(path) as img:
+                images.append(img.convert("RGB"))
+        sequences.append({
+            "dir": seq_dir,
+            "goal": goal,
+            "prompts": prompts,
+            "image_features": clip_evaluator.extract_clip_image_features(images),
+        })
+
+    engine = FaithfulnessEngine(clip_evaluator, seed=args.seed)
+    result = engine.score(sequences, args.num_distractors, args.bootstrap, args.confidence)
+    result["sequences"] = [seq["dir"] for seq in sequences]
+    for name in ("goal_faithfulness", "step_faithfulness"):
+        summary = result[name]
+        if summary is None:
+            print(f"{name}: n/a (fewer than {args.num_distractors + 1} distinct goals)")
+        elif summary["ci_low"] is None:
+            print(f"{name}: {summary['mean']:.4f}")
+        else:
+            print(f"{name}: {summary['mean']:.4f} "
+                  f"[{summary['ci_low']:.4f}, {summary['ci_high']:.4f}] at {summary['confidence']:.0%}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,39 @@ import os
 import dashscope
 import dotenv
 from dotenv import load_dotenv
-from utils import encode_file
-from utils import save_image_from_url
+from utils import dashscope_base_url, save_image_from_url, raise_if_throttled
+from payload_cache import image_payload, encoded_payloads, remote_urls
+from tracing import traced, current_span, record_usage
+
+
+# bounding box of the source sent for draft edits; qwen-image-edit sizes its output from the
+# input image and needs both sides within 384-3072px
+DRAFT_SIZE = (512, 512)
 
 class image_editor:
     def __init__(self):
         load_dotenv()
         self.api_key = os.getenv("ALIBABA_API_KEY")
-        dashscope.base_http_api_url = 'https://dashscope-intl.aliyuncs.com/api/v1'
+        dashscope.base_http_api_url = dashscope_base_url()
     
-    def edit_image(self, image_filepath, prompt, dest_filename, edit_url):
-        encoded_image = encode_file(image_filepath)
+    @traced("edit", model="qwen-image-edit")
+    def edit_image(self, image_filepath, prompt, dest_filename, edit_url, return_image=False, seed=None, draft=False):
+        """
+        Edit the image at edit_url with prompt and save the result to dest_filename.
+        If edit_url is missing or expired, the hosted copy of image_filepath is used,
+        falling back to uploading the local file. With draft, image_filepath is sent
+        downscaled to DRAFT_SIZE (edit_url is ignored) for a faster low-resolution
+        preview; a fixed seed lets an accepted draft be re-rendered at full size.
+        Returns the hosted image URL, or (url, PIL Image) when return_image is set.
+        """
+        image_ref = encoded_payloads.encode(image_filepath, DRAFT_SIZE) if draft else image_payload(image_filepath, edit_url)
+        extra = {"seed": seed} if seed is not None else {}
 
         messages = [
         {
             "role": "user",
             "content": [
-                {"image": edit_url},
+                {"image": image_ref},
                 {"text": prompt}
             ]
         }
@@ -31,20 +47,28 @@ class image_editor:
             messages=messages,
             stream=False,
             watermark=False,
-            negative_prompt=" "
+            negative_prompt=" ",
+            **extra
         )
+        current_span().set(status_code=response.status_code, images=1, uploaded=image_ref.startswith("data:"),
+                           draft=draft)
+        record_usage(response)
+        raise_if_throttled(response)
         print('got response')
 
         if response:
             print(response)
             output_url = response.output.choices[0].message.content[0]['image']
-            save_image_from_url(output_url, dest_filename)
-            return output_url
+            image = save_image_from_url(output_url, dest_filename)
+            if image is not None:
+                remote_urls.record(dest_filename, output_url)
+            return (output_url, image) if return_image else output_url
         else:
             print(f"HTTP status code: {response.status_code}")
             print(f"Error code: {response.code}")
             print(f"Error message: {response.message}")
             print("For more information, see the documentation: https://www.alibabacloud.com/help/zh/model-studio/error-code")
+        return (None, None) if return_image else None
 
     
 
@@ -3,7 +3,14 @@ from dotenv import load_dotenv
 import dashscope
 from dashscope import MultiModalConversation
 import json
-from utils import save_image_from_url
+from utils import dashscope_base_url, save_image_from_url, raise_if_throttled
+from payload_cache import remote_urls
+from tracing import traced, current_span, record_usage
+
+
+# the only output sizes qwen-image accepts (16:9, 4:3, 1:1, 3:4, 9:16); there is no smaller draft size
+SUPPORTED_SIZES = ("1664*928", "1472*1140", "1328*1328", "1140*1472", "928*1664")
+FULL_SIZE = "1328*1328"
 
 
 
@@ -13,9 +20,18 @@ class image_generator:
     def __init__(self):
         load_dotenv()
         self.api_key = os.getenv("ALIBABA_API_KEY")
-        dashscope.base_http_api_url = 'https://dashscope-intl.aliyuncs.com/api/v1'
+        dashscope.base_http_api_url = dashscope_base_url()
 
-    def generate_image(self, prompt, filename):
+    @traced("generate", model="qwen-image-plus")
+    def generate_image(self, prompt, filename, return_image=False, size=FULL_SIZE, seed=None):
+        """
+        Generate an image for prompt and save it to filename. size must be one of
+        SUPPORTED_SIZES; a fixed seed makes the result reproducible.
+        Returns the hosted image URL, or (url, PIL Image) when return_image is set.
+        """
+        if size not in SUPPORTED_SIZES:
+            raise ValueError(f"qwen-image does not support size {size!r}; use one of {', '.join(SUPPORTED_SIZES)}")
+        extra = {"seed": seed} if seed is not None else {}
         messages = [
         {
             "role": "user",
@@ -33,8 +49,12 @@ class image_generator:
         watermark=False,
         prompt_extend=True,
         negative_prompt='',
-        size='1328*1328'
+        size=size,
+        **extra
         )
+        current_span().set(status_code=response.status_code, images=1)
+        record_usage(response)
+        raise_if_throttled(response)
 
         if response.status_code == 200:
             print(json.dumps(response, ensure_ascii=False))
@@ -50,10 +70,13 @@ class image_generator:
             if not image_url:
                 raise KeyError("No image field found in response.")
             print(f"Image URL: {image_url}")
-            save_image_from_url(image_url, filename)
-            return image_url
+            image = save_image_from_url(image_url, filename)
+            if image is not None:
+                remote_urls.record(filename, image_url)
+            return (image_url, image) if return_image else image_url
         except (IndexError, KeyError, AttributeError, TypeError) as e:
             print(f"Failed to extract image URL: {e}")
+        return (None, None) if return_image else None
 
 
 # Need: to initialize functions that -> rewrite prompts _
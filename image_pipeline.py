@@ -0,0 +1,135 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+from torchvision.transforms import functional as TF
+
+from embedding_cache import file_key, image_key
+from tracing import traced, current_span
+
+
+class SharedPreprocessor:
+    """
+    Decodes every image once and derives both the CLIP and the DINO input tensors
+    from one downscaled intermediate, on a thread pool (PIL releases the GIL while
+    decoding and resizing). JPEGs are decoded at reduced scale via draft(), other
+    formats are box-reduced; the intermediate keeps at least twice the largest
+    target side so the final antialiased resizes see the same detail.
+
+    CLIP: bicubic resize of the short side, center crop, CLIP mean/std
+    DINO: the DinoEval.preprocess transform (bilinear 256, crop 224, ImageNet mean/std)
+    """
+    def __init__(self, dino_evaluator, clip_evaluator, workers=None, batch_size=16):
+        self.dino_evaluator = dino_evaluator
+        self.clip_evaluator = clip_evaluator
+        image_processor = clip_evaluator.clip_processor.image_processor
+        self.clip_size = image_processor.size["shortest_edge"]
+        self.clip_crop = (image_processor.crop_size["height"], image_processor.crop_size["width"])
+        self.clip_mean = image_processor.image_mean
+        self.clip_std = image_processor.image_std
+        self.min_side = 2 * max(self.clip_size, 256)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1),
+                                           thread_name_prefix="preprocess")
+        # features differ slightly from the per-model preprocessing, so they get their own cache entries
+        tag = f"|decode=shared,min_side={self.min_side}"
+        self.dino_cache_namespace = dino_evaluator.cache_namespace + tag
+        self.clip_cache_namespace = clip_evaluator.image_cache_namespace + tag
+
+    def decode(self, source):
+        """Image path or PIL image -> RGB intermediate with short side >= min_side (if the source was larger)."""
+        if isinstance(source, Image.Image):
+            image = source if source.mode == "RGB" else source.convert("RGB")
+        else:
+            with Image.open(source) as f:
+                # only JPEG implements draft: libjpeg decodes straight to 1/2, 1/4 or 1/8 scale
+                f.draft("RGB", (self.min_side, self.min_side))
+                image = f.convert("RGB")
+        factor = min(image.size) // self.min_side
+        if factor >= 2:
+            image = image.reduce(factor)
+        return image
+
+    def _clip_pixels(self, image):
+        image = TF.resize(image, self.clip_size, interpolation=TF.InterpolationMode.BICUBIC)
+        image = TF.center_crop(image, self.clip_crop)
+        return TF.normalize(TF.to_tensor(image), self.clip_mean, self.clip_std)
+
+    def _preprocess_one(self, source):
+        image = self.decode(source)
+        return self._clip_pixels(image), self.dino_evaluator.preprocess(image)
+
+    def _submit(self, sources):
+        return [self.executor.submit(self._preprocess_one, source) for source in sources]
+
+    @staticmethod
+    def _collect(futures):
+        clip_pixels, dino_pixels = zip(*(future.result() for future in futures))
+        return torch.stack(clip_pixels), torch.stack(dino_pixels)
+
+    @traced("preprocess")
+    def preprocess(self, sources):
+        """(clip_pixels, dino_pixels) tensors for a list of image paths or PIL images"""
+        current_span().set(images=len(sources))
+        return self._collect(self._submit(sources))
+
+    def iter_batches(self, sources):
+        """
+        Yield (clip_pixels, dino_pixels) per batch_size chunk of sources, preprocessing
+        the next chunk on the pool while the caller runs the models on the current one.
+        """
+        chunks = [sources[i:i + self.batch_size] for i in range(0, len(sources), self.batch_size)]
+        pending = self._submit(chunks[0]) if chunks else None
+        for i in range(len(chunks)):
+            current = pending
+            if i + 1 < len(chunks):
+                pending = self._submit(chunks[i + 1])
+            yield self._collect(current)
+
+    def _compute(self, sources):
+        dino_features, clip_features = [], []
+        for clip_pixels, dino_pixels in self.iter_batches(sources):
+            dino_features.append(self.dino_evaluator.extract_dino_features_from_pixels(dino_pixels))
+            clip_features.append(self.clip_evaluator.extract_clip_image_features_from_pixels(clip_pixels))
+        return torch.cat(dino_features), torch.cat(clip_features)
+
+    def extract_features(self, sources):
+        """
+        Normalized (dino_features, clip_image_features) for image paths or PIL images,
+        each image decoded once for both models. Uses the evaluators' EmbeddingCache if set.
+        """
+        dino_cache, clip_cache = self.dino_evaluator.cache, self.clip_evaluator.cache
+        if dino_cache is None and clip_cache is None:
+            return self._compute(sources)
+
+        keys = [file_key(s) if isinstance(s, (str, os.PathLike)) else image_key(s) for s in sources]
+        indices = list(range(len(sources)))
+        clip_computed = {}
+
+        def compute_both(missing):
+            dino_features, clip_features = self._compute([sources[i] for i in missing])
+            clip_computed.update(zip(missing, clip_features))
+            return dino_features
+
+        def compute_clip(missing):
+            # usually everything was computed alongside DINO above
+            rest = [i for i in missing if i not in clip_computed]
+            if rest:
+                clip_computed.update(zip(rest, self._compute([sources[i] for i in rest])[1]))
+            return torch.stack([clip_computed[i] for i in missing])
+
+        if dino_cache is not None:
+            dino_features = dino_cache.get_or_compute(self.dino_cache_namespace, keys, indices, compute_both)
+            dino_features = torch.from_numpy(dino_features).to(self.dino_evaluator.device)
+        else:
+            dino_features = compute_both(indices)
+        if clip_cache is not None:
+            clip_features = clip_cache.get_or_compute(self.clip_cache_namespace, keys, indices, compute_clip)
+            clip_features = torch.from_numpy(clip_features).to(self.clip_evaluator.device)
+        else:
+            clip_features = compute_clip(indices)
+        return dino_features, clip_features
+
+    def close(self):
+        self.executor.shutdown(wait=True)
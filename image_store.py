@@ -0,0 +1,150 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_writer import wait_written
+
+
+# decoded pixels kept across all stores of the process before least recently used images are dropped
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# thumbnails keep twice the evaluators' 224/256px inputs, like image_pipeline.SharedPreprocessor
+THUMBNAIL_MIN_SIDE = 512
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageMemoryCache:
+    """
+    LRU of decoded images bounded by total pixel bytes. Entries put with
+    expendable=True (full frames) are evicted before the others (thumbnails).
+    One instance is shared by every SequenceImageStore in the process, so
+    concurrent sessions draw on a single budget instead of each growing with its
+    sequence.
+    """
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, image, expendable=False):
+        size = image_nbytes(image)
+        with self.lock:
+            self._drop(key)
+            if size > self.budget:
+                return
+            self.entries[key] = (image, size, expendable)
+            self.nbytes += size
+            while self.nbytes > self.budget:
+                victim = next((k for k, entry in self.entries.items() if entry[2]), None)
+                self._drop(victim if victim is not None else next(iter(self.entries)))
+
+    def discard(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+
+shared_image_cache = ImageMemoryCache()
+
+
+class SequenceImageStore:
+    """
+    The step images of a sequence as file paths plus cached decodes. Full-size
+    frames are decoded only when asked for; evaluators get small RGB thumbnails
+    (short side >= THUMBNAIL_MIN_SIDE) decoded at reduced scale. Every file is
+    opened in a with block, so no handle outlives the decode, and all decoded
+    images live in a memory-bounded LRU that drops full frames first, then
+    thumbnails, and re-decodes them from disk when needed again.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, paths=(), cache=None, thumbnail_min_side=THUMBNAIL_MIN_SIDE):
+        self.id = next(self._ids)
+        self.paths = list(paths)
+        self.cache = cache or shared_image_cache
+        self.thumbnail_min_side = thumbnail_min_side
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path, image=None):
+        """Append a step; image, if given, is the already decoded file and seeds the cache."""
+        self.paths.append(path)
+        index = len(self.paths) - 1
+        if image is not None:
+            self._seed(index, image)
+        return index
+
+    def replace(self, index, path, image=None):
+        """Point step index at a regenerated file, dropping the stale decodes."""
+        self.paths[index] = path
+        for kind in ("full", "thumbnail"):
+            self.cache.discard((self.id, kind, index))
+        if image is not None:
+            self._seed(index, image)
+
+    def _seed(self, index, image):
+        image = image if image.mode == "RGB" else image.convert("RGB")
+        self.cache.put((self.id, "thumbnail", index), self._reduce(image))
+        self.cache.put((self.id, "full", index), image, expendable=True)
+
+    def _reduce(self, image):
+        factor = min(image.size) // self.thumbnail_min_side
+        return image.reduce(factor) if factor >= 2 else image
+
+    def image(self, index):
+        """Full-resolution RGB image of step index."""
+        key = (self.id, "full", index)
+        image = self.cache.get(key)
+        if image is None:
+            wait_written(self.paths[index])
+            with Image.open(self.paths[index]) as f:
+                image = f.convert("RGB")
+            self.cache.put(key, image, expendable=True)
+        return image
+
+    def thumbnail(self, index):
+        """Small RGB image of step index, for the evaluators."""
+        key = (self.id, "thumbnail", index)
+        image = self.cache.get(key)
+        if image is None:
+            full = self.cache.get((self.id, "full", index))
+            if full is not None:
+                image = self._reduce(full)
+            else:
+                wait_written(self.paths[index])
+                with Image.open(self.paths[index]) as f:
+                    # JPEGs decode straight to a reduced scale; other formats are box-reduced below
+                    f.draft("RGB", (self.thumbnail_min_side, self.thumbnail_min_side))
+                    image = self._reduce(f.convert("RGB"))
+            self.cache.put(key, image)
+        return image
+
+    def thumbnails(self):
+        return [self.thumbnail(i) for i in range(len(self.paths))]
+
+    def show(self, index):
+        self.image(index).show()
+
+    def close(self):
+        """Drop this store's decoded images from the shared cache."""
+        for index in range(len(self.paths)):
+            for kind in ("full", "thumbnail"):
+                self.cache.discard((self.id, kind, index))
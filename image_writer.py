@@ -0,0 +1,213 @@
+import atexit
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import traced, current_span
+
+
+TRANSCODE_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+PREVIEW_DIR = "previews"
+EVAL_DIR = "eval"
+
+
+class ImageWriter:
+    """
+    Writes downloaded images to disk on a small thread pool, off the request path.
+    At most max_pending writes are queued; submit blocks beyond that. Besides the
+    original bytes it can write, per image:
+        <name>.webp / <name>.jpg    transcoded copy at the given quality
+        previews/<name>.jpg         preview thumbnail (longest side thumbnail_size)
+        eval/<name>.png             evaluator-sized crop (short side resized to
+                                    eval_size, center crop eval_size x eval_size)
+    Every file goes to a temporary name first and is renamed into place. Readers
+    of a path that may still be queued call wait(path); the content hash of a
+    queued file is known up front (pending_digest). A failed write is kept until
+    the path is written again, so every later wait(path) raises it instead of the
+    reader finding the file missing. Everything queued is flushed at interpreter exit.
+    """
+    def __init__(self, transcode=None, quality=90, thumbnail_size=None, eval_size=None, workers=2, max_pending=32):
+        if transcode is not None and transcode not in TRANSCODE_FORMATS:
+            raise ValueError(f"transcode must be one of {sorted(TRANSCODE_FORMATS)}, got {transcode!r}")
+        self.transcode = transcode
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.eval_size = eval_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        # absolute path -> (future, sha256 of the bytes being written)
+        self.pending = {}
+        # absolute path -> exception of its last write
+        self.failed = {}
+
+    def submit(self, path, data, image=None):
+        """Queue data (the original file bytes) for path; image is its decoded form, used for the derived files."""
+        # a second write to the same path must land after the first (and replaces a failed one)
+        with self.lock:
+            entry = self.pending.get(os.path.abspath(path))
+        if entry is not None:
+            entry[0].exception()
+        self.slots.acquire()
+        digest = hashlib.sha256(data).hexdigest()
+        key = os.path.abspath(path)
+        # held across submit so _done cannot run before the entry exists
+        with self.lock:
+            try:
+                future = self.executor.submit(self._write, path, data, image)
+            except BaseException:
+                self.slots.release()
+                raise
+            self.pending[key] = (future, digest)
+            self.failed.pop(key, None)
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        self.slots.release()
+        with self.lock:
+            if self.pending.get(key, (None,))[0] is future:
+                del self.pending[key]
+                if future.exception() is not None:
+                    self.failed[key] = future.exception()
+        if future.exception() is not None:
+            print(f"Error saving image to {key}: {future.exception()}")
+
+    def pending_digest(self, path):
+        """sha256 of the bytes queued for path, or None if nothing is queued."""
+        with self.lock:
+            entry = self.pending.get(os.path.abspath(path))
+        return entry[1] if entry is not None else None
+
+    def wait(self, path):
+        """Block until a queued write of path is on disk; raises if the last write of path failed."""
+        key = os.path.abspath(path)
+        with self.lock:
+            entry = self.pending.get(key)
+        if entry is not None:
+            entry[0].result()
+            return
+        with self.lock:
+            error = self.failed.get(key)
+        if error is not None:
+            raise error
+
+    def flush(self):
+        """Wait for every queued write; raises the first failure among all writes not since redone."""
+        self._drain()
+        with self.lock:
+            error = next(iter(self.failed.values()), None)
+        if error is not None:
+            raise error
+
+    def _drain(self):
+        with self.lock:
+            futures = [future for future, _ in self.pending.values()]
+        for future in futures:
+            future.exception()
+
+    def close(self):
+        # failures were already reported by _done
+        self._drain()
+        self.executor.shutdown(wait=True)
+
+    @traced("write")
+    def _write(self, path, data, image):
+        current_span().set(bytes=len(data))
+        directory, name = os.path.split(path)
+        stem = os.path.splitext(name)[0]
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _atomic_write(path, lambda f: f.write(data))
+        if image is None or not (self.transcode or self.thumbnail_size or self.eval_size):
+            return
+        rgb = image if image.mode == "RGB" else image.convert("RGB")
+        if self.transcode:
+            fmt, ext = TRANSCODE_FORMATS[self.transcode]
+            _atomic_write(os.path.join(directory, stem + ext),
+                          lambda f: rgb.save(f, format=fmt, quality=self.quality))
+        if self.thumbnail_size:
+            preview = rgb.copy()
+            preview.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            _atomic_write(_derived_path(directory, PREVIEW_DIR, stem + ".jpg"),
+                          lambda f: preview.save(f, format="JPEG", quality=self.quality))
+        if self.eval_size:
+            crop = eval_crop(rgb, self.eval_size)
+            _atomic_write(_derived_path(directory, EVAL_DIR, stem + ".png"),
+                          lambda f: crop.save(f, format="PNG"))
+
+
+def eval_crop(image, size):
+    """Bicubic resize of the short side to size, then a center size x size crop (the evaluators' input)."""
+    from PIL import Image
+
+    scale = size / min(image.size)
+    width, height = max(size, round(image.width * scale)), max(size, round(image.height * scale))
+    resized = image.resize((width, height), Image.Resampling.BICUBIC, reducing_gap=3.0)
+    left, top = (width - size) // 2, (height - size) // 2
+    return resized.crop((left, top, left + size, top + size))
+
+
+def _derived_path(directory, subdir, name):
+    os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+    return os.path.join(directory, subdir, name)
+
+
+def _atomic_write(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+_writer = None
+_writer_options = {}
+_writer_lock = threading.Lock()
+
+
+def configure(**options):
+    """Set ImageWriter options (transcode, quality, thumbnail_size, eval_size, ...) before first use."""
+    global _writer_options
+    with _writer_lock:
+        if _writer is not None:
+            raise RuntimeError("image writer already started; configure it before the first download")
+        _writer_options = options
+
+
+def add_arguments(parser):
+    """Add the image writer's command-line options to an argparse parser."""
+    parser.add_argument("--transcode", choices=sorted(TRANSCODE_FORMATS),
+                        help="also write a WebP/JPEG copy of every downloaded image")
+    parser.add_argument("--quality", type=int, default=90, help="WebP/JPEG quality for --transcode and --previews")
+    parser.add_argument("--previews", type=int, metavar="SIZE", help=f"write {PREVIEW_DIR}/<name>.jpg thumbnails")
+    parser.add_argument("--eval-crops", type=int, metavar="SIZE",
+                        help=f"write {EVAL_DIR}/<name>.png evaluator-sized center crops, e.g. 224")
+
+
+def configure_from_args(args):
+    configure(transcode=args.transcode, quality=args.quality, thumbnail_size=args.previews, eval_size=args.eval_crops)
+
+
+def get_image_writer():
+    """Process-wide ImageWriter, created on first use and flushed at exit."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ImageWriter(**_writer_options)
+            atexit.register(_writer.close)
+        return _writer
+
+
+def pending_digest(path):
+    return _writer.pending_digest(path) if _writer is not None else None
+
+
+def wait_written(*paths):
+    """
+    Block until any queued writes of paths are on disk (no-op for files not
+    written here); raises the error of a write that failed.
+    """
+    if _writer is not None:
+        for path in paths:
+            _writer.wait(path)
@@ -0,0 +1,180 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import traced
+
+
+class LiveMetrics:
+    """
+    Embeds each accepted step on a background thread as the sequence is built and
+    keeps running DINO-I / CLIP-I / CLIP-T state (consecutive similarities and the
+    cumulative text embedding), so drift shows up right after the step that caused
+    it and the end-of-run report only has to reuse the stored features.
+
+    Steps are processed in submission order on a single worker; replace_last
+    swaps the newest step for a regenerated image, restore preloads the steps of
+    a resumed session and checkpoint hands the features to a session once every
+    queued step is embedded.
+    """
+    FEATURES = ("dino", "clip_image", "clip_text", "clip_step")
+
+    def __init__(self, warmup, goal_text):
+        self.warmup = warmup
+        self.goal_text = goal_text
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-metrics")
+        self.lock = threading.Lock()
+        self.pending = []
+        self.error = None
+        # per-step features and running-state contributions
+        self.steps = []
+
+    def add(self, image, prompt, path=None):
+        """Queue an accepted step (PIL image + its prompt) for embedding."""
+        self._submit(self._push, image, prompt)
+
+    def replace_last(self, image, prompt=None, path=None):
+        """Queue a regenerated image for the newest step, keeping its prompt unless a new one is given."""
+        self._submit(self._replace, image, prompt)
+
+    def restore(self, prompts, paths=None, features=None):
+        """Queue already accepted steps, embedding only those without stored features."""
+        self._submit(self._restore, prompts, paths, features)
+
+    def checkpoint(self, callback):
+        """Queue callback(features, scores) to run once every step queued so far is embedded."""
+        self._submit(self._checkpoint, callback)
+
+    def _submit(self, fn, *args):
+        ctx = contextvars.copy_context()
+        self.pending.append(self.executor.submit(ctx.run, self._guarded, fn, *args))
+
+    def _guarded(self, fn, *args):
+        if self.error is not None:
+            return
+        try:
+            fn(*args)
+        except Exception as e:
+            self.error = e
+
+    @traced("live_metrics")
+    def _embed(self, image, prompt):
+        dino_evaluator, clip_evaluator = self.warmup.get()
+        text_features = clip_evaluator.extract_clip_text_features([prompt, f"{self.goal_text}. {prompt}"])
+        return {
+            "prompt": prompt,
+            "dino": dino_evaluator.extract_dino_features([image])[0],
+            "clip_image": clip_evaluator.extract_clip_image_features([image])[0],
+            "clip_text": text_features[0],
+            "clip_step": text_features[1],
+        }
+
+    def _push(self, image, prompt):
+        self._append(self._embed(image, prompt))
+
+    def _append(self, step):
+        import torch.nn.functional as F
+
+        with self.lock:
+            prev = self.steps[-1] if self.steps else None
+            step["text_sum"] = step["clip_text"] + (prev["text_sum"] if prev is not None else 0)
+            cumulative_text = F.normalize(step["text_sum"], p=2, dim=0)
+            step["clip_t"] = (step["clip_image"] * cumulative_text).sum().item()
+            step["dino_sim"] = (step["dino"] * prev["dino"]).sum().item() if prev is not None else None
+            step["clip_sim"] = (step["clip_image"] * prev["clip_image"]).sum().item() if prev is not None else None
+            self.steps.append(step)
+
+    def _restore(self, prompts, paths, features):
+        import torch
+        from PIL import Image
+
+        num_stored = len(features["dino"]) if features is not None else 0
+        if num_stored:
+            # stored features are CPU arrays; new ones are on the evaluators' devices
+            dino_evaluator, clip_evaluator = self.warmup.get()
+            devices = {name: clip_evaluator.device for name in self.FEATURES}
+            devices["dino"] = dino_evaluator.device
+        for i, prompt in enumerate(prompts):
+            if i < num_stored:
+                step = {name: torch.from_numpy(features[name][i]).to(devices[name]) for name in self.FEATURES}
+                self._append(dict(step, prompt=prompt))
+            else:
+                with Image.open(paths[i]) as img:
+                    self._push(img.convert("RGB"), prompt)
+
+    def _checkpoint(self, callback):
+        callback({name: value.detach().cpu().numpy() for name, value in self._stack().items()}, self.scores())
+
+    def _replace(self, image, prompt):
+        with self.lock:
+            if not self.steps:
+                raise RuntimeError("replace_last called before any step was added")
+            last = self.steps.pop()
+        self._push(image, prompt if prompt is not None else last["prompt"])
+
+    def scores(self):
+        """Running scores over the steps embedded so far (does not wait for pending ones)."""
+        with self.lock:
+            steps = list(self.steps)
+        pairs = steps[1:]
+        clip_i = sum(s["clip_sim"] for s in pairs) / len(pairs) if pairs else 0.0
+        dino_i = sum(s["dino_sim"] for s in pairs) / len(pairs) if pairs else 0.0
+        clip_t = sum(s["clip_t"] for s in steps) / len(steps) if steps else 0.0
+        return {
+            "steps": len(steps),
+            "dino_i": dino_i,
+            "clip_i": clip_i,
+            "clip_t": clip_t,
+            "clip_star": clip_i * clip_t,
+            "dino_star": dino_i * clip_t,
+            "last_dino_sim": pairs[-1]["dino_sim"] if pairs else None,
+            "last_clip_t": steps[-1]["clip_t"] if steps else None,
+        }
+
+    def show(self):
+        if self.error is not None:
+            print(f"[live metrics unavailable: {self.error}]")
+            return
+        scores = self.scores()
+        if not scores["steps"]:
+            print("[live metrics: first step still embedding]")
+            return
+        waiting = sum(not f.done() for f in self.pending)
+        line = (f"[live metrics, {scores['steps']} step(s)] DINO-I {scores['dino_i']:.3f}  "
+                f"CLIP-I {scores['clip_i']:.3f}  CLIP-T {scores['clip_t']:.3f}")
+        if scores["last_dino_sim"] is not None:
+            line += f"  | last step: DINO sim {scores['last_dino_sim']:.3f}, CLIP-T {scores['last_clip_t']:.3f}"
+        if waiting:
+            line += f"  ({waiting} update(s) pending)"
+        print(line)
+
+    def features(self):
+        """
+        Wait for pending steps and return features in the extract_sequence_features
+        format, ready for eval_report.report_from_features.
+        """
+        import torch
+
+        for future in self.pending:
+            future.result()
+        if self.error is not None:
+            raise RuntimeError(f"live metrics failed: {self.error}") from self.error
+        return self._stack()
+
+    def _stack(self):
+        import torch
+
+        with self.lock:
+            steps = list(self.steps)
+        return {name: torch.stack([s[name] for s in steps]) for name in self.FEATURES}
+
+    def report(self, all_goal_texts=None, num_distractors=1):
+        """The full eval_report sequence report, from the already embedded steps."""
+        from eval_report import report_from_features
+
+        dino_evaluator, clip_evaluator = self.warmup.get()
+        return report_from_features(dino_evaluator, clip_evaluator, self.features(), self.goal_text,
+                                    all_goal_texts, num_distractors)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
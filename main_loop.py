@@ -1,107 +1,199 @@
+import argparse
+import asyncio
 from image_gen import image_generator
 from image_edit import image_editor
 from prompt_rewriter import prompt_rewriter
 import os
 from utils import encode_file
-from PIL import Image
-from dino_eval import DinoEval
-from clip_eval import CLIPEvaluator
+from eval_report import print_report
+from model_warmup import ModelWarmup
+from live_metrics import LiveMetrics
 from vlm_analyzer import vlm_analyzer
+from async_engine import AsyncEngine
+from candidate_ranker import best_of_n
+from consistency_checker import BackgroundConsistencyChecker, format_result
+from pipeline_service import ServiceClient, ServiceProxy, ServiceLiveMetrics
+from session import SequenceSession
+from image_store import SequenceImageStore
+from draft import DraftFrame, new_seed
+import image_writer
+import tracing
 
 
-def main():
+def pick_best_candidate(engine, warmup, step_num, prompt, output_dir, num_candidates,
+                        prev_image=None, source_url=None, service=None, draft=False, source_image=None):
+    """
+    Run best-of-N for one step (here or on the pipeline service) and return the
+    selected candidate (see candidate_ranker.best_of_n), or None if all failed.
+    Candidates are ranked against prev_image and edited from source_url, or from
+    source_image if it has expired.
+    """
+    if service is not None:
+        best = service.run("best_of_n", {
+            "step_num": step_num, "prompt": prompt, "output_dir": os.path.abspath(output_dir),
+            "n": num_candidates, "prev_image": os.path.abspath(prev_image) if prev_image else None,
+            "source_url": source_url, "draft": draft,
+            "source_image": os.path.abspath(source_image) if source_image else None,
+        })
+    else:
+        evaluator, clip_evaluator = warmup.get()
+        best = asyncio.run(best_of_n(engine, evaluator, clip_evaluator, step_num, prompt, output_dir,
+                                     num_candidates, prev_image, source_url, draft=draft, source_image=source_image))
+    if best is None:
+        return None
+    print(f"Other candidates kept in {output_dir}/candidates/")
+    return best
+
+
+def main(num_candidates=1, vlm_window=0, service_url=None, resume_dir=None, draft=False):
     """
     Interactive workflow for generating sequential images with consistent style.
+    With num_candidates > 1, every step issues that many requests in parallel
+    and the best DINO/CLIP scoring candidate is selected automatically.
+    With vlm_window > 0, each accepted step is VLM-checked in the background
+    against the previous vlm_window steps while the next step is being made.
+    With service_url, every remote call and all model work go to a running
+    pipeline_service, so nothing is loaded in this process.
+    Every accepted step is checkpointed to session.json in the output directory;
+    with resume_dir, an interrupted session continues at its next step without
+    regenerating or re-embedding the steps already accepted.
+    With draft, steps after the first are reviewed as low-resolution previews and
+    only the accepted one is rendered at full size with the same prompt and seed.
     """
     print("="*70)
     print("INTERACTIVE IMAGE SEQUENCE GENERATOR")
     print("="*70)
     
 
-    generator = image_generator()
-    editor = image_editor()
-    rewriter = prompt_rewriter()
-    evaluator = DinoEval()
-    clip_evaluator = CLIPEvaluator()
-    vlm = vlm_analyzer()
-    
-    output_dir = input("specify output directory: ")
-    os.makedirs(output_dir, exist_ok=True)
-    
+    service = ServiceClient(service_url) if service_url else None
+    if service is not None:
+        warmup = None
+        generator = editor = rewriter = vlm = ServiceProxy(service)
+    else:
+        # DINO/CLIP load in the background; they are only needed for ranking and the final report
+        warmup = ModelWarmup().start()
+        generator = image_generator()
+        editor = image_editor()
+        rewriter = prompt_rewriter()
+        vlm = vlm_analyzer()
+    engine = AsyncEngine(generator, editor, rewriter, vlm, max_concurrency=max(num_candidates, 1))
+    checker = BackgroundConsistencyChecker(vlm, vlm_window) if vlm_window > 0 else None
     
-    print("\n[STEP 1] Setup")
-    print("-"*70)
-    num_steps = int(input("How many steps in your sequence? "))
-    print(f"You will create {num_steps} images.\n")
+    if resume_dir:
+        output_dir = resume_dir
+        session = SequenceSession.load(output_dir)
+        session.verify()
+        num_steps, goal_step = session.num_steps, session.goal
+        print(f"Resuming {output_dir} at step {session.next_step}/{num_steps}")
+        tracing.set_context(sequence=output_dir)
+    else:
+        output_dir = input("specify output directory: ")
+        os.makedirs(output_dir, exist_ok=True)
+        if SequenceSession.exists(output_dir):
+            print(f"Starting over; use --resume {output_dir} to continue the session saved there instead")
+        session = SequenceSession(output_dir)
 
-    goal_step = input("input goal: ")
+        print("\n[STEP 1] Setup")
+        print("-"*70)
+        num_steps = int(input("How many steps in your sequence? "))
+        print(f"You will create {num_steps} images.\n")
+
+        goal_step = input("input goal: ")
+        session.start(goal_step, num_steps)
+    # accepted steps are embedded in the background as the sequence grows
+    live = ServiceLiveMetrics(service, goal_step) if service is not None else LiveMetrics(warmup, goal_step)
     
     
-    images = []
-    prompts = []
-    edit_prompts = []
-    pil_images = []
+    images = [step["path"] for step in session.steps]
+    prompts = [step["prompt"] for step in session.steps]
+    edit_prompts = list(session.state["edit_prompts"])
+    # decoded lazily; full frames and evaluator thumbnails share a bounded cache
+    store = SequenceImageStore(images)
+    # hosted copies of the accepted steps are reused while their URLs are valid
+    edit_url = session.restore_urls()
+    if images:
+        live.restore(prompts, images, session.features())
     
     
-    print("\n[STEP 2] First Prompt")
-    print("-"*70)
-    user_prompt = input("Enter your first image description: ")
+    if not images:
+        print("\n[STEP 2] First Prompt")
+        print("-"*70)
+        user_prompt = input("Enter your first image description: ")
     
     
-    print("\nRewriting prompt with vintage cartoon style...")
-    enhanced_prompt = rewriter.rewrite_prompt(user_prompt)
+        print("\nRewriting prompt with vintage cartoon style...")
+        enhanced_prompt = rewriter.rewrite_prompt(user_prompt)
     
    
-    print("\n[STEP 3] Prompt Validation")
-    print("-"*70)
-    print("Enhanced prompt:")
-    print(f"\n{enhanced_prompt}\n")
-    proceed = input("Generate image with this prompt? (y/n): ").strip().lower()
-    
-    if proceed != 'y':
-        enhanced_prompt = input("Please input propt to pass to generator")
-    
-    prompts.append(enhanced_prompt)
-    
-    
-    print("\n[STEP 4] Generating Image")
-    print("-"*70)
-    first_image = f"{output_dir}/step_1.png"
-    print(f"Generating image 1/{num_steps}...")
-    edit_url = generator.generate_image(enhanced_prompt, first_image)
-    images.append(first_image)
-    image = Image.open(first_image)
-    image.show()
-    pil_images.append(Image.open(first_image))
-    
-    print("\n[STEP 5] Image Validation")
-    print("-"*70)
-    print(f"Image saved to: {first_image}")
-    proceed = input("Does the image look good? Continue to next step? (y/n): ").strip().lower()
-    
-    while proceed != 'y':
-        edit = input("Would you like to regenerate this image with edits? (y/n)").strip().lower()
-        if edit != 'y':
-            print('exiting')
-            return
-        edit_prompt = input("Input prompt to edit image")
-        edit_prompts.append(edit_prompt)
-        editor.edit_image(first_image, edit_prompt, first_image, edit_url)
-        image = Image.open(first_image)
-        pil_images[0] = Image.open(first_image)
-        image.show()
-        proceed = input("does this image look good? Continue to next step (y/n)")
+        print("\n[STEP 3] Prompt Validation")
+        print("-"*70)
+        print("Enhanced prompt:")
+        print(f"\n{enhanced_prompt}\n")
+        proceed = input("Generate image with this prompt? (y/n): ").strip().lower()
+    
+        if proceed != 'y':
+            enhanced_prompt = input("Please input propt to pass to generator")
+    
+        prompts.append(enhanced_prompt)
+    
+    
+        print("\n[STEP 4] Generating Image")
+        print("-"*70)
+        first_image = f"{output_dir}/step_1.png"
+        tracing.set_context(sequence=output_dir, step=1)
+        print(f"Generating image 1/{num_steps}...")
+        if num_candidates > 1:
+            best = pick_best_candidate(engine, warmup, 1, enhanced_prompt, output_dir, num_candidates,
+                                       service=service)
+            edit_url = best["url"] if best else None
+            image = None
+        else:
+            edit_url, image = generator.generate_image(enhanced_prompt, first_image, return_image=True)
+        first_url = edit_url
+        images.append(first_image)
+        store.add(first_image, image)
+        store.show(0)
+        live.add(store.thumbnail(0), enhanced_prompt, first_image)
+    
+        print("\n[STEP 5] Image Validation")
+        print("-"*70)
+        print(f"Image saved to: {first_image}")
+        proceed = input("Does the image look good? Continue to next step? (y/n): ").strip().lower()
+    
+        while proceed != 'y':
+            edit = input("Would you like to regenerate this image with edits? (y/n)").strip().lower()
+            if edit != 'y':
+                print('exiting')
+                return
+            edit_prompt = input("Input prompt to edit image")
+            edit_prompts.append(edit_prompt)
+            session.add_edit_prompt(edit_prompt)
+            first_url, image = editor.edit_image(first_image, edit_prompt, first_image, edit_url, return_image=True)
+            store.replace(0, first_image, image)
+            live.replace_last(store.thumbnail(0), path=first_image)
+            store.show(0)
+            proceed = input("does this image look good? Continue to next step (y/n)")
+        # later steps edit the accepted step 1, so the URL must show the same image as images[0]
+        edit_url = first_url
+        session.accept_step(1, first_image, enhanced_prompt, first_url, edit_url=edit_url)
+        live.checkpoint(session.save_features)
 
-    prev_prompt = enhanced_prompt
+    prev_prompt = prompts[-1]
     
     
-    for step_num in range(2, num_steps + 1):
+    for step_num in range(len(images) + 1, num_steps + 1):
+        tracing.set_context(step=step_num)
         print("\n" + "="*70)
         print(f"[STEP {step_num}] Next Image in Sequence")
         print("="*70)
+        live.show()
+        if checker is not None:
+            checker.poll()
         
  
-        prev_image = images[-1]
+        # every step is an edit of the accepted step 1: edit_url is its hosted copy, and its
+        # file stands in when that URL has expired (and is what drafts are rendered from)
+        source_image = images[0]
         user_prompt = input(f"\nDescribe what happens in step {step_num}: ")
         
         # # Rewrite prompt
@@ -121,37 +213,74 @@ def main():
         print(f"\nGenerating image {step_num}/{num_steps} based on previous image...")
         next_image = f"{output_dir}/step_{step_num}.png"
         prev_url = edit_url
-        cur_url = editor.edit_image(prev_image, enhanced_prompt, next_image, edit_url)
+        # with draft, every edit below is a preview that is replayed at full size on accept
+        frame = DraftFrame(next_image) if draft else None
+        if num_candidates > 1:
+            best = pick_best_candidate(engine, warmup, step_num, enhanced_prompt, output_dir,
+                                       num_candidates, images[-1], edit_url, service, draft, source_image)
+            cur_url = best["url"] if best else None
+            if frame is not None and best:
+                frame.edit(source_image, enhanced_prompt, best["seed"])
+            image = None
+        else:
+            seed = new_seed() if draft else None
+            cur_url, image = editor.edit_image(source_image, enhanced_prompt, next_image, edit_url, return_image=True,
+                                               seed=seed, draft=draft)
+            if frame is not None:
+                frame.edit(source_image, enhanced_prompt, seed)
         images.append(next_image)
         
         
         print(f"\nImage saved to: {next_image}")
-        image = Image.open(next_image)
-        image.show()
-        pil_images.append(image)
+        index = store.add(next_image, image)
+        store.show(index)
+        live.add(store.thumbnail(index), enhanced_prompt, next_image)
         proceed = input("Continue to next step? (y/n): ").strip().lower()
-        # print("VLM evaluation -----------------------------------------")
-        # vlm.check_image_consistency(images[-2], prompts[-2], images[-1], prompts[-1])
         
         while proceed != 'y':
             edit = input("Would you like to regenerate this image with edits? (y/n)").strip().lower()
             if edit != 'y':
                 print("now editing previous one")
                 edit_prmpt = input("input prompt to regenerate image")
-                edit_prompts.append(edit_prompt)
-                cur_url = editor.edit_image(image, edit_prmpt, next_image, cur_url)
-                image = Image.open(next_image)
-                image.show()
-                pil_images[-1] = image
+                edit_prompts.append(edit_prmpt)
+                session.add_edit_prompt(edit_prmpt)
+                seed = new_seed() if draft else None
+                cur_url, image = editor.edit_image(next_image, edit_prmpt, next_image, cur_url, return_image=True,
+                                                   seed=seed, draft=draft)
+                if frame is not None:
+                    frame.refine(edit_prmpt, seed)
+                store.replace(index, next_image, image)
+                store.show(index)
+                live.replace_last(store.thumbnail(index), path=next_image)
                 proceed = input("does this image look good (y/n)?")
             if edit == 'y':
                 edit_prompt = input("Input prompt to regenerate image")
                 edit_prompts.append(edit_prompt)
-                cur_url = editor.edit_image(prev_image, edit_prompt, next_image, prev_url)
-                image = Image.open(next_image)
-                image.show()
-                pil_images[-1] = image
+                session.add_edit_prompt(edit_prompt)
+                seed = new_seed() if draft else None
+                cur_url, image = editor.edit_image(source_image, edit_prompt, next_image, prev_url, return_image=True,
+                                                   seed=seed, draft=draft)
+                if frame is not None:
+                    frame.edit(source_image, edit_prompt, seed)
+                store.replace(index, next_image, image)
+                store.show(index)
+                live.replace_last(store.thumbnail(index), path=next_image)
                 proceed = input("does this image look good? Continue to next step (y/n)")
+
+        if frame is not None and frame.ops:
+            print(f"Rendering step {step_num} at full resolution...")
+            full_url, image = frame.promote(editor, return_image=True)
+            if full_url is None:
+                print("full-resolution render failed; keeping the draft")
+            else:
+                cur_url = full_url
+                store.replace(index, next_image, image)
+                live.replace_last(store.thumbnail(index), path=next_image)
+        session.accept_step(step_num, next_image, enhanced_prompt, cur_url)
+        live.checkpoint(session.save_features)
+        if checker is not None:
+            # runs while the next step is described, generated and reviewed
+            checker.submit_step(images, prompts)
     
 
     print("\n" + "="*70)
@@ -171,19 +300,38 @@ def main():
     print("="*70)
 
     print("evaluating images")
-    dino_i = evaluator.compute_dino_i(pil_images)
-    clip_t = clip_evaluator.compute_clip_t(pil_images, prompts)
-    clip_star = clip_evaluator.compute_clip_star(pil_images, prompts)
-
-    dino_star = dino_i * clip_t
-    print("DINO-i", dino_i)
-    print("CLIP-star", clip_star)
-    print("DINO-star", dino_star)
-
-    goal_faithfulness = clip_evaluator.compute_goal_faithfulness(pil_images, goal_step, prompts, 1)
+    tracing.set_context(step=None)
+    # every accepted image was already embedded by the live tracker
+    report = live.report(prompts, 1)
+    live.close()
+    store.close()
+    print_report(report)
 
-    print("goal faithfulness ", goal_faithfulness)
+    if checker is not None:
+        print("\nVLM consistency checks:")
+        for result in checker.results():
+            print("  " + format_result(result))
+        checker.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Interactive image sequence generator")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="parallel candidates per step, best one is auto-selected")
+    parser.add_argument("--vlm-window", type=int, default=0,
+                        help="VLM-check each accepted step against this many previous steps in the background")
+    parser.add_argument("--service", help="use a running pipeline_service, e.g. http://127.0.0.1:8765 "
+                                          "or unix:///tmp/pipeline.sock")
+    parser.add_argument("--draft", action="store_true",
+                        help="review edits as low-resolution drafts; accepted steps are re-rendered at full size")
+    image_writer.add_arguments(parser)
+    parser.add_argument("--resume", metavar="OUTPUT_DIR",
+                        help="continue the checkpointed session in this output directory")
+    parser.add_argument("--trace", help="append per-stage spans to this JSONL file")
+    parser.add_argument("--metrics", help="write a Prometheus text snapshot of stage timings here at exit")
+    args = parser.parse_args()
+    if args.trace or args.metrics:
+        tracing.configure(args.trace, args.metrics)
+    image_writer.configure_from_args(args)
+    main(num_candidates=args.candidates, vlm_window=args.vlm_window, service_url=args.service,
+         resume_dir=args.resume, draft=args.draft)
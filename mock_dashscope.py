@@ -0,0 +1,265 @@
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def make_png(width, height, seed=0):
+    """Small-to-encode PNG of the given size: horizontal colour bands derived from seed."""
+    rng = random.Random(seed)
+    base = [rng.randrange(256) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        shade = (y * 255) // max(height - 1, 1)
+        pixel = bytes(((c + shade) % 256) for c in base)
+        rows.append(b"\x00" + pixel * width)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class MockConfig:
+    """Latencies are in seconds; jitter is a +/- fraction of each latency."""
+    def __init__(self, text_latency=1.0, generate_latency=8.0, edit_latency=6.0, vlm_latency=3.0,
+                 download_latency=0.05, jitter=0.2, error_rate=0.0, rate_limit=0.0, url_ttl=24 * 60 * 60):
+        self.text_latency = text_latency
+        self.generate_latency = generate_latency
+        self.edit_latency = edit_latency
+        self.vlm_latency = vlm_latency
+        self.download_latency = download_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # requests per second admitted before answering 429; 0 disables the limit
+        self.rate_limit = rate_limit
+        self.url_ttl = url_ttl
+
+
+class MockDashScope:
+    """
+    Local stand-in for the DashScope endpoints this repo uses: text generation,
+    multimodal generation (image generate/edit and VLM), upload policy + OSS upload
+    and hosting of the generated images. Point the clients at it by setting
+    DASHSCOPE_BASE_URL to base_url before constructing them.
+    """
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self.images = {}
+        self.png_cache = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0}
+        # a bucket smaller than one request would throttle everything below 1 req/s
+        self.burst = max(1.0, self.config.rate_limit)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def root_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        return self.root_url + "/api/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-dashscope", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _sleep(self, latency):
+        if latency > 0:
+            time.sleep(max(0.0, latency * (1 + random.uniform(-self.config.jitter, self.config.jitter))))
+
+    def _admit(self):
+        """Returns None if the request may proceed, else an (http status, code, message) error."""
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.config.rate_limit > 0:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last_refill) * self.config.rate_limit)
+                self.last_refill = now
+                if self.tokens < 1.0:
+                    self.stats["throttled"] += 1
+                    return 429, "Throttling.RateQuota", "Requests rate limit exceeded, please try again later."
+                self.tokens -= 1.0
+            if random.random() < self.config.error_rate:
+                self.stats["errors"] += 1
+                return 500, "InternalError", "Mock injected failure."
+        return None
+
+    def _host_image(self, size, seed):
+        width, height = (int(v) for v in size.split("*"))
+        key = (width, height, seed % 16)
+        with self.lock:
+            png = self.png_cache.get(key)
+        if png is None:
+            png = make_png(width, height, seed % 16)
+            with self.lock:
+                self.png_cache[key] = png
+        image_id = uuid.uuid4().hex
+        with self.lock:
+            self.images[image_id] = png
+        expires = int(time.time() + self.config.url_ttl)
+        return f"{self.root_url}/images/{image_id}.png?Expires={expires}"
+
+    def _multimodal(self, body):
+        model = body.get("model", "")
+        parameters = body.get("parameters", {})
+        messages = body.get("input", {}).get("messages", [])
+        content = messages[-1].get("content", []) if messages else []
+        text = " ".join(item.get("text", "") for item in content if isinstance(item, dict))
+
+        if "image" in model:
+            self._sleep(self.config.edit_latency if "edit" in model else self.config.generate_latency)
+            seed = parameters.get("seed", zlib.crc32(text.encode("utf-8")))
+            url = self._host_image(parameters.get("size", "1328*1328"), seed)
+            result = [{"image": url}]
+            usage = {"width": 0, "height": 0, "image_count": 1}
+        else:
+            self._sleep(self.config.vlm_latency)
+            result = [{"text": "PASS: 1. yes 2. yes 3. yes 5. yes 6. yes 7. yes (mock verdict)"}]
+            usage = {"input_tokens": len(text.split()), "output_tokens": 16}
+        return {
+            "output": {"choices": [{"finish_reason": "stop", "message": {"role": "assistant", "content": result}}]},
+            "usage": usage,
+        }
+
+    def _text_generation(self, body):
+        self._sleep(self.config.text_latency)
+        messages = body.get("input", {}).get("messages", [])
+        user = messages[-1].get("content", "") if messages else ""
+        rewritten = f"{user}, newspaper cartoon style, digitally colored, NO TEXT"
+        return {
+            "output": {"choices": [{"finish_reason": "stop", "message": {"role": "assistant", "content": rewritten}}]},
+            "usage": {"input_tokens": len(user.split()), "output_tokens": len(rewritten.split())},
+        }
+
+    def _upload_policy(self):
+        return {
+            "data": {
+                "policy": "mock-policy",
+                "signature": "mock-signature",
+                "upload_dir": f"mock/{uuid.uuid4().hex}",
+                "upload_host": self.root_url + "/oss",
+                "expire_in_seconds": 300,
+                "max_file_size_mb": 100,
+                "capacity_limit_mb": 999999,
+                "oss_access_key_id": "mock-key",
+                "x_oss_object_acl": "private",
+                "x_oss_forbid_overwrite": "true",
+            }
+        }
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _error(self, status, code, message):
+                self._send(status, {"request_id": uuid.uuid4().hex, "code": code, "message": message})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith("/images/"):
+                    image_id = url.path[len("/images/"):].split(".")[0]
+                    with mock.lock:
+                        png = mock.images.get(image_id)
+                    if png is None:
+                        return self._error(404, "NotFound", "No such image.")
+                    mock._sleep(mock.config.download_latency)
+                    return self._send(200, png, "image/png")
+                if url.path == "/api/v1/uploads" and parse_qs(url.query).get("action") == ["getPolicy"]:
+                    body = mock._upload_policy()
+                    body["request_id"] = uuid.uuid4().hex
+                    return self._send(200, body)
+                self._error(404, "NotFound", f"Unknown path {url.path}")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length) if length else b""
+                if url.path == "/oss":
+                    return self._send(200, b"", "text/plain")
+
+                error = mock._admit()
+                if error is not None:
+                    return self._error(*error)
+                try:
+                    body = json.loads(raw or b"{}")
+                except ValueError:
+                    return self._error(400, "InvalidParameter", "Body is not JSON.")
+
+                if url.path == "/api/v1/services/aigc/text-generation/generation":
+                    result = mock._text_generation(body)
+                elif url.path == "/api/v1/services/aigc/multimodal-generation/generation":
+                    result = mock._multimodal(body)
+                else:
+                    return self._error(404, "NotFound", f"Unknown path {url.path}")
+                result["request_id"] = uuid.uuid4().hex
+                self._send(200, result)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local DashScope stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--text-latency", type=float, default=1.0)
+    parser.add_argument("--generate-latency", type=float, default=8.0)
+    parser.add_argument("--edit-latency", type=float, default=6.0)
+    parser.add_argument("--vlm-latency", type=float, default=3.0)
+    parser.add_argument("--download-latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests/second, 0 = unlimited")
+    args = parser.parse_args()
+
+    config = MockConfig(args.text_latency, args.generate_latency, args.edit_latency, args.vlm_latency,
+                        args.download_latency, args.jitter, args.error_rate, args.rate_limit)
+    mock = MockDashScope(config, args.host, args.port)
+    print(f"mock DashScope listening, export DASHSCOPE_BASE_URL={mock.base_url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import torch
+
+from tracing import traced
+
+
+SNAPSHOT_FORMAT_VERSION = 1
+DINO_HUB_REPO = "facebookresearch/dinov2"
+DINO_MODEL = "dinov2_vitb14"
+
+
+def default_snapshot_dir():
+    """Snapshot root used when none is passed explicitly (MODEL_SNAPSHOT_DIR), or None."""
+    return os.getenv("MODEL_SNAPSHOT_DIR")
+
+
+def _model_dir(snapshot_dir, model_name):
+    return os.path.join(snapshot_dir, model_name.replace("/", "__"))
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_manifest(model_dir, manifest):
+    manifest = dict(manifest, format_version=SNAPSHOT_FORMAT_VERSION,
+                    torch_version=torch.__version__, created_at=time.time())
+    tmp_path = os.path.join(model_dir, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(model_dir, "manifest.json"))
+
+
+def _read_manifest(model_dir):
+    path = os.path.join(model_dir, "manifest.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"no model snapshot at {model_dir}, run `python model_snapshot.py export` first")
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"snapshot {model_dir} has format version {manifest.get('format_version')}, "
+                         f"expected {SNAPSHOT_FORMAT_VERSION}; re-export it")
+    return manifest
+
+
+def has_snapshot(snapshot_dir, model_name):
+    return bool(snapshot_dir) and os.path.exists(os.path.join(_model_dir(snapshot_dir, model_name), "manifest.json"))
+
+
+def export_dino_snapshot(snapshot_dir, dino_model=None):
+    """
+    Store dinov2 as hub code + a plain state dict, so it can be rebuilt without
+    network access or the torch hub cache and its weights memory-mapped on load.
+    """
+    if dino_model is None:
+        dino_model = torch.hub.load(DINO_HUB_REPO, DINO_MODEL)
+    model_dir = _model_dir(snapshot_dir, DINO_MODEL)
+    code_dir = os.path.join(model_dir, "code")
+    os.makedirs(model_dir, exist_ok=True)
+
+    hub_code = os.path.join(torch.hub.get_dir(), DINO_HUB_REPO.replace("/", "_") + "_main")
+    if os.path.exists(code_dir):
+        shutil.rmtree(code_dir)
+    shutil.copytree(hub_code, code_dir, ignore=shutil.ignore_patterns(".git", "__pycache__"))
+
+    weights_path = os.path.join(model_dir, "weights.pt")
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in dino_model.state_dict().items()}
+    torch.save(state_dict, weights_path)
+    _write_manifest(model_dir, {"model": DINO_MODEL, "weights_sha256": _sha256(weights_path)})
+    return model_dir
+
+
+@traced("snapshot_load", model=DINO_MODEL)
+def load_dino_snapshot(snapshot_dir, device="cpu"):
+    """Rebuild dinov2 from a snapshot with mmap'd weights (pages shared between processes)."""
+    model_dir = _model_dir(snapshot_dir, DINO_MODEL)
+    _read_manifest(model_dir)
+    model = torch.hub.load(os.path.join(model_dir, "code"), DINO_MODEL, source="local", pretrained=False)
+    state_dict = torch.load(os.path.join(model_dir, "weights.pt"), map_location="cpu", mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device).eval()
+
+
+def export_clip_snapshot(snapshot_dir, model_name="openai/clip-vit-base-patch32"):
+    """Store the CLIP model as safetensors plus its processor config."""
+    from transformers import CLIPModel, CLIPProcessor
+
+    model_dir = _model_dir(snapshot_dir, model_name)
+    os.makedirs(model_dir, exist_ok=True)
+    CLIPModel.from_pretrained(model_name).save_pretrained(model_dir, safe_serialization=True)
+    CLIPProcessor.from_pretrained(model_name).save_pretrained(model_dir)
+    weights = sorted(f for f in os.listdir(model_dir) if f.endswith(".safetensors"))
+    _write_manifest(model_dir, {
+        "model": model_name,
+        "weights_sha256": {f: _sha256(os.path.join(model_dir, f)) for f in weights},
+    })
+    return model_dir
+
+
+@traced("snapshot_load")
+def load_clip_snapshot(snapshot_dir, model_name="openai/clip-vit-base-patch32"):
+    """Load CLIP from a snapshot; safetensors weights are memory-mapped, no hub access."""
+    from transformers import CLIPModel, CLIPProcessor
+
+    model_dir = _model_dir(snapshot_dir, model_name)
+    _read_manifest(model_dir)
+    model = CLIPModel.from_pretrained(model_dir, local_files_only=True, use_safetensors=True)
+    processor = CLIPProcessor.from_pretrained(model_dir, local_files_only=True)
+    return model, processor
+
+
+def verify_snapshot(snapshot_dir, model_name):
+    """Check a snapshot's weights against the hashes recorded at export."""
+    model_dir = _model_dir(snapshot_dir, model_name)
+    manifest = _read_manifest(model_dir)
+    expected = manifest["weights_sha256"]
+    if isinstance(expected, str):
+        expected = {"weights.pt": expected}
+    for filename, digest in expected.items():
+        if _sha256(os.path.join(model_dir, filename)) != digest:
+            raise ValueError(f"{model_dir}/{filename} does not match its manifest hash")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or verify offline DINO/CLIP model snapshots")
+    parser.add_argument("command", choices=["export", "verify"])
+    parser.add_argument("--out", default=default_snapshot_dir(), help="snapshot root (default: $MODEL_SNAPSHOT_DIR)")
+    parser.add_argument("--clip-model", default="openai/clip-vit-base-patch32")
+    args = parser.parse_args()
+    if not args.out:
+        parser.error("--out or MODEL_SNAPSHOT_DIR is required")
+
+    if args.command == "export":
+        print("exported", export_dino_snapshot(args.out))
+        print("exported", export_clip_snapshot(args.out, args.clip_model))
+    else:
+        for model_name in (DINO_MODEL, args.clip_model):
+            manifest = verify_snapshot(args.out, model_name)
+            print(f"{model_name}: ok (format {manifest['format_version']}, torch {manifest['torch_version']})")
+
+
+if __name__ == "__main__":
+    main()
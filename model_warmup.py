@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class ModelWarmup:
+    """
+    Imports torch/transformers and builds DinoEval and CLIPEvaluator on a
+    background thread, so interactive prompts and remote generation are not
+    held up by model loading. get() blocks only if loading is still running.
+    """
+    def __init__(self, dino_kwargs=None, clip_kwargs=None):
+        self.dino_kwargs = dino_kwargs or {}
+        self.clip_kwargs = clip_kwargs or {}
+        self.dino_evaluator = None
+        self.clip_evaluator = None
+        self.error = None
+        self.load_seconds = None
+        self.thread = threading.Thread(target=self._load, name="model-warmup", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            from dino_eval import DinoEval
+            from clip_eval import CLIPEvaluator
+
+            self.dino_evaluator = DinoEval(**self.dino_kwargs)
+            self.clip_evaluator = CLIPEvaluator(**self.clip_kwargs)
+        except Exception as e:
+            self.error = e
+        self.load_seconds = time.perf_counter() - start
+
+    @property
+    def ready(self):
+        return not self.thread.is_alive() and self.thread.ident is not None
+
+    def get(self):
+        """Return (DinoEval, CLIPEvaluator), waiting for warm-up to finish if needed."""
+        if self.thread.ident is None:
+            self.start()
+        if self.thread.is_alive():
+            print("waiting for evaluation models to finish loading...")
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"evaluation model warm-up failed: {self.error}") from self.error
+        return self.dino_evaluator, self.clip_evaluator
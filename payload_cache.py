@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from calendar import timegm
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from image_writer import pending_digest, wait_written
+from utils import encode_file
+
+
+# DashScope result URLs are valid for 24 hours
+DEFAULT_URL_TTL = 24 * 60 * 60
+# files uploaded to DashScope's temporary OSS storage are kept for 48 hours
+UPLOAD_TTL = 48 * 60 * 60
+
+
+def file_digest(file_path):
+    # a file still queued on the image writer hashes to the bytes being written
+    digest = pending_digest(file_path)
+    if digest is not None:
+        return digest
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def url_expiry(url, default_ttl=DEFAULT_URL_TTL):
+    """
+    Expiry (epoch seconds) of a signed OSS URL, or now + default_ttl if unsigned.
+    V1 signatures carry the expiry time itself (Expires); V4 signatures carry the
+    signing time (x-oss-date, e.g. 20240101T000000Z) and a lifetime in seconds
+    from then (x-oss-expires).
+    """
+    query = parse_qs(urlparse(url).query)
+    try:
+        if "Expires" in query:
+            return float(query["Expires"][0])
+        if "x-oss-expires" in query and "x-oss-date" in query:
+            signed_at = timegm(time.strptime(query["x-oss-date"][0], "%Y%m%dT%H%M%SZ"))
+            return signed_at + float(query["x-oss-expires"][0])
+    except ValueError:
+        pass
+    return time.time() + default_ttl
+
+
+class EncodedPayloadCache:
+    """LRU of base64 data URIs keyed by (file hash, size target); max_size=None is the file as-is."""
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, file_path, max_size=None, digest=None):
+        key = (digest or file_digest(file_path), tuple(max_size) if max_size else None)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        encoded = encode_file(file_path, max_size)
+        with self.lock:
+            self.entries[key] = encoded
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return encoded
+
+
+class RemoteUrlCache:
+    """
+    Tracks where a file's exact content is already hosted remotely and until when,
+    so edits can reference the hosted URL instead of uploading the file again.
+    Persisted as JSON when a path is given.
+    """
+    def __init__(self, path=None, margin=300):
+        self.path = path
+        self.margin = margin
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def record(self, file_path, url, digest=None):
+        digest = digest or file_digest(file_path)
+        with self.lock:
+            self.entries[digest] = {"url": url, "expires_at": url_expiry(url)}
+            self._save()
+        return digest
+
+    def is_valid(self, url):
+        return url_expiry(url) - self.margin > time.time()
+
+    def lookup(self, file_path, digest=None):
+        digest = digest or file_digest(file_path)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            if entry["expires_at"] - self.margin <= time.time():
+                del self.entries[digest]
+                self._save()
+                return None
+            return entry["url"]
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class UploadedRefCache:
+    """
+    oss:// references of files uploaded to DashScope's temporary storage, keyed by
+    content hash, so an image shared by several requests (e.g. the middle image of
+    overlapping VLM pairs) is uploaded once. Concurrent requests for the same file
+    wait for a single upload.
+    """
+    def __init__(self, ttl=UPLOAD_TTL, margin=300):
+        self.ttl = ttl
+        self.margin = margin
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.file_locks = {}
+
+    def upload(self, file_path, model, api_key=None, digest=None):
+        from dashscope.utils.oss_utils import OssUtils
+
+        digest = digest or file_digest(file_path)
+        with self.lock:
+            file_lock = self.file_locks.setdefault(digest, threading.Lock())
+        with file_lock:
+            entry = self.entries.get(digest)
+            if entry is not None and entry["expires_at"] - self.margin > time.time():
+                return entry["ref"]
+            ref = OssUtils.upload(model=model, file_path=file_path, api_key=api_key)
+            self.entries[digest] = {"ref": ref, "expires_at": time.time() + self.ttl}
+            return ref
+
+
+encoded_payloads = EncodedPayloadCache()
+remote_urls = RemoteUrlCache()
+uploaded_refs = UploadedRefCache()
+
+
+def image_payload(file_path, url=None, max_size=None):
+    """
+    Image reference to send to DashScope for file_path: the given hosted url if it
+    is still valid, else a remembered hosted url for the same content, else a
+    (memoized) base64 upload of the local file, at full resolution unless max_size
+    is given. Encoding only happens in the last case.
+    """
+    if url and remote_urls.is_valid(url):
+        return url
+    digest = file_digest(file_path)
+    hosted = remote_urls.lookup(file_path, digest)
+    if hosted:
+        return hosted
+    return encoded_payloads.encode(file_path, max_size, digest)
+
+
+def model_image_ref(file_path, model, api_key=None):
+    """
+    Image reference for a multimodal request on file_path: a still-valid hosted URL
+    for the same content if known, else a (memoized) temporary upload. Falls back to
+    a file:// path, which the SDK uploads on every call, if the upload fails.
+    """
+    digest = file_digest(file_path)
+    hosted = remote_urls.lookup(file_path, digest)
+    if hosted:
+        return hosted
+    wait_written(file_path)
+    try:
+        return uploaded_refs.upload(file_path, model, api_key, digest)
+    except Exception as e:
+        print(f"upload of {file_path} failed ({e}), sending it inline")
+        return f"file://{os.path.abspath(file_path)}"
@@ -0,0 +1,557 @@
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+DEFAULT_SERVICE_URL = os.getenv("PIPELINE_SERVICE_URL", "http://127.0.0.1:8765")
+# lower runs first; interactive single calls jump ahead of evaluations and whole sequences
+DEFAULT_PRIORITY = {
+    "rewrite": 0,
+    "generate": 0,
+    "edit": 0,
+    "best_of_n": 0,
+    "vlm_check": 1,
+    "evaluate": 5,
+    "sequence": 10,
+}
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self, kind, params, priority):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.priority = priority
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.events = []
+        self.cond = threading.Condition()
+
+    def emit(self, event):
+        with self.cond:
+            self.events.append(dict(event, time=time.time()))
+            self.cond.notify_all()
+
+    def transition(self, expected, status):
+        """Move from expected to status atomically; False if the job was no longer in expected."""
+        with self.cond:
+            if self.status != expected:
+                return False
+            self.status = status
+            return True
+
+    def finish(self, status, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = status
+        self.emit({"event": "done", "status": status, "result": result, "error": error})
+
+    @property
+    def finished(self):
+        return self.status in ("ok", "failed", "cancelled")
+
+    def summary(self, full=False):
+        summary = {"id": self.id, "kind": self.kind, "priority": self.priority, "status": self.status,
+                   "created_at": self.created_at, "events": len(self.events)}
+        if full:
+            summary.update(params=self.params, result=self.result, error=self.error)
+        return summary
+
+
+class PipelineService:
+    """
+    Keeps DinoEval/CLIPEvaluator and the DashScope clients resident and runs jobs
+    from a priority queue on a pool of worker threads. Remote calls of all jobs
+    share one AsyncEngine on a private event loop, so rate limits apply across
+    users; model work goes through the BatchRunner's single evaluation thread.
+
+    Job kinds and params:
+        rewrite     prompt, edit_prompt (optional)
+        generate    prompt, filename, seed
+        edit        image, prompt, dest, url, seed, draft
+        vlm_check   image_1, prompt_1, image_2, prompt_2
+        best_of_n   step_num, prompt, output_dir, n, prev_image, source_url, draft, source_image
+        evaluate    image_paths, prompts, goal, all_goals, num_distractors
+        sequence    spec (see batch_runner.load_specs), all_goals
+    """
+    def __init__(self, workers=8, max_concurrency=8, rate=2.0, manifest_path="service_manifest.jsonl",
+                 response_cache_path=None, embedding_cache_dir=None, accel=None, max_finished=1000):
+        from async_engine import AsyncEngine
+        from batch_runner import BatchRunner
+        from embedding_cache import EmbeddingCache, DEFAULT_CACHE_DIR
+        from image_edit import image_editor
+        from image_gen import image_generator
+        from model_warmup import ModelWarmup
+        from prompt_rewriter import prompt_rewriter
+        from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+        from vlm_analyzer import vlm_analyzer
+
+        # the embedding cache makes repeated evaluations of a growing sequence only embed new images
+        cache = EmbeddingCache(embedding_cache_dir or DEFAULT_CACHE_DIR)
+        evaluator_kwargs = {"cache": cache, "accel": accel}
+        self.warmup = ModelWarmup(evaluator_kwargs, evaluator_kwargs).start()
+        response_cache = ResponseCache(response_cache_path or DEFAULT_CACHE_PATH)
+        self.engine = AsyncEngine(image_generator(), image_editor(), prompt_rewriter(cache=response_cache),
+                                  vlm_analyzer(cache=response_cache), max_concurrency=max_concurrency, rate=rate)
+        self.runner = BatchRunner(self.engine, manifest_path, load_evaluators=self.warmup.get)
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="service-loop", daemon=True)
+        self.loop_thread.start()
+
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_finished = max_finished
+        self.workers = [
+            threading.Thread(target=self._work, name=f"service-worker-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, kind, params, priority=None):
+        if kind not in DEFAULT_PRIORITY:
+            raise ValueError(f"unknown job kind {kind!r}, expected one of {sorted(DEFAULT_PRIORITY)}")
+        job = Job(kind, params or {}, DEFAULT_PRIORITY[kind] if priority is None else priority)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        job.emit({"event": "queued", "position": self.queue.qsize()})
+        self.queue.put((job.priority, next(self.counter), job))
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        # a worker may claim the job at the same time; only one of the two wins
+        if job is None or not job.transition("queued", "cancelled"):
+            return False
+        job.finish("cancelled")
+        return True
+
+    def health(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {
+            "models_ready": self.warmup.ready and self.warmup.error is None,
+            "model_error": str(self.warmup.error) if self.warmup.error else None,
+            "queued": sum(job.status == "queued" for job in jobs),
+            "running": sum(job.status == "running" for job in jobs),
+            "jobs": len(jobs),
+        }
+
+    def _work(self):
+        while True:
+            _, _, job = self.queue.get()
+            if not job.transition("queued", "running"):
+                continue
+            job.emit({"event": "started"})
+            try:
+                job.finish("ok", self._run(job))
+            except Exception as e:
+                job.finish("failed", error=f"{type(e).__name__}: {e}")
+
+    def _await(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _on_model_thread(self, fn, *args):
+        return self.runner.eval_executor.submit(fn, *args).result()
+
+    def _run(self, job):
+        from batch_runner import normalize_spec
+        from candidate_ranker import best_of_n
+        from image_writer import wait_written
+        from vlm_analyzer import parse_consistency
+
+        p = job.params
+        engine = self.engine
+        if job.kind == "rewrite":
+            if p.get("edit_prompt"):
+                return self._await(engine.rewrite_prompt_for_edit(p["prompt"], p["edit_prompt"]))
+            return self._await(engine.rewrite_prompt(p["prompt"]))
+        # clients read the result files as soon as the job is done, so queued writes are waited for
+        if job.kind == "generate":
+            url = self._await(engine.generate_image(p["prompt"], p["filename"], seed=p.get("seed")))
+            wait_written(p["filename"])
+            return {"url": url}
+        if job.kind == "edit":
+            url = self._await(engine.edit_image(p["image"], p["prompt"], p["dest"], p.get("url"),
+                                                seed=p.get("seed"), draft=p.get("draft", False)))
+            wait_written(p["dest"])
+            return {"url": url}
+        if job.kind == "vlm_check":
+            text = self._await(engine.check_image_consistency(p["image_1"], p["prompt_1"], p["image_2"], p["prompt_2"],
+                                                              verbose=False))
+            return parse_consistency(text)
+        if job.kind == "best_of_n":
+            dino_evaluator, clip_evaluator = self.warmup.get()
+            return self._await(best_of_n(engine, dino_evaluator, clip_evaluator, p["step_num"], p["prompt"],
+                                         p["output_dir"], p["n"], p.get("prev_image"), p.get("source_url"),
+                                         self.runner.eval_executor, p.get("draft", False), p.get("source_image")))
+        if job.kind == "evaluate":
+            return self._on_model_thread(self._evaluate, p)
+        spec = normalize_spec(dict(p["spec"]))
+        return self._await(self.runner.run_sequence(spec, p.get("all_goals") or [spec["goal"]], progress=job.emit))
+
+    def _evaluate(self, p):
+        from PIL import Image
+        from eval_report import evaluate_sequence
+        from image_writer import wait_written
+
+        dino_evaluator, clip_evaluator = self.warmup.get()
+        images = []
+        wait_written(*p["image_paths"])
+        for path in p["image_paths"]:
+            with Image.open(path) as img:
+                images.append(img.convert("RGB"))
+        return evaluate_sequence(dino_evaluator, clip_evaluator, images, p["prompts"], p["goal"],
+                                 p.get("all_goals"), p.get("num_distractors", 1))
+
+    def close(self):
+        self.runner.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _handler_class(service):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _job(self, job_id):
+            job = service.get(job_id)
+            if job is None:
+                self._send(404, {"error": f"no job {job_id}"})
+            return job
+
+        def _stream_events(self, job):
+            """Newline-delimited JSON events, kept open until the job finishes."""
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            sent = 0
+            while True:
+                with job.cond:
+                    while sent == len(job.events):
+                        job.cond.wait()
+                    events = job.events[sent:]
+                sent += len(events)
+                for event in events:
+                    self.wfile.write((json.dumps(event, default=str) + "\n").encode("utf-8"))
+                self.wfile.flush()
+                if events[-1]["event"] == "done":
+                    return
+
+        def do_GET(self):
+            parts = urlparse(self.path).path.strip("/").split("/")
+            if parts == ["health"]:
+                return self._send(200, service.health())
+            if parts == ["jobs"]:
+                with service.lock:
+                    jobs = list(service.jobs.values())
+                return self._send(200, [job.summary() for job in jobs])
+            if len(parts) in (2, 3) and parts[0] == "jobs":
+                job = self._job(parts[1])
+                if job is None:
+                    return
+                if len(parts) == 3 and parts[2] == "events":
+                    return self._stream_events(job)
+                return self._send(200, job.summary(full=True))
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if urlparse(self.path).path.strip("/") != "jobs":
+                return self._send(404, {"error": "not found"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                job = service.submit(body["kind"], body.get("params"), body.get("priority"))
+            except (ValueError, KeyError) as e:
+                return self._send(400, {"error": str(e)})
+            self._send(202, {"id": job.id, "priority": job.priority})
+
+        def do_DELETE(self):
+            parts = urlparse(self.path).path.strip("/").split("/")
+            if len(parts) == 2 and parts[0] == "jobs":
+                job = self._job(parts[1])
+                if job is not None:
+                    self._send(200, {"cancelled": service.cancel(job.id)})
+                return
+            self._send(404, {"error": "not found"})
+
+    return Handler
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    handler = _handler_class(service)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        return _UnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient:
+    """Talks to a PipelineService at http://host:port or unix:///path/to.sock."""
+    def __init__(self, url=DEFAULT_SERVICE_URL, timeout=None):
+        self.url = urlparse(url)
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.url.scheme == "unix":
+            return _UnixHTTPConnection(self.url.path, self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+
+    def _request(self, method, path, payload=None):
+        conn = self._connection()
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            conn.request(method, path, body, {"Content-Type": "application/json"} if body else {})
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"null")
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise ServiceError(f"{method} {path}: {response.status} {data}")
+        return data
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def submit(self, kind, params, priority=None):
+        return self._request("POST", "/jobs", {"kind": kind, "params": params, "priority": priority})["id"]
+
+    def job(self, job_id):
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def cancel(self, job_id):
+        return self._request("DELETE", f"/jobs/{job_id}")["cancelled"]
+
+    def events(self, job_id):
+        """Yield the job's progress events as they happen, ending with the "done" event."""
+        conn = self._connection()
+        try:
+            conn.request("GET", f"/jobs/{job_id}/events")
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise ServiceError(f"events of {job_id}: {response.status}")
+            for line in response:
+                event = json.loads(line)
+                yield event
+                if event["event"] == "done":
+                    return
+        finally:
+            conn.close()
+
+    def wait(self, job_id, on_event=None):
+        for event in self.events(job_id):
+            if on_event is not None:
+                on_event(event)
+            if event["event"] == "done":
+                if event["status"] != "ok":
+                    raise ServiceError(f"job {job_id} {event['status']}: {event['error']}")
+                return event["result"]
+        raise ServiceError(f"event stream of job {job_id} ended early")
+
+    def run(self, kind, params, priority=None, on_event=None):
+        """Submit a job and block until its result."""
+        return self.wait(self.submit(kind, params, priority), on_event)
+
+
+class ServiceProxy:
+    """
+    Stand-in for image_generator, image_editor, prompt_rewriter and vlm_analyzer that
+    forwards every call to a pipeline service, so interactive runs need no local
+    clients or models. The service shares this host's filesystem, so paths are
+    passed as absolute paths.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _open(path):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    def generate_image(self, prompt, filename, return_image=False, seed=None):
+        url = self.client.run("generate", {"prompt": prompt, "filename": os.path.abspath(filename),
+                                           "seed": seed})["url"]
+        if not return_image:
+            return url
+        return (url, self._open(filename)) if url else (None, None)
+
+    def edit_image(self, image_filepath, prompt, dest_filename, edit_url, return_image=False, seed=None, draft=False):
+        url = self.client.run("edit", {"image": os.path.abspath(image_filepath), "prompt": prompt,
+                                       "dest": os.path.abspath(dest_filename), "url": edit_url,
+                                       "seed": seed, "draft": draft})["url"]
+        if not return_image:
+            return url
+        return (url, self._open(dest_filename)) if url else (None, None)
+
+    def rewrite_prompt(self, original_prompt, bypass_cache=False):
+        return self.client.run("rewrite", {"prompt": original_prompt})
+
+    def rewrite_prompt_for_edit(self, original_prompt, edit_prompt, bypass_cache=False):
+        return self.client.run("rewrite", {"prompt": original_prompt, "edit_prompt": edit_prompt})
+
+    def check_image_consistency(self, image_1_path, image_1_prompt, image_2_path, image_2_prompt,
+                                bypass_cache=False, verbose=True):
+        result = self.client.run("vlm_check", {"image_1": os.path.abspath(image_1_path), "prompt_1": image_1_prompt,
+                                               "image_2": os.path.abspath(image_2_path), "prompt_2": image_2_prompt})
+        if verbose:
+            print(result["text"])
+        return result["text"]
+
+
+class ServiceLiveMetrics:
+    """
+    LiveMetrics counterpart for service mode: every accepted step queues an
+    evaluation of the sequence so far on the service, whose embedding cache
+    means only the new image is embedded.
+    """
+    def __init__(self, client, goal_text):
+        self.client = client
+        self.goal_text = goal_text
+        self.paths = []
+        self.prompts = []
+        self.latest = None
+        self.shown = None
+
+    def _submit(self):
+        self.latest = self.client.submit("evaluate", {"image_paths": list(self.paths), "prompts": list(self.prompts),
+                                                      "goal": self.goal_text})
+
+    def add(self, image, prompt, path=None):
+        self.paths.append(os.path.abspath(path))
+        self.prompts.append(prompt)
+        self._submit()
+
+    def replace_last(self, image, prompt=None, path=None):
+        if path is not None:
+            self.paths[-1] = os.path.abspath(path)
+        if prompt is not None:
+            self.prompts[-1] = prompt
+        self._submit()
+
+    def restore(self, prompts, paths=None, features=None):
+        """Resume with already accepted steps; the service's embedding cache already holds their features."""
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.prompts = list(prompts)
+        self._submit()
+
+    def checkpoint(self, callback):
+        # features stay in the service's embedding cache; only the latest metrics are kept
+        callback(None, self.shown)
+
+    def show(self):
+        if self.latest is None:
+            return
+        job = self.client.job(self.latest)
+        if job["status"] == "ok":
+            self.shown = job["result"]
+        elif job["status"] == "failed":
+            print(f"[live metrics unavailable: {job['error']}]")
+            return
+        if self.shown is None:
+            print("[live metrics: first step still being evaluated]")
+            return
+        print(f"[live metrics, {self.shown['num_images']} step(s)] DINO-I {self.shown['dino_i']:.3f}  "
+              f"CLIP-I {self.shown['clip_i']:.3f}  CLIP-T {self.shown['clip_t']:.3f}"
+              + ("" if job["status"] == "ok" else "  (update pending)"))
+
+    def report(self, all_goal_texts=None, num_distractors=1):
+        return self.client.run("evaluate", {"image_paths": self.paths, "prompts": self.prompts, "goal": self.goal_text,
+                                            "all_goals": all_goal_texts, "num_distractors": num_distractors})
+
+    def close(self):
+        pass
+
+
+def main():
+    import image_writer
+    import tracing
+
+    parser = argparse.ArgumentParser(description="Local pipeline service with resident models and a job queue")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=8, help="jobs run at once")
+    parser.add_argument("--concurrency", type=int, default=8, help="max DashScope calls in flight")
+    parser.add_argument("--rate", type=float, default=2.0, help="initial DashScope calls per second")
+    parser.add_argument("--manifest", default="service_manifest.jsonl", help="manifest rows of sequence jobs")
+    parser.add_argument("--accel", help="evaluator acceleration, e.g. int8 (see accel.py)")
+    image_writer.add_arguments(parser)
+    parser.add_argument("--trace", help="append per-stage spans to this JSONL file")
+    parser.add_argument("--metrics", help="write a Prometheus text snapshot of stage timings here at exit")
+    args = parser.parse_args()
+    if args.trace or args.metrics:
+        tracing.configure(args.trace, args.metrics)
+    image_writer.configure_from_args(args)
+
+    service = PipelineService(workers=args.workers, max_concurrency=args.concurrency, rate=args.rate,
+                              manifest_path=args.manifest, accel=args.accel)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    where = f"unix://{args.unix_socket}" if args.unix_socket else f"http://{args.host}:{args.port}"
+    print(f"pipeline service listening on {where} (models loading in the background)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
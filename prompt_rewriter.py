@@ -1,13 +1,17 @@
 import os 
 import dashscope
 from dotenv import load_dotenv
+from utils import dashscope_base_url, raise_if_throttled
+from tracing import traced, current_span, record_usage
 
 
 
 class prompt_rewriter:
-    def __init__(self):
-        dashscope.base_http_api_url = 'https://dashscope-intl.aliyuncs.com/api/v1'
+    def __init__(self, cache=None):
+        # optional ResponseCache; identical rewrite requests are served from it
+        self.cache = cache
         load_dotenv()
+        dashscope.base_http_api_url = dashscope_base_url()
         self.api_key = os.getenv("ALIBABA_API_KEY")
         self.edit_system_prompt = """
 Given an original prompt and an edit prompt, generate a consistent, succinct prompt to pass to an image edit generation model. Keep all key details the same, but include the desired edits while ensuring to keep other details consistent. 
@@ -26,30 +30,41 @@ You are an expert AI Image Prompt Engineer. Your sole task is to take a simple,
 """
 
     
-    def rewrite_prompt(self, original_prompt):
-        messages = [
-            {'role': 'system', 'content': self.system_prompt},
-            {'role': 'user', 'content': original_prompt}
-        ]
-        response = dashscope.Generation.call(
-        api_key=self.api_key,
-        model="qwen-plus",
-        messages=messages,
-        result_format='message'
-        )
-        response = response.output.get("choices", [])[0].get("message", {}).get("content", [])
-        return(response)
+    def rewrite_prompt(self, original_prompt, bypass_cache=False):
+        return self._rewrite(self.system_prompt, original_prompt, bypass_cache)
     
-    def rewrite_prompt_for_edit(self, original_prompt, edit_prompt):
+    def rewrite_prompt_for_edit(self, original_prompt, edit_prompt, bypass_cache=False):
+        return self._rewrite(
+            self.edit_system_prompt,
+            f"Original Prompt: {original_prompt}, Edit Prompt: {edit_prompt}",
+            bypass_cache
+        )
+
+    @traced("rewrite", model="qwen-plus")
+    def _rewrite(self, system_prompt, user_content, bypass_cache=False):
+        model = "qwen-plus"
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(model, system_prompt, user_content)
+            cached = self.cache.get(cache_key, bypass=bypass_cache)
+            if cached is not None:
+                current_span().set(cached=True)
+                return cached
+
         messages = [
-            {'role': 'system', 'content': self.edit_system_prompt},
-            {'role': 'user', 'content': f"Original Prompt: {original_prompt}, Edit Prompt: {edit_prompt}"}
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_content}
         ]
         response = dashscope.Generation.call(
         api_key=self.api_key,
-        model="qwen-plus",
+        model=model,
         messages=messages,
         result_format='message'
         )
+        current_span().set(status_code=response.status_code, cached=False)
+        record_usage(response)
+        raise_if_throttled(response)
         response = response.output.get("choices", [])[0].get("message", {}).get("content", [])
+        if cache_key is not None and response:
+            self.cache.put(cache_key, response)
         return(response)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from image_writer import wait_written
+from payload_cache import file_digest, url_expiry, remote_urls
+
+
+SESSION_FILE = "session.json"
+FEATURES_FILE = "session_features.npz"
+FEATURE_NAMES = ("dino", "clip_image", "clip_text", "clip_step")
+
+
+class SequenceSession:
+    """
+    On-disk checkpoint of an interactive sequence in its output directory.
+    session.json (goal, step count, accepted steps with prompt, file, digest and
+    hosted URL + expiry, edit prompts, latest metrics) is rewritten atomically
+    after every accepted step; the steps' DINO/CLIP features go to a .npz next to
+    it once they are embedded. A resumed run continues at the next step without
+    regenerating or re-embedding anything.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, SESSION_FILE)
+        self.features_path = os.path.join(output_dir, FEATURES_FILE)
+        self.lock = threading.Lock()
+        self.state = {
+            "version": 1,
+            "goal": None,
+            "num_steps": None,
+            "edit_url": None,
+            "steps": [],
+            "edit_prompts": [],
+            "embedded_steps": 0,
+            "metrics": None,
+            "updated_at": None,
+        }
+
+    @classmethod
+    def load(cls, output_dir):
+        session = cls(output_dir)
+        if not os.path.exists(session.path):
+            raise FileNotFoundError(f"no {SESSION_FILE} in {output_dir}")
+        with open(session.path) as f:
+            session.state.update(json.load(f))
+        return session
+
+    @staticmethod
+    def exists(output_dir):
+        return os.path.exists(os.path.join(output_dir, SESSION_FILE))
+
+    def start(self, goal, num_steps):
+        with self.lock:
+            self.state.update(goal=goal, num_steps=num_steps)
+            self._save()
+
+    @property
+    def goal(self):
+        return self.state["goal"]
+
+    @property
+    def num_steps(self):
+        return self.state["num_steps"]
+
+    @property
+    def steps(self):
+        return self.state["steps"]
+
+    @property
+    def next_step(self):
+        return len(self.state["steps"]) + 1
+
+    def accept_step(self, step_num, path, prompt, url=None, edit_url=None):
+        """Record (or overwrite) accepted step step_num and write the session file."""
+        # the checkpoint must never point at a file that is still only queued
+        wait_written(path)
+        step = {
+            "step": step_num,
+            "path": path,
+            "prompt": prompt,
+            "digest": file_digest(path),
+            "url": url,
+            "url_expires_at": url_expiry(url) if url else None,
+        }
+        with self.lock:
+            del self.state["steps"][step_num - 1:]
+            self.state["steps"].append(step)
+            self.state["embedded_steps"] = min(self.state["embedded_steps"], step_num - 1)
+            if edit_url is not None:
+                self.state["edit_url"] = edit_url
+            self._save()
+
+    def add_edit_prompt(self, edit_prompt):
+        with self.lock:
+            self.state["edit_prompts"].append(edit_prompt)
+            self._save()
+
+    def save_features(self, features, metrics=None):
+        """
+        Store the features of the accepted steps (dict of (steps, dim) arrays in
+        the LiveMetrics.features layout; rows past the accepted steps are dropped)
+        and the latest metrics. features may be None to store only the metrics.
+        """
+        with self.lock:
+            if features is None:
+                self.state["metrics"] = metrics
+                self._save()
+                return
+            num_steps = min(len(self.state["steps"]), *(len(features[name]) for name in FEATURE_NAMES))
+            tmp_path = self.features_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **{name: np.asarray(features[name][:num_steps], dtype=np.float32)
+                               for name in FEATURE_NAMES})
+            os.replace(tmp_path, self.features_path)
+            self.state["embedded_steps"] = num_steps
+            if metrics is not None:
+                self.state["metrics"] = metrics
+            self._save()
+
+    def features(self):
+        """Stored features of the accepted steps, or None if none were saved."""
+        embedded = self.state["embedded_steps"]
+        if not embedded or not os.path.exists(self.features_path):
+            return None
+        with np.load(self.features_path) as data:
+            return {name: data[name][:embedded] for name in FEATURE_NAMES}
+
+    def verify(self):
+        """Raise ValueError if an accepted step's file is missing or no longer matches its digest."""
+        for step in self.state["steps"]:
+            if not os.path.exists(step["path"]):
+                raise ValueError(f"step {step['step']}: {step['path']} is missing")
+            if file_digest(step["path"]) != step["digest"]:
+                raise ValueError(f"step {step['step']}: {step['path']} changed since it was accepted")
+
+    def valid_url(self, url, expires_at, margin=300):
+        return url if url and expires_at and expires_at - margin > time.time() else None
+
+    def restore_urls(self):
+        """
+        Re-register the still-valid hosted URLs of the accepted steps so edits
+        reference them instead of uploading the files again. Returns the edit URL
+        to continue with, the accepted step 1's hosted copy, or None if it expired.
+        """
+        for step in self.state["steps"]:
+            url = self.valid_url(step["url"], step["url_expires_at"])
+            if url:
+                remote_urls.record(step["path"], url, step["digest"])
+        if self.state["steps"] and self.state["steps"][0]["url"]:
+            # older checkpoints stored step 1's pre-edit generation URL as edit_url
+            first = self.state["steps"][0]
+            return self.valid_url(first["url"], first["url_expires_at"])
+        edit_url = self.state["edit_url"]
+        return self.valid_url(edit_url, url_expiry(edit_url)) if edit_url else None
+
+    def _save(self):
+        self.state["updated_at"] = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_cache import EmbeddingStore
+
+
+def vec(value, dim=4):
+    return np.full(dim, value, dtype=np.float32)
+
+
+def crash(store):
+    # a killed process leaves the mmaps as written and releases its lock
+    store.vectors.flush()
+    store.slot_keys.flush()
+    store.lock_file.close()
+
+
+def test_crash_after_recycling_a_slot_drops_only_the_evicted_key(tmp_path):
+    store = EmbeddingStore(str(tmp_path), 4, 3)
+    for i, key in enumerate("abc"):
+        store.put(key, vec(i))
+    store.flush()
+    # recycles a's slot 0, then dies before index.json is saved
+    store.put("d", vec(3))
+    crash(store)
+
+    store = EmbeddingStore(str(tmp_path), 4, 3)
+    assert store.get("a") is None
+    store.put("e", vec(4))
+    assert store.slots["e"] == 0
+    np.testing.assert_array_equal(store.get("b"), vec(1))
+    np.testing.assert_array_equal(store.get("c"), vec(2))
+    np.testing.assert_array_equal(store.get("e"), vec(4))
+    assert sorted(store.slots.values()) == [0, 1, 2]
+
+
+def test_flushed_store_reloads(tmp_path):
+    store = EmbeddingStore(str(tmp_path), 4, 2)
+    store.put("a", vec(1))
+    store.put("b", vec(2))
+    store.put("c", vec(3))
+    store.flush()
+    crash(store)
+
+    store = EmbeddingStore(str(tmp_path), 4, 2)
+    assert store.get("a") is None
+    np.testing.assert_array_equal(store.get("b"), vec(2))
+    np.testing.assert_array_equal(store.get("c"), vec(3))
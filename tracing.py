@@ -0,0 +1,214 @@
+import atexit
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+
+class _State:
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = None
+        self.metrics_path = None
+        self.lock = threading.Lock()
+        # stage -> aggregate counters for the Prometheus snapshot
+        self.stats = defaultdict(lambda: defaultdict(float))
+
+
+_state = _State()
+_current_span = contextvars.ContextVar("current_span", default=None)
+_trace_context = contextvars.ContextVar("trace_context", default={})
+
+
+class Span:
+    """One timed stage. Attributes set on it (bytes, images, tokens, ...) are exported with it."""
+    __slots__ = ("stage", "attrs", "start", "wall_start", "token")
+
+    def __init__(self, stage, attrs):
+        self.stage = stage
+        self.attrs = dict(_trace_context.get())
+        self.attrs.update(attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, name, value):
+        self.attrs[name] = self.attrs.get(name, 0) + value
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _current_span.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        _record(self, duration)
+        return False
+
+
+class _NoopSpan:
+    """Stand-in returned while tracing is disabled; every operation is a no-op."""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def configure(trace_path=None, metrics_path=None):
+    """
+    Enable tracing. Spans are appended to trace_path as JSONL; a Prometheus text
+    snapshot is written to metrics_path at exit. With neither set, tracing is off.
+    """
+    with _state.lock:
+        if _state.trace_file is not None:
+            _state.trace_file.close()
+            _state.trace_file = None
+        if trace_path:
+            _state.trace_file = open(trace_path, "a", buffering=1)
+        _state.metrics_path = metrics_path
+        _state.enabled = bool(trace_path or metrics_path)
+
+
+def enabled():
+    return _state.enabled
+
+
+def span(stage, **attrs):
+    """Context manager timing one stage, e.g. `with span("download", url=url) as s: s.set(bytes=n)`."""
+    if not _state.enabled:
+        return _NOOP_SPAN
+    return Span(stage, attrs)
+
+
+def current_span():
+    """The innermost active span, for adding attributes from inside a traced function."""
+    if not _state.enabled:
+        return _NOOP_SPAN
+    return _current_span.get() or _NOOP_SPAN
+
+
+def traced(stage, **static_attrs):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return fn(*args, **kwargs)
+            with Span(stage, static_attrs):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class trace_context:
+    """Tag every span opened inside the block with these attributes (e.g. sequence, step)."""
+    def __init__(self, **attrs):
+        self.attrs = attrs
+        self.token = None
+
+    def __enter__(self):
+        merged = dict(_trace_context.get())
+        merged.update(self.attrs)
+        self.token = _trace_context.set(merged)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _trace_context.reset(self.token)
+        return False
+
+
+def set_context(**attrs):
+    """Like trace_context, but stays in effect until changed again (for long flat flows like main_loop)."""
+    merged = dict(_trace_context.get())
+    merged.update(attrs)
+    _trace_context.set(merged)
+
+
+def record_usage(response):
+    """Copy token/image counts from a DashScope response's usage onto the current span."""
+    span = current_span()
+    if span is _NOOP_SPAN:
+        return
+    usage = getattr(response, "usage", None) or {}
+    for name in ("input_tokens", "output_tokens", "image_count"):
+        value = usage.get(name) if hasattr(usage, "get") else None
+        if value is not None:
+            span.set(**{name: value})
+
+
+def _record(span, duration):
+    record = {"ts": span.wall_start, "stage": span.stage, "duration_s": duration}
+    record.update(span.attrs)
+    with _state.lock:
+        stats = _state.stats[span.stage]
+        stats["count"] += 1
+        stats["duration_seconds"] += duration
+        if "error" in span.attrs:
+            stats["errors"] += 1
+        for name in ("bytes", "images", "input_tokens", "output_tokens"):
+            value = span.attrs.get(name)
+            if isinstance(value, (int, float)):
+                stats[name] += value
+        if _state.trace_file is not None:
+            _state.trace_file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+def prometheus_snapshot():
+    """Aggregate span statistics in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE pipeline_stage_duration_seconds summary",
+    ]
+    with _state.lock:
+        stats = {stage: dict(values) for stage, values in _state.stats.items()}
+    for stage, values in sorted(stats.items()):
+        lines.append(f'pipeline_stage_duration_seconds_sum{{stage="{stage}"}} {values.get("duration_seconds", 0.0)}')
+        lines.append(f'pipeline_stage_duration_seconds_count{{stage="{stage}"}} {int(values.get("count", 0))}')
+    for name, metric in (("errors", "pipeline_stage_errors_total"),
+                         ("bytes", "pipeline_stage_bytes_total"),
+                         ("images", "pipeline_stage_images_total"),
+                         ("input_tokens", "pipeline_stage_input_tokens_total"),
+                         ("output_tokens", "pipeline_stage_output_tokens_total")):
+        lines.append(f"# TYPE {metric} counter")
+        for stage, values in sorted(stats.items()):
+            value = values.get(name, 0)
+            lines.append(f'{metric}{{stage="{stage}"}} {int(value) if float(value).is_integer() else value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_snapshot())
+    os.replace(tmp_path, path)
+
+
+def _at_exit():
+    if _state.metrics_path:
+        write_prometheus(_state.metrics_path)
+    if _state.trace_file is not None:
+        _state.trace_file.close()
+
+
+atexit.register(_at_exit)
+
+if os.getenv("PIPELINE_TRACE") or os.getenv("PIPELINE_METRICS"):
+    configure(os.getenv("PIPELINE_TRACE"), os.getenv("PIPELINE_METRICS"))
@@ -1,38 +1,114 @@
 import mimetypes
 import base64
+import os
 import io
+import json
+import re
 import requests
 from PIL import Image
+from downloader import get_downloader
+from image_writer import get_image_writer, wait_written
+from tracing import traced, current_span
 
 
+STEP_FILE_RE = re.compile(r"^step_(\d+)\.png$")
+
+DEFAULT_DASHSCOPE_BASE_URL = 'https://dashscope-intl.aliyuncs.com/api/v1'
+
+
+def dashscope_base_url():
+    """DashScope API base URL, overridable with DASHSCOPE_BASE_URL (e.g. to point at mock_dashscope)."""
+    return os.getenv("DASHSCOPE_BASE_URL", DEFAULT_DASHSCOPE_BASE_URL)
+
+
+class ThrottledError(Exception):
+    """Raised when DashScope rejects a call because of rate limiting."""
+
+
+def raise_if_throttled(response):
+    """Raise ThrottledError if a DashScope response is a throttling rejection."""
+    status_code = getattr(response, "status_code", None)
+    code = getattr(response, "code", None) or ""
+    if status_code == 429 or str(code).startswith("Throttling"):
+        raise ThrottledError(f"{status_code} {code}: {getattr(response, 'message', '')}")
+
+
+@traced("encode")
 def encode_file(file_path, max_size=(1024, 1024)):
-    """Encode image to base64, resize if too large."""
+    """Encode image to base64, resize if too large (max_size=None sends it at full size)."""
     mime_type, _ = mimetypes.guess_type(file_path)
     if not mime_type or not mime_type.startswith("image/"):
         raise ValueError("Unsupported image format")
+    wait_written(file_path)
 
     try:
         with Image.open(file_path) as img:
+            if max_size is None or (img.width <= max_size[0] and img.height <= max_size[1]):
+                # already fits: send the file as-is instead of decoding and re-encoding it
+                with open(file_path, 'rb') as f:
+                    encoded = base64.b64encode(f.read()).decode('utf-8')
+                current_span().set(bytes=len(encoded), resized=False)
+                return f"data:{mime_type};base64,{encoded}"
+
             img.thumbnail(max_size, Image.Resampling.LANCZOS)
             
             buffer = io.BytesIO()
             img.save(buffer, format=img.format or 'PNG')
             encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            current_span().set(bytes=len(encoded), resized=True)
             return f"data:{mime_type};base64,{encoded}"
     except IOError as e:
         raise IOError(f"Failed to encode file: {e}")
     
 
 def save_image_from_url(image_url, filename):
+    """
+    Download image_url and queue it for writing to filename on the background
+    image writer (see image_writer). Returns the decoded PIL Image, or None if the
+    download failed. The file is not on disk yet when this returns: a failed write
+    is raised by image_writer.wait_written(filename), which every reader of the
+    file goes through, rather than being reported here.
+    """
     try:
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status() 
+        data, image = get_downloader().fetch_image(image_url)
 
-        with open(filename, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+        get_image_writer().submit(filename, data, image)
         print(f"Image '{filename}' downloaded successfully from {image_url}")
+        return image
     except requests.exceptions.RequestException as e:
         print(f"Error downloading image from {image_url}: {e}")
     except IOError as e:
-        print(f"Error saving image to {filename}: {e}")
\ No newline at end of file
+        print(f"Error saving image to {filename}: {e}")
+
+
+def load_sequence(seq_dir):
+    """
+    Read a sequence directory: step_N.png files plus prompts.json
+    ({"goal": ..., "prompts": [...]}) as written by batch_runner.
+
+    Returns:
+        (image paths in step order, goal text, list of step prompts)
+    """
+    steps = []
+    for name in os.listdir(seq_dir):
+        match = STEP_FILE_RE.match(name)
+        if match:
+            steps.append((int(match.group(1)), os.path.join(seq_dir, name)))
+    steps.sort()
+
+    with open(os.path.join(seq_dir, "prompts.json")) as f:
+        manifest = json.load(f)
+    prompts = manifest["prompts"]
+    if len(prompts) != len(steps):
+        raise ValueError(f"{seq_dir}: {len(steps)} step images but {len(prompts)} prompts")
+    return [path for _, path in steps], manifest.get("goal", ""), prompts
+
+
+def find_sequence_dirs(root):
+    """All directories under root holding a sequence (prompts.json plus step_N.png files), sorted."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if "prompts.json" in filenames and any(STEP_FILE_RE.match(name) for name in filenames):
+            found.append(dirpath)
+    return sorted(found)
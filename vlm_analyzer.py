@@ -1,12 +1,19 @@
 import os
+import re
 import dashscope
 from dashscope import MultiModalConversation
 from dotenv import load_dotenv
+from utils import dashscope_base_url, raise_if_throttled
+from payload_cache import file_digest, model_image_ref
+from tracing import traced, current_span, record_usage
 
 class vlm_analyzer:
     
-    def __init__(self):
+    def __init__(self, cache=None):
         load_dotenv()
+        # optional ResponseCache, keyed on the prompt text and both images' content
+        self.cache = cache
+        self.model = 'qwen3-vl-plus'
         category_focus = {
             1: "the tracked object(s) maintaining visual identity (same colors, shapes)",
             2: "the tool/agent staying consistent even as the object transforms",
@@ -17,7 +24,7 @@ class vlm_analyzer:
             7: "adherence to the prompt"
         }
 
-        dashscope.base_http_api_url = 'https://dashscope-intl.aliyuncs.com/api/v1'
+        dashscope.base_http_api_url = dashscope_base_url()
     
         self.prompt = f"""You are a strict consistency checker for sequential images in aphasia research.
 
@@ -45,25 +52,83 @@ class vlm_analyzer:
 
         Start your response with either "PASS:" or "FAIL:" followed by your analysis."""
 
-    def check_image_consistency(self, image_1_path, image_1_prompt, image_2_path, image_2_prompt):
-        image_1_path = f"file://{image_1_path}"
-        image_2_path = f"file://{image_2_path}"
+    @traced("vlm_check", model="qwen3-vl-plus")
+    def check_image_consistency(self, image_1_path, image_1_prompt, image_2_path, image_2_prompt, bypass_cache=False,
+                                verbose=True):
+        text = self.prompt + 'image 1 prompt:' + image_1_prompt + 'image 2 prompt' + image_2_prompt
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.model, None, text, [file_digest(image_1_path), file_digest(image_2_path)])
+            cached = self.cache.get(cache_key, bypass=bypass_cache)
+            if cached is not None:
+                current_span().set(cached=True)
+                if verbose:
+                    print(cached)
+                return cached
+
+        # hosted URL or a once-per-file upload, shared by every pair the image is in
+        api_key = os.getenv('ALIBABA_API_KEY')
+        image_1_path = model_image_ref(image_1_path, self.model, api_key)
+        image_2_path = model_image_ref(image_2_path, self.model, api_key)
 
         messages = [{'role':'user',
                 # When using a model from the Qwen2.5-VL series with an image list, you can set the fps parameter. This parameter indicates that the images are extracted from a source video at an interval of 1/fps seconds. The setting is ignored for other models.
              'content': [{'image': image_1_path},
                          {'image': image_2_path},
-                         {'text': self.prompt + 'image 1 prompt:' + image_1_prompt + 'image 2 prompt' + image_2_prompt}]}]
+                         {'text': text}]}]
         
         
         response = MultiModalConversation.call(
-        api_key=os.getenv('ALIBABA_API_KEY'),
-        model='qwen3-vl-plus',  
+        api_key=api_key,
+        model=self.model,  
         messages=messages)
+        current_span().set(status_code=response.status_code, images=2, cached=False)
+        record_usage(response)
+        raise_if_throttled(response)
         
-        print(response)
-        print(response["output"]["choices"][0]["message"].content[0]["text"])
+        if verbose:
+            print(response)
+        text = response["output"]["choices"][0]["message"].content[0]["text"]
+        if verbose:
+            print(text)
+        if cache_key is not None:
+            self.cache.put(cache_key, text)
+        return text
+
+
+
+VERDICT_RE = re.compile(r"\b(PASS|FAIL)\s*:", re.IGNORECASE)
+QUESTION_RE = re.compile(r"^\W*(\d+)\s*[.):]\W*(.*)$")
+ANSWER_RE = re.compile(r"\b(yes|no)\b", re.IGNORECASE)
+
+
+def parse_consistency(text):
+    """
+    Structured form of a check_image_consistency response.
 
+    Returns:
+        dict with verdict ("PASS", "FAIL" or None if missing), passed, answers
+        ({question number: {"answer": "yes"/"no"/None, "explanation": str}}) and the raw text
+    """
+    text = text or ""
+    match = VERDICT_RE.search(text)
+    verdict = match.group(1).upper() if match else None
+    answers = {}
+    current = None
+    for line in text.splitlines():
+        question = QUESTION_RE.match(line.strip())
+        if question:
+            body = question.group(2).strip()
+            answer = ANSWER_RE.search(body)
+            current = {"answer": answer.group(1).lower() if answer else None, "explanation": body}
+            answers[int(question.group(1))] = current
+        elif current is not None and line.strip():
+            # explanation continued on the next line; pick up the yes/no if the first line lacked it
+            current["explanation"] += " " + line.strip()
+            if current["answer"] is None:
+                answer = ANSWER_RE.search(line)
+                current["answer"] = answer.group(1).lower() if answer else None
+    return {"verdict": verdict, "passed": verdict == "PASS", "answers": answers, "text": text}
 
 
 # vlm = vlm_analyzer()